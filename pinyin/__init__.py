@@ -10,6 +10,7 @@ sys.path.append(utils.toolkitdir("pinyin", "vendor", "python27"))
 sys.path.append(utils.toolkitdir("pinyin", "vendor", "cjklib"))
 sys.path.append(utils.toolkitdir("pinyin", "vendor", "sqlalchemy", "lib"))
 
+import characters
 import config
 import db
 import dictionary
@@ -21,6 +22,7 @@ import mocks
 import model
 import numberutils
 import statistics
+import syllables
 import transformations
 
 #import anki  # Don't import the anki submodule because it imports lots of anki stuff,
@@ -4,17 +4,22 @@
 from aqt.qt import *
 from aqt.utils import showInfo
 from anki.find import Finder
+from anki.utils import ids2str
 
 import pinyin.anki.keys
+import pinyin.bulkfill
 import pinyin.factproxy
+import pinyin.focusupdates
 import pinyin.media
+import pinyin.profiling
 import pinyin.transformations
 import pinyin.utils
 
 from pinyin.logger import log
 from pinyin.config import getconfig, saveconfig
 
-from copy import deepcopy
+import os
+import weakref
 
 #
 # A base class for hooks added using the addHook routine.
@@ -36,12 +41,10 @@ class ToolMenuHook(Hook):
         log.info("Installing a menu hook (%s)", type(self))
 
 class FocusHook(Hook):
-
+    
     # Called by anki editor (aqt.editor)
     # Requires boolean return value: true if note was updated
     def onFocusLost(self, flag, note, fldIdx):
-        savedNoteValues = deepcopy(note.values())
-
         fieldNames = self.mw.col.models.fieldNames(note.model())
         currentFieldName = fieldNames[fldIdx]
         log.info("User moved focus from the field %s", currentFieldName)
@@ -60,25 +63,66 @@ class FocusHook(Hook):
                 updater = self.updaters.get(key)
                 break
 
-        # Update the card, ignoring any errors
         fieldValue = note.fields[fldIdx]
         if not updater:
             return flag
-
-        pinyin.utils.suppressexceptions(
-            lambda: updater.updatefact(factproxy, fieldValue))
-
-        noteChanged = (savedNoteValues != note.values())
-
-        return noteChanged
+        
+        # Looking things up can take a while (particularly if we end up asking Google), so we do it on
+        # another thread with a copy of the fields, and only touch the note once we are back on this one
+        fields = dict([(key, factproxy[key]) for key in factproxy.fieldnames])
+        deferred = pinyin.bulkfill.deferredcopy(updater)
+        
+        def apply(update):
+            # If the user has changed the field again since, there's no point: another update will be along
+            if note.fields[fldIdx] != fieldValue:
+                return
+            
+            # NB: don't reload the editor unless we have to, as that loses whatever the user is typing
+            if pinyin.focusupdates.applyupdate(self.notifier, self.mediamanager, factproxy, fields, update) != 0 and factproxy.dirty:
+                self.showUpdatedNote(note)
+        
+        self.updates.submit(note.id, lambda: pinyin.focusupdates.computeupdate(deferred, "updatefact", fields, fieldValue), apply)
+        self.timer.start()
+        
+        # The note hasn't changed yet: we'll tell the editor when it has
+        return flag
+    
+    def applyUpdates(self):
+        pinyin.utils.suppressexceptions(self.updates.applyready)
+        if self.updates.pending == 0:
+            self.timer.stop()
+    
+    def showUpdatedNote(self, note):
+        # Do what the editor does when we report a change straight away: notes already in the
+        # collection are saved, while those still being added are left for the user to add
+        if self.mw.col.db.scalar("select 1 from notes where id = ?", note.id):
+            note.flush()
+        
+        for editor in self.editors.keys():
+            if editor.note is note:
+                editor.loadNote()
+    
+    def onLoadNote(self, editor):
+        self.editors[editor] = True
     
     def install(self):
-        from anki.hooks import addHook, remHook
+        from anki.hooks import addHook, remHook, wrap
+        import aqt.editor
         
         # Install hook into focus event of Anki: we regenerate the model information when
         # the cursor moves from the Expression/Reading/whatever field to another field
         log.info("Installing focus hook")
         
+        # Updates are worked out in the background, and we check for finished ones while any are pending
+        self.updates = pinyin.focusupdates.BackgroundUpdates()
+        self.timer = QTimer(self.mw)
+        self.timer.setInterval(50)
+        self.mw.connect(self.timer, SIGNAL('timeout()'), self.applyUpdates)
+        
+        # Keep track of the editors, so we can show them updated notes. NB: weakly, so closed ones can go
+        self.editors = weakref.WeakKeyDictionary()
+        aqt.editor.Editor.loadNote = wrap(aqt.editor.Editor.loadNote, self.onLoadNote, "after")
+        
         # Unconditionally add our new hook to Anki
         addHook('editFocusLost', self.onFocusLost)
 
@@ -171,8 +215,8 @@ hookbuilders = [
 # Build hooks that are invoked from the menu.
 #
 def buildHooks(menu, mw, config, notifier, mediamanager, updaters):
-    buildHookMissingInformation(menu, mw, config, notifier, updaters)
-    buildHookReformatReadings(menu, mw, config, notifier, updaters)
+    buildHookMissingInformation(menu, mw, config, notifier, mediamanager, updaters)
+    buildHookReformatReadings(menu, mw, config, notifier, mediamanager, updaters)
     menu.addSeparator()
     buildHookPreferences(menu, mw, config, notifier, mediamanager)
     buildHookHelp(menu, mw)
@@ -190,22 +234,22 @@ def buildHookPreferences(menu, mw, config, notifier, mediamanager):
     function = lambda: openPreferences(mw, config, notifier, mediamanager)
     createAction(menu, mw, title, tip, function)
 
-def buildHookMissingInformation(menu, mw, config, notifier, updaters):
+def buildHookMissingInformation(menu, mw, config, notifier, mediamanager, updaters):
     title = 'Fill missing card data'
     tip = 'Update all the cards in the deck with any missing information the Pinyin Toolkit can provide.'
     field = "expression"
     updatehow = "updatefact"
     notification = "All missing information has been successfully added to your deck."
-    function = lambda: runBulkFill(mw, config, notifier, updaters, field, updatehow, notification)
+    function = lambda: runBulkFill(mw, config, notifier, mediamanager, updaters, field, updatehow, notification)
     createBulkFillAction(menu, mw, title, tip, function)
 
-def buildHookReformatReadings(menu, mw, config, notifier, updaters):
+def buildHookReformatReadings(menu, mw, config, notifier, mediamanager, updaters):
     title = 'Reformat readings'
     tip = 'Update all the readings in your deck with colorisation and tones according to your preferences.'
     field = "reading"
     updatehow = "updatefactalways"
     notification = "All readings have been successfully reformatted."
-    function = lambda: runBulkFill(mw, config, notifier, updaters, field, updatehow, notification)
+    function = lambda: runBulkFill(mw, config, notifier, mediamanager, updaters, field, updatehow, notification)
     createBulkFillAction(menu, mw, title, tip, function)
 
 # Create action with details and add to menu
@@ -236,7 +280,10 @@ def openPreferences(mw, config, notifier, mediamanager):
         config.settings = controller.model.settings
         saveconfig()
 
-def runBulkFill(mw, config, notifier, updaters, field, updatehow, notification):
+# Where each kind of bulk fill got up to in each deck, saved next to the configuration
+bulkfillwatermarks = pinyin.utils.Thunk(lambda: pinyin.bulkfill.Watermarks(os.path.join(os.path.dirname(pinyin.bulkfill.__file__), "bulkfill.p")))
+
+def runBulkFill(mw, config, notifier, mediamanager, updaters, field, updatehow, notification):
     if mw.web.key == "deckBrowser":
         return showInfo(u"No deck selected 同志!")
 
@@ -247,24 +294,51 @@ def runBulkFill(mw, config, notifier, updaters, field, updatehow, notification):
         queryStr += " or note:*" + tag + "* "
     notes = Finder(mw.col).findNotes(queryStr)
 
-    for noteId in notes:
-        note = mw.col.getNote(noteId)
-        # Need a fact proxy because the updater works on dictionary-like objects
-        factproxy = pinyin.factproxy.FactProxy(config.candidateFieldNamesByKey, note)
-        if field not in factproxy:
-            continue
-        
-        getattr(updaters[field], updatehow)(factproxy, factproxy[field])
-        
-        # NB: very important to mark the fact as modified (see #105) because otherwise
-        # the HTML etc won't be regenerated by Anki, so users may not e.g. get working
-        # sounds that have just been filled in by the updater.
-        note.flush()
+    # Keep the UI alive while the updaters work on another thread. Anything they need to do to the
+    # collection, or to show the user, is handed back to this thread to do
+    progressdialog = QProgressDialog(u"Updating %d notes..." % len(notes), u"Cancel", 0, len(notes), mw)
+    progressdialog.setWindowModality(Qt.WindowModal)
+    progressdialog.show()
     
-    # For good measure, mark the deck as modified as well (see #105)
-    mw.col.setMod()
+    def progress(done, total):
+        # NB: an incremental fill may have fewer notes to get through than we first thought
+        progressdialog.setMaximum(total)
+        progressdialog.setValue(done)
+        return not(progressdialog.wasCanceled())
+    
+    runner = pinyin.bulkfill.BackgroundRunner(idle=mw.app.processEvents)
+    notifier.marshal = mediamanager.marshal = runner.callonwaitingthread
+    try:
+        timings = config.bulkfilltimings and pinyin.profiling.NoteTimings() or None
+        bulkfill = pinyin.bulkfill.BulkFill(config.candidateFieldNamesByKey, updaters[field], field, updatehow, workers=config.bulkfillworkers, timings=timings)
+        if config.incrementalbulkfill:
+            # Ask the database which notes have changed, rather than loading every note to find out
+            modifiedsince = lambda noteids, since: mw.col.db.all("select id, mod from notes where mod >= ? and id in " + ids2str(noteids), since)
+            # NB: the notes need filling again if the dictionaries the updater uses have been updated, as well as if the settings changed.
+            # They do after a sync too, since the notes it brought down keep the (possibly older) modification time from the other device
+            dataversion = getattr(updaters[field], "dataversion", None)
+            fingerprint = (config.fingerprint(), dataversion is not None and dataversion() or None, mw.col.ls)
+            incremental = pinyin.bulkfill.IncrementalBulkFill(bulkfill, bulkfillwatermarks(), (mw.col.path, mw.col.decks.selected()), fingerprint)
+            result = incremental.run(mw.col, notes, modifiedsince, progress=progress, runinbackground=runner)
+        else:
+            result = bulkfill.run(mw.col, notes, progress=progress, runinbackground=runner)
+    finally:
+        notifier.marshal = mediamanager.marshal = None
+        progressdialog.close()
+    
+    if timings is not None:
+        timings.write(pinyin.utils.toolkitdir("Pinyin Toolkit timings.txt"))
+    
+    if getattr(updaters[field], "cache", None) is not None:
+        updaters[field].cache.flush()
+        log.info(updaters[field].cache.report())
+    
+    # For good measure, mark the deck as modified as well (see #105), if we did actually modify it
+    if result.changed != 0:
+        mw.col.setMod()
 
     # DEBUG consider future feature to add missing measure words cards after doing so (not now)
-    notifier.info(notification)
-
-
+    if result.cancelled:
+        notifier.info(u"Stopped after looking at %d of %d notes: %d of them changed." % (result.scanned, result.total, result.changed))
+    else:
+        notifier.info(notification + u" %d notes changed, %d were already up to date." % (result.changed, result.unchanged))
@@ -13,6 +13,7 @@ from pinyin.db import *
 import pinyin.db.builder
 import pinyin.forms.builddb
 import pinyin.forms.builddbcontroller
+import pinyin.resultcache
 import pinyin.updater
 
 import hooks
@@ -57,9 +58,14 @@ class PinyinToolkit(object):
             log.error("Database construction failed: disabling the Toolkit")
             return
 
+        # Remember what we generate from expressions between sessions, next to the configuration
+        resultcache = None
+        if getconfig().resultcachesize > 0:
+            resultcache = pinyin.resultcache.ResultCache(os.path.join(os.path.dirname(pinyin.resultcache.__file__), "resultcache.db"), getconfig().resultcachesize)
+        
         # Build the updaters
         updaters = {
-            'expression' : pinyin.updater.FieldUpdaterFromExpression(thenotifier, themediamanager),
+            'expression' : pinyin.updater.FieldUpdaterFromExpression(thenotifier, themediamanager, cache=resultcache),
             'reading'    : pinyin.updater.FieldUpdaterFromReading(),
             'meaning'    : pinyin.updater.FieldUpdaterFromMeaning(),
             'audio'      : pinyin.updater.FieldUpdaterFromAudio(thenotifier, themediamanager)
@@ -7,27 +7,28 @@ import pinyin.utils
 class AnkiMediaManager(object):
     def __init__(self, mw):
         self.mw = mw
+        self.registry = pinyin.media.MediaPackRegistry(os.path.join(os.path.dirname(pinyin.media.__file__), "mediapacks.p"))
+        self.importcache = pinyin.media.MediaImportCache()
+        
+        # Set while the updaters run on another thread: the collection must only be touched from the main one
+        self.marshal = None
+    
+    def onmainthread(self, function):
+        if self.marshal is None:
+            return function()
+        else:
+            return self.marshal(function)
     
     def mediadir(self):
         return self.mw.col.media.dir()
 
     def discovermediapacks(self):
-        packs = []
-        themediadir = self.mediadir()
-        for packname in os.listdir(themediadir):
-            # Skip the download cache directory
-            if packname.lower() == "downloads":
-                continue
-            
-            # Only try and process directories as packs:
-            packpath = os.path.join(themediadir, packname)
-            if os.path.isdir(packpath):
-                log.info("Considering %s as a media pack", packname)
-                packs.append(pinyin.media.MediaPack.frompath(packpath))
-            else:
-                log.info("Ignoring the file %s in the media directory", packname)
-        
-        return packs
+        return self.registry.discovermediapacks(self.mediadir())
     
     def importtocurrentdeck(self, file):
-        return self.mw.col.media.addFile(file)
+        # Anki would copy and hash the file every time, even though the same few hundred sounds come up over and over
+        def importfile():
+            mediadir = self.mediadir()
+            return self.registry.addingfiles(mediadir, lambda: self.importcache.importfile(mediadir, file, self.mw.col.media.addFile))
+        
+        return self.onmainthread(importfile)
@@ -14,9 +14,18 @@ class AnkiNotifier(object):
     def __init__(self):
         # A list of those things we have already shown, if we're suppressing duplicate messages
         self.alreadyshown = []
+        
+        # Set while the updaters run on another thread, to get the messages shown from the main one
+        self.marshal = None
+    
+    def onmainthread(self, function):
+        if self.marshal is None:
+            return function()
+        else:
+            return self.marshal(function)
     
     def info(self, what):
-        showInfo(what)
+        self.onmainthread(lambda: showInfo(what))
     
     def infoOnce(self, what):
         if not(what in self.alreadyshown):
@@ -27,4 +36,5 @@ class AnkiNotifier(object):
         if exception_info is None:
             exception_info = sys.exc_info()
         
-        showWarning(text + u"\r\nThe exception was:\r\n" + "".join(traceback.format_exception(*exception_info)))
+        message = text + u"\r\nThe exception was:\r\n" + "".join(traceback.format_exception(*exception_info))
+        self.onmainthread(lambda: showWarning(message))
@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import Queue
+import copy
+import cPickle
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+
+import factproxy
+import profiling
+import utils
+from logger import log
+
+
+"""
+A fact that remembers which fields were written to, so the same writes can be
+made to other facts.
+"""
+class RecordingFact(dict):
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.written = {}
+    
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.written[key] = value
+
+"""
+Summary of what a bulk fill did.
+"""
+class BulkFillResult(object):
+    phases = ["load", "compute", "write", "save"]
+    
+    def __init__(self, total):
+        self.total = total
+        self.scanned = 0
+        self.changed = 0
+        self.skipped = 0
+        self.computed = 0
+        self.batches = 0
+        self.cancelled = False
+        
+        # The latest modification time of any note we went through, once we were done with it,
+        # and the IDs of the notes that were modified at exactly that time
+        self.watermark = None
+        self.atwatermark = set()
+        
+        # Seconds spent in each phase of the fill
+        self.timings = dict([(phase, 0.0) for phase in self.phases])
+    
+    unchanged = property(lambda self: self.scanned - self.changed)
+    
+    def __repr__(self):
+        return "BulkFillResult(total=%d, scanned=%d, changed=%d, skipped=%d, computed=%d, batches=%d, cancelled=%s)" % \
+                 (self.total, self.scanned, self.changed, self.skipped, self.computed, self.batches, self.cancelled)
+    
+    def summarize(self):
+        return "Scanned %d notes: %d changed, %d unchanged, %d skipped" % (self.scanned, self.changed, self.unchanged, self.skipped) + \
+               "".join(["; %s %.2fs" % (phase, self.timings[phase]) for phase in self.phases])
+    
+    def sawnote(self, noteid, mod):
+        if mod > self.watermark:
+            self.watermark, self.atwatermark = mod, set([noteid])
+        elif mod == self.watermark:
+            self.atwatermark.add(noteid)
+    
+    def timed(self, phase, action):
+        start = time.time()
+        try:
+            return action()
+        finally:
+            self.timings[phase] += time.time() - start
+
+"""
+Runs an updater over many notes at once. Notes are loaded and written back in batches,
+with a single save of the collection for each batch that changed anything, and notes that would get exactly the
+same update are grouped together so the updater only has to run once for all of them.
+
+The collection is anything that looks enough like an Anki one: it needs getNote and save.
+Only the updater runs through runinbackground, which is given a function to call and should
+return its result. That lets the UI keep responding while the slow part happens, without
+the collection ever being touched from another thread.
+
+With more than one worker, the updater runs in that many processes, which share whatever the
+dictionaries had already loaded. Anything the updater tells the user, or asks to be imported into
+the deck, is passed back and done by this process. Workers are started by forking, so on systems
+that can't do that we just run the updater here.
+
+Given NoteTimings, the fill records how long each note spent in each stage of the work. NB: only
+the stages run by this process are recorded, so with several workers that is just the media
+imports and flushes.
+"""
+class BulkFill(object):
+    def __init__(self, candidateFieldNamesByKey, updater, field, updatehow="updatefact", batchsize=500, workers=1, timings=None):
+        self.candidateFieldNamesByKey = candidateFieldNamesByKey
+        self.updater = updater
+        self.field = field
+        self.updatehow = updatehow
+        self.batchsize = batchsize
+        self.workers = workers
+        self.timings = timings
+    
+    """
+    Fill the notes with the given IDs. The progress callback, if any, is told how many notes
+    we have been through and the total after each batch, and can return False to cancel the
+    rest of the fill. Batches that have already been written are kept.
+    """
+    def run(self, collection, noteids, progress=None, runinbackground=None):
+        if runinbackground is None:
+            runinbackground = lambda function: function()
+        
+        result = BulkFillResult(len(noteids))
+        
+        # Updates for each kind of note we have seen so far, so later batches can reuse them
+        updates = {}
+        
+        pool = self.startworkers()
+        try:
+            profiling.recording(self.timings, lambda: self.runbatches(collection, noteids, progress, runinbackground, result, updates, pool))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        
+        log.info("Finished bulk fill: %s", result.summarize())
+        return result
+    
+    def runbatches(self, collection, noteids, progress, runinbackground, result, updates, pool):
+        for start in range(0, len(noteids), self.batchsize):
+            # Load the whole batch, working out what kind of update each note needs as we go
+            pending = result.timed("load", lambda: self.load(collection, noteids[start:start + self.batchsize], result))
+            
+            # Run the updater once for every kind of note we haven't seen before, on a copy of
+            # the note so that we just find out what it would write
+            representatives, seen = [], set()
+            for noteid, note, proxy, signature in pending:
+                if signature not in updates and signature not in seen:
+                    representatives.append((signature, RecordingFact([(key, proxy[key]) for key in proxy.fieldnames]), self.describe(noteid, proxy)))
+                    seen.add(signature)
+            
+            if len(representatives) != 0:
+                updates.update(result.timed("compute", lambda: profiling.elsewhere(runinbackground, lambda: self.computeupdates(representatives, pool))))
+                result.computed += len(representatives)
+            
+            # Write the results back in one go, leaving alone any note where nothing actually changed
+            changed = result.timed("write", lambda: self.write(pending, updates))
+            if changed != 0:
+                result.timed("save", collection.save)
+            
+            result.scanned += len(pending)
+            result.changed += changed
+            for noteid, note, proxy, signature in pending:
+                result.sawnote(noteid, note.mod)
+            result.batches += 1
+            
+            if progress is not None and progress(min(start + self.batchsize, len(noteids)), len(noteids)) is False:
+                log.info("Bulk fill cancelled after %d of %d notes", start + self.batchsize, len(noteids))
+                result.cancelled = True
+                break
+    
+    def load(self, collection, noteids, result):
+        pending = []
+        for noteid in noteids:
+            note = collection.getNote(noteid)
+            proxy = factproxy.FactProxy(self.candidateFieldNamesByKey, note)
+            if self.field not in proxy:
+                result.skipped += 1
+                result.sawnote(noteid, note.mod)
+                continue
+            
+            pending.append((noteid, note, proxy, self.signature(noteid, proxy)))
+        
+        return pending
+    
+    def write(self, pending, updates):
+        changed = 0
+        for noteid, note, proxy, signature in pending:
+            for key, value in updates[signature].items():
+                proxy[key] = value
+            
+            # NB: very important to mark the fact as modified (see #105) because otherwise
+            # the HTML etc won't be regenerated by Anki, so users may not e.g. get working
+            # sounds that have just been filled in by the updater. But flushing a note that
+            # hasn't changed just makes Anki regenerate its cards and sync it for nothing.
+            if proxy.dirty:
+                profiling.startnote(self.describe(noteid, proxy))
+                profiling.timed("flush", note.flush)
+                changed += 1
+        
+        return changed
+    
+    """
+    Notes get the same update if the field we are updating from has the same contents, and the
+    same fields are present and empty. The updater doesn't look at anything else, except when
+    the field is blank: then it makes judgements about the rest of the contents, so such notes
+    are left in a kind of their own.
+    
+    Fields the updater says it may rewrite even when they are filled (its rewrittenkeys) must
+    also have the same contents: we only record the writes that changed the representative, so
+    another note with something else in such a field wouldn't get it rewritten otherwise.
+    """
+    def signature(self, noteid, proxy):
+        value = proxy[self.field]
+        if value.strip() == u"":
+            return (noteid,)
+        
+        rewrittenkeys = getattr(self.updater, "rewrittenkeys", [])
+        return (value, tuple(sorted([(key, proxy[key].strip() == u"", key in rewrittenkeys and proxy[key] or None) for key in proxy.fieldnames])))
+    
+    """
+    How the note is referred to in the timings, if we are recording them.
+    """
+    def describe(self, noteid, proxy):
+        if self.timings is None:
+            return None
+        
+        return u"note %s (%s)" % (noteid, proxy[self.field])
+    
+    def computeupdates(self, representatives, pool=None):
+        if pool is None:
+            updates = {}
+            for signature, fact, description in representatives:
+                profiling.startnote(description)
+                updates[signature] = computeupdate(self.updater, self.updatehow, self.field, signature, fact)
+            
+            return updates
+        
+        # Hand out the work in a few chunks per worker: enough to keep them all busy to the end
+        jobs = [(signature, dict(fact)) for signature, fact, description in representatives]
+        try:
+            results = pool.map(computeinworker, jobs, max(1, len(jobs) // (self.workers * 4)))
+        except Exception, e:
+            # The workers are forked copies of whatever process we are in (e.g. Anki, with Qt and
+            # all), and that doesn't always go well. We can still do the work ourselves
+            log.exception("Error from the bulk fill workers, so filling these notes in this process")
+            return self.computeupdates(representatives)
+        
+        # Now do what the workers couldn't, in the order that they would have done it
+        updates = {}
+        for (signature, fact, description), (written, notifications) in zip(representatives, results):
+            profiling.startnote(description)
+            for method, args in notifications:
+                getattr(self.updater.notifier, method)(*args)
+            
+            updates[signature] = dict([(key, self.importmedia(value)) for key, value in written.items()])
+        
+        return updates
+    
+    def startworkers(self):
+        if self.workers <= 1:
+            return None
+        elif not(hasattr(os, "fork")):
+            log.info("Running the bulk fill in this process, as we can't fork worker processes here")
+            return None
+        
+        # The workers get their own copy of the updater, with stand-ins for the things that must stay here
+        import multiprocessing
+        log.info("Starting %d bulk fill workers", self.workers)
+        try:
+            return multiprocessing.Pool(self.workers, startworker, (deferredcopy(self.updater), self.updatehow, self.field))
+        except Exception, e:
+            log.exception("Couldn't start the bulk fill workers, so running the bulk fill in this process")
+            return None
+    
+    def importmedia(self, value):
+        return importmedia(getattr(self.updater, "mediamanager", None), value)
+
+"""
+Runs the updater for one kind of note, returning what it wrote. Some updaters make random
+choices (e.g. between equally good media packs), so we seed them from the kind of note to
+get the same result whichever process does the work, and put back the old random state
+after so we don't disturb anyone else.
+"""
+def computeupdate(updater, updatehow, field, signature, fact):
+    state = random.getstate()
+    random.seed(long(utils.md5(repr(signature)), 16))
+    try:
+        getattr(updater, updatehow)(fact, fact[field])
+    finally:
+        random.setstate(state)
+    
+    return fact.written
+
+# What a bulk fill worker process is working with: set up when the process starts
+workerstate = {}
+
+def startworker(updater, updatehow, field):
+    # NB: a SQLite connection must not be used by both sides of a fork, so we need our own
+    import db
+    db.reconnect()
+    
+    workerstate.update({ "updater" : updater, "updatehow" : updatehow, "field" : field })
+
+def computeinworker(job):
+    signature, fields = job
+    updater = workerstate["updater"]
+    
+    notifier = getattr(updater, "notifier", None)
+    if notifier is not None:
+        notifier.calls = []
+    
+    written = computeupdate(updater, workerstate["updatehow"], workerstate["field"], signature, RecordingFact(fields))
+    return written, notifier is not None and notifier.calls or []
+
+"""
+A notifier for worker processes. It keeps what it is told, so the process that started
+them can pass it on to the real notifier.
+"""
+class DeferredNotifier(object):
+    def __init__(self):
+        self.calls = []
+    
+    def info(self, what):
+        self.calls.append(("info", (what,)))
+    
+    def infoOnce(self, what):
+        self.calls.append(("infoOnce", (what,)))
+    
+    def exception(self, text, exception_info=None):
+        # NB: tracebacks can't be sent between processes, so we send the text they would be shown as
+        if exception_info is None:
+            exception_info = sys.exc_info()
+        
+        self.calls.append(("info", (text + u"\r\nThe exception was:\r\n" + "".join(traceback.format_exception(*exception_info)),)))
+
+"""
+A media manager for worker processes. Media can only be imported into the deck by the process
+that started them, so instead we put a marker into the field saying which file to import, which
+that process replaces with the name the file was imported as.
+"""
+class DeferredMediaManager(object):
+    importregex = re.compile(u"\x00([^\x00]*)\x00")
+    
+    def __init__(self, themediadir, mediapacks):
+        self.themediadir = themediadir
+        self.mediapacks = mediapacks
+    
+    def mediadir(self):
+        return self.themediadir
+    
+    def discovermediapacks(self):
+        return self.mediapacks
+    
+    def importtocurrentdeck(self, filename):
+        return u"\x00%s\x00" % filename
+
+"""
+A copy of the updater that can run away from the thread or process that made it: anything it
+tells the user is kept for later, and media it imports is marked in the fields instead.
+"""
+def deferredcopy(updater):
+    updater = copy.copy(updater)
+    if hasattr(updater, "notifier"):
+        updater.notifier = DeferredNotifier()
+    if hasattr(updater, "mediamanager"):
+        updater.mediamanager = DeferredMediaManager(updater.mediamanager.mediadir(), updater.mediamanager.discovermediapacks())
+    
+    return updater
+
+"""
+Imports the media marked in a field value written by a deferred copy of an updater, returning
+the value with the markers replaced by the names the media was imported as.
+"""
+def importmedia(mediamanager, value):
+    if not(isinstance(value, basestring)):
+        return value
+    
+    return DeferredMediaManager.importregex.sub(lambda match: profiling.timed("media import", lambda: mediamanager.importtocurrentdeck(match.group(1))), value)
+
+"""
+Remembers, for each collection and each kind of bulk fill, the latest modification time of the
+notes the last complete fill went through, and a fingerprint of the settings it was done with.
+The next fill then only needs to look at notes modified since, unless the settings changed.
+It is saved to a file as we go, but is only a cache: if that is lost we just fill everything.
+
+Anki only records modification times to the second, so we also remember which notes we saw
+modified in the very last second. Any other note modified in that second is filled next time.
+
+Notes can also come to be filled without being modified (e.g. when their cards are moved into
+the deck being filled), so we remember which notes the fill went through as well.
+"""
+class Watermarks(object):
+    version = 2
+    
+    def __init__(self, path=None):
+        self.path = path
+        
+        # (collection, operation) -> (fingerprint, modification time, IDs of notes seen at that time, IDs of all notes filled or None)
+        self.watermarks = {}
+        
+        self.load()
+    
+    """
+    The modification time from which notes need filling again and the IDs of notes modified at
+    that time that don't, or None if all notes do.
+    """
+    def since(self, collection, operation, fingerprint):
+        known = self.watermarks.get((collection, operation))
+        if known is None or known[0] != fingerprint:
+            return None
+        
+        return known[1], known[2]
+    
+    """
+    The IDs of the notes the last fill went through, or None if we don't know them.
+    """
+    def filled(self, collection, operation, fingerprint):
+        known = self.watermarks.get((collection, operation))
+        if known is None or known[0] != fingerprint:
+            return None
+        
+        return known[3]
+    
+    def update(self, collection, operation, fingerprint, watermark, atwatermark=set(), filled=None):
+        if filled is not None:
+            filled = set(filled)
+        
+        self.watermarks[(collection, operation)] = (fingerprint, watermark, set(atwatermark), filled)
+        self.save()
+    
+    def load(self):
+        if self.path is None or not(os.path.exists(self.path)):
+            return
+        
+        try:
+            watermarksfile = open(self.path, "rb")
+            try:
+                saved = cPickle.load(watermarksfile)
+            finally:
+                watermarksfile.close()
+            
+            if saved["version"] != self.version:
+                log.info("Ignoring the bulk fill watermarks at %s because they are from another version", self.path)
+                return
+            
+            self.watermarks = saved["watermarks"]
+        except Exception, e:
+            log.exception("Error while loading the bulk fill watermarks from %s", self.path)
+            self.watermarks = {}
+    
+    def save(self):
+        if self.path is None:
+            return
+        
+        try:
+            watermarksfile = open(self.path, "wb")
+            try:
+                cPickle.dump({ "version" : self.version, "watermarks" : self.watermarks }, watermarksfile, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                watermarksfile.close()
+        except IOError, e:
+            log.exception("Error while saving the bulk fill watermarks to %s", self.path)
+
+"""
+A bulk fill that only goes through the notes modified since the last time it was run over the
+same collection with the same settings, and those it didn't go through that time. Finding the
+modified notes is left to the modifiedsince function, which is given the note IDs and a
+modification time, and returns the ID and modification time of those modified then or later:
+with Anki that is best done with a query, so that we don't have to load every note just to find
+out that it hasn't changed.
+
+The fingerprint should cover everything the fill depends on besides the notes themselves, such
+as the settings and the version of the dictionaries. It should also change whenever notes can
+have changed without their modification time passing the watermark: a sync brings down notes
+with the modification time they were given on another device, which may well be older.
+"""
+class IncrementalBulkFill(object):
+    def __init__(self, bulkfill, watermarks, collection, fingerprint):
+        self.bulkfill = bulkfill
+        self.watermarks = watermarks
+        self.collection = collection
+        self.fingerprint = fingerprint
+    
+    operation = property(lambda self: (self.bulkfill.field, self.bulkfill.updatehow))
+    
+    def run(self, collection, noteids, modifiedsince, **kwargs):
+        allnoteids = noteids
+        since = self.watermarks.since(self.collection, self.operation, self.fingerprint)
+        if since is None:
+            log.info("Filling all %d notes, since we have no record of filling them with these settings", len(noteids))
+        else:
+            (watermark, atwatermark), filled = since, self.watermarks.filled(self.collection, self.operation, self.fingerprint)
+            wanted = set([noteid for noteid, mod in modifiedsince(noteids, watermark) if mod != watermark or noteid not in atwatermark])
+            if filled is not None:
+                wanted.update([noteid for noteid in noteids if noteid not in filled])
+            
+            noteids = [noteid for noteid in noteids if noteid in wanted]
+            log.info("Filling the %d of %d notes modified since %s or not filled last time", len(noteids), len(allnoteids), watermark)
+        
+        result = self.bulkfill.run(collection, noteids, **kwargs)
+        
+        # If we were cancelled, we can't say that everything up to the watermark has been filled
+        if not(result.cancelled):
+            watermark, atwatermark = result.watermark, result.atwatermark
+            if since is not None and watermark is None:
+                # There was nothing new, so what we knew before still holds
+                watermark, atwatermark = since
+            elif since is not None and watermark == since[0]:
+                atwatermark = atwatermark | since[1]
+            
+            if watermark is not None:
+                self.watermarks.update(self.collection, self.operation, self.fingerprint, watermark, atwatermark, allnoteids)
+        
+        return result
+
+"""
+Runs a function on a worker thread, while the thread that asked waits for the result. While
+waiting, it calls the idle function (e.g. to process UI events) and runs anything the worker
+hands back through callonwaitingthread, for those things that must only be done on that thread.
+"""
+class BackgroundRunner(object):
+    def __init__(self, idle=None, interval=0.01):
+        self.idle = idle
+        self.interval = interval
+        
+        self.waitingthread = None
+        self.calls = Queue.Queue()
+    
+    def __call__(self, function):
+        outcome = {}
+        def work():
+            try:
+                outcome["result"] = function()
+            except Exception, e:
+                outcome["exception"] = sys.exc_info()
+        
+        worker = threading.Thread(target=work)
+        self.waitingthread = threading.currentThread()
+        try:
+            worker.start()
+            while worker.isAlive() or not(self.calls.empty()):
+                self.runcalls()
+                if self.idle is not None:
+                    self.idle()
+                worker.join(self.interval)
+        finally:
+            self.waitingthread = None
+        
+        if "exception" in outcome:
+            exception = outcome["exception"]
+            raise exception[0], exception[1], exception[2]
+        
+        return outcome["result"]
+    
+    def runcalls(self):
+        while True:
+            try:
+                function, outcome, done = self.calls.get_nowait()
+            except Queue.Empty:
+                return
+            
+            try:
+                outcome["result"] = function()
+            except Exception, e:
+                outcome["exception"] = sys.exc_info()
+            done.set()
+    
+    def callonwaitingthread(self, function):
+        # Nobody is waiting, or we are the one who is, so there is no need to hand it over
+        if self.waitingthread is None or self.waitingthread is threading.currentThread():
+            return function()
+        
+        outcome, done = {}, threading.Event()
+        self.calls.put((function, outcome, done))
+        done.wait()
+        
+        if "exception" in outcome:
+            exception = outcome["exception"]
+            raise exception[0], exception[1], exception[2]
+        
+        return outcome["result"]
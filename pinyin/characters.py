@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import re
+import sys
+import unicodedata
+
+
+"""
+Codepoint ranges (inclusive) that we consider to be hanzi: the CJK Unified Ideographs
+and all their extensions, plus the compatibility ideographs.
+"""
+hanziranges = [
+    (0x3400, 0x4DBF),   # Extension A
+    (0x4E00, 0x9FFF),   # CJK Unified Ideographs
+    (0xF900, 0xFAFF),   # CJK Compatibility Ideographs
+    (0x20000, 0x2A6DF), # Extension B
+    (0x2A700, 0x2B73F), # Extension C
+    (0x2B740, 0x2B81F), # Extension D
+    (0x2B820, 0x2CEAF), # Extension E
+    (0x2CEB0, 0x2EBEF), # Extension F
+    (0x2F800, 0x2FA1F), # CJK Compatibility Ideographs Supplement
+    (0x30000, 0x3134F)  # Extension G
+  ]
+
+"""
+The blocks for which we have tabulated the punctuation characters. Anything outside
+these is rare enough in our fields that we just ask unicodedata about it instead.
+"""
+punctuationblocks = [
+    (0x0000, 0x00FF),   # Basic Latin and Latin-1 Supplement
+    (0x2000, 0x206F),   # General Punctuation
+    (0x3000, 0x303F),   # CJK Symbols and Punctuation
+    (0xFE10, 0xFE1F),   # Vertical Forms
+    (0xFE30, 0xFE6F),   # CJK Compatibility Forms and Small Form Variants
+    (0xFF00, 0xFFEF)    # Halfwidth and Fullwidth Forms
+  ]
+
+"""
+Codepoint ranges (inclusive) within the tabulated blocks whose General_Category is one of
+the punctuation categories (Pc, Pd, Ps, Pe, Pi, Pf, Po), as given by unicodedata.
+"""
+punctuationranges = [
+    # Basic Latin and Latin-1 Supplement: ! " # % & ' ( ) * , - . / : ; ? @ [ \ ] _ { } ¡ « · » ¿
+    (0x0021, 0x0023), (0x0025, 0x002A), (0x002C, 0x002F), (0x003A, 0x003B), (0x003F, 0x0040),
+    (0x005B, 0x005D), (0x005F, 0x005F), (0x007B, 0x007B), (0x007D, 0x007D), (0x00A1, 0x00A1),
+    (0x00AB, 0x00AB), (0x00B7, 0x00B7), (0x00BB, 0x00BB), (0x00BF, 0x00BF),
+    # General Punctuation: dashes, quotes, ellipses and friends
+    (0x2010, 0x2027), (0x2030, 0x2043), (0x2045, 0x2051), (0x2053, 0x205E),
+    # CJK Symbols and Punctuation: 、。〃〈〉《》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〽
+    (0x3001, 0x3003), (0x3008, 0x3011), (0x3014, 0x301F), (0x3030, 0x3030), (0x303D, 0x303D),
+    # Vertical Forms
+    (0xFE10, 0xFE19),
+    # CJK Compatibility Forms and Small Form Variants
+    (0xFE30, 0xFE52), (0xFE54, 0xFE61), (0xFE63, 0xFE63), (0xFE68, 0xFE68), (0xFE6A, 0xFE6B),
+    # Halfwidth and Fullwidth Forms: ！＂＃％＆＇（）＊，－．／：；？＠［＼］＿｛｝｟｠｡｢｣､･
+    (0xFF01, 0xFF03), (0xFF05, 0xFF0A), (0xFF0C, 0xFF0F), (0xFF1A, 0xFF1B), (0xFF1F, 0xFF20),
+    (0xFF3B, 0xFF3D), (0xFF3F, 0xFF3F), (0xFF5B, 0xFF5B), (0xFF5D, 0xFF5D), (0xFF5F, 0xFF65)
+  ]
+
+"""
+Reports whether the codepoint falls into one of a sorted list of inclusive ranges.
+"""
+def inranges(ranges, starts, codepoint):
+    i = bisect.bisect_right(starts, codepoint) - 1
+    return i >= 0 and codepoint <= ranges[i][1]
+
+def rangestarts(ranges):
+    return [start for start, _end in ranges]
+
+hanzistarts = rangestarts(hanziranges)
+punctuationblockstarts = rangestarts(punctuationblocks)
+
+# There are only a few hundred tabulated punctuation characters, so we can afford to just list them
+tabulatedpunctuation = frozenset([unichr(codepoint) for start, end in punctuationranges for codepoint in range(start, end + 1)])
+
+"""
+Turns a list of ranges into the body of a regex character class. On narrow builds of Python
+the characters outside the Basic Multilingual Plane are stored as surrogate pairs, and each
+half of a pair is not a hanzi in its own right, so we can only match ranges within the BMP.
+"""
+def characterclass(ranges):
+    return u"".join([re.escape(unichr(start)) + u"-" + re.escape(unichr(end)) for start, end in ranges if end <= sys.maxunicode])
+
+hanziregex = re.compile(u"[%s]" % characterclass(hanziranges), re.UNICODE)
+allhanziregex = re.compile(u"[%s]*\\Z" % characterclass(hanziranges), re.UNICODE)
+alltabulatedpunctuationregex = re.compile(u"[%s]*\\Z" % characterclass(punctuationranges), re.UNICODE)
+
+
+"""
+Reports whether the given character is a hanzi. Byte strings are never hanzi.
+"""
+def ishanzi(char):
+    if type(char) == str:
+        return False
+    
+    # Check the common cases before doing a search of the range table
+    codepoint = ord(char)
+    if codepoint < 0x3400:
+        return False
+    elif codepoint <= 0x9FFF:
+        return codepoint >= 0x4E00 or codepoint <= 0x4DBF
+    else:
+        return inranges(hanziranges, hanzistarts, codepoint)
+
+"""
+Reports whether the given character is punctuation, in the sense of the Unicode General_Category.
+"""
+def ispunctuationcharacter(char):
+    if type(char) == str:
+        char = unicode(char)
+    
+    if char in tabulatedpunctuation:
+        return True
+    elif inranges(punctuationblocks, punctuationblockstarts, ord(char)):
+        return False
+    else:
+        # For General_Category list see http://unicode.org/Public/UNIDATA/UCD.html
+        return 'P' in unicodedata.category(char)
+
+"""
+Utility function that reports whether a string consists only of punctuation characters
+"""
+def ispunctuation(text):
+    # Nearly all punctuation we see comes from the tabulated blocks, so try them all in one go
+    text = unicode(text)
+    if alltabulatedpunctuationregex.match(text):
+        return True
+    
+    # NB: can't use "all" because it's not in Python 2.4 and below, which Anki uses
+    for char in text:
+        if not(ispunctuationcharacter(char)):
+            return False
+    
+    return True
+
+"""
+Reports whether a string consists only of hanzi.
+"""
+def isallhanzi(text):
+    if type(text) == str:
+        return len(text) == 0
+    
+    return allhanziregex.match(text) is not None
+
+"""
+Returns just the hanzi from the string, in the order in which they occur.
+"""
+def filterhanzi(text):
+    if type(text) == str:
+        return u""
+    
+    return u"".join(hanziregex.findall(text))
+
+"""
+Counts the hanzi in the string.
+"""
+def counthanzi(text):
+    return len(filterhanzi(text))
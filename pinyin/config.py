@@ -28,9 +28,13 @@ defaultsettings = {
 
     "colorizedpinyingeneration"    : True, # Should we try and write readings and measure words that include colorized pinyin?
     "colorizedcharactergeneration" : True, # Should we try and fill out a field called Color with a colored version of the character?
+    "compactcoloredhtml"           : False, # Should runs of syllables or characters with the same color share a single <span>?
+    "usetonecolorclasses"          : False, # Should tone colors be written as CSS classes (tone1 ... tone5, tone3s for sandhi) rather than inline styles?
+                                            # NB: the card templates then need CSS rules for those classes, or the colors won't show up
     
     "audiogeneration"              : True, # Should we try and fill out a field called Audio with text-to-speech commands?
     "mwaudiogeneration"            : True, # Should we try and fill out a field called MW Audio with measure word text-to-speech commands?
+    "concatenateaudio"             : False, # Should the MP3 sounds for a reading be joined into a single file, rather than played one after another?
     "readinggeneration"            : True, # Should we try and fill out a field called Reading with pinyin?
     
     "meaninggeneration"            : True, # Should we try and fill out a field called Meaning with the definition? 
@@ -52,6 +56,11 @@ defaultsettings = {
     "forcemeaningnumberstobeformatted" : True,  # Should we try and format numbers in the meaning as their fancy variant?
     "forcepinyininaudiotosoundtags"    : True,  # Should we try and replace pinyin in the audio field with the corresponding audio?
     
+    "incrementalbulkfill"              : True,  # Should filling the deck only look at notes changed since the last fill with the same settings?
+    "bulkfillworkers"                  : 1,     # How many processes should share the work of filling the deck? NB: more than one forks copies of Anki, so only works where Python can fork, and isn't always reliable
+    "resultcachesize"                  : 50000, # How many generated field values should we remember between sessions? 0 remembers nothing
+    "bulkfilltimings"                  : False, # Should filling the deck write a report of which notes and stages took the time, next to the log?
+    
     # Unimplemented flags (for dev purposes)
     #"posgeneration"                : True, # Should we try to generate the POS (part of Speech) from dictionaries?
     #"enablefeedback"               : True, # Should support for submitting entries to CEDICT, etc be turned on?
@@ -82,6 +91,9 @@ defaultsettings = {
     # Be aware that you may be able to find higher quality audio files from other sources.
     "mandarinsoundsurl" : "http://www.chinese-lessons.com/sounds/Mandarin_sounds.zip",
     
+    # The MD5 digest the downloaded sound pack must have, or None to accept whatever we are sent
+    "mandarinsoundsmd5" : None,
+    
     # The character to use for hanzi masking in meanings: ~ or [~] are obvious alternatives
     "hanzimaskingcharacter" : u"㊥",
 
@@ -234,6 +246,20 @@ def incorporatebykeydict(incorporations):
     return inner
 
 
+"""
+A representation of a settings value that doesn't depend on the order in which the dictionaries
+inside it happened to be built, so that equal settings are always represented the same way.
+"""
+def canonicalrepr(value):
+    if isinstance(value, dict):
+        return "{" + ", ".join([canonicalrepr(key) + ": " + canonicalrepr(value[key]) for key in sorted(value.keys())]) + "}"
+    elif isinstance(value, list):
+        return "[" + ", ".join([canonicalrepr(item) for item in value]) + "]"
+    elif isinstance(value, tuple):
+        return "(" + ", ".join([canonicalrepr(item) for item in value]) + ",)"
+    else:
+        return repr(value)
+
 """
 Routines to fetch and save the config to the current Anki Profile
 """
@@ -244,6 +270,9 @@ SETTINGS_FILE = os.path.join(os.path.dirname(__file__), "ptkconfig.p")
 sCONFIG = None
 
 def saveconfig():
+    # Make sure that the settings we are about to save are the ones we generate fields with from now on
+    sCONFIG.changed()
+    
     settingsFile = open(SETTINGS_FILE, "wb")
     cPickle.dump(sCONFIG.settings, settingsFile)
     settingsFile.flush()
@@ -266,13 +295,62 @@ def getconfig():
     return sCONFIG
 
 
+"""
+Formatting of the bits of HTML that depend on the settings. Used by both the Config and the snapshots
+of it, which only need to provide the settings and derived settings as attributes.
+"""
+class SettingsFormatting(object):
+    def meaningnumber(self, n):
+        if self.meaningnumberingstrings is None:
+            return ""
+        
+        if n <= len(self.meaningnumberingstrings):
+            number = self.meaningnumberingstrings[n - 1]
+        else:
+            # Ensure that we fall back on normal (n) numbers if there are more numbers than we have in the supplied list
+            number = '(' + str(n) + ')'
+
+        if self.colormeaningnumbers:
+            return '<span style="color:' + self.meaningnumberingcolor + '">' + number + '</span>'
+        else:
+            return number
+    
+    def numbermeanings(self, meanings, offset):
+        # Don't add meaning numbers if it is disabled or there is only one meaning
+        if len(meanings) > 1 and self.meaningnumberingstrings != None:
+            # Add numbers to all the meanings in the list
+            return self.meaningseperatorstring.join([self.meaningnumber(offset + n + 1) + " " + meaning for n, meaning in enumerate(meanings)])
+        else:
+            # Concatenate together all the meanings directly
+            return self.meaningseperatorstring.join(meanings)
+    
+    def formatmeanings(self, meanings):
+        if self.emphasisemainmeaning and len(meanings) > 1:
+            # Call out the first meaning specially
+            starttag, endtag = self.mainmeaningemphasistag.endswith("/") and ("<%s />" % self.mainmeaningemphasistag[:-1], "") \
+                                                                          or ("<%s>" % self.mainmeaningemphasistag, "</%s>" % self.mainmeaningemphasistag)
+            return meanings[0] + self.meaningseperatorstring + starttag + self.numbermeanings(meanings[1:], 1) + endtag
+        else:
+            # No header, just format all the meanings together
+            return self.numbermeanings(meanings, 0)
+    
+    def formathanzimaskingcharacter(self):
+        if self.colormeaningnumbers:
+            return '<span style="color:' + self.meaningnumberingcolor + '">' + self.hanzimaskingcharacter + '</span>'
+        else:
+            return self.hanzimaskingcharacter
+
+    def getmodeltagslist(self):
+        return self.modelTags.split(',')
+
+
 """
 Pinyin Toolkit configuration object: this will be pickled
 up and stored into Anki's configuration database.  To allow
 extension of this class in the future, I only pickle up the
 key/value pairs stored in the user data field.
 """
-class Config(object):
+class Config(SettingsFormatting):
     # NB: DO NOT store anything of importance into this class other than the settings dictionary.
     # Any such data won't be saved between sessions!
     
@@ -336,6 +414,10 @@ class Config(object):
             self.__dict__["settings"][name] = value
         else:
             object.__setattr__(self, name, value)
+        
+        # Any snapshot we have made no longer reflects the settings
+        if name == "settings" or name in self.__dict__.get("settings", {}):
+            self.changed()
     
     #
     # Derived settings
@@ -346,48 +428,28 @@ class Config(object):
     meaningnumberingstrings = property(lambda self: meaningnumberingstringss[self.meaningnumbering])
     meaningseperatorstring = property(lambda self: meaningseperatorstrings.get(self.meaningseperator) or self.custommeaningseperator)
     
-    def meaningnumber(self, n):
-        if self.meaningnumberingstrings is None:
-            return ""
-        
-        if n <= len(self.meaningnumberingstrings):
-            number = self.meaningnumberingstrings[n - 1]
-        else:
-            # Ensure that we fall back on normal (n) numbers if there are more numbers than we have in the supplied list
-            number = '(' + str(n) + ')'
-
-        if self.colormeaningnumbers:
-            return '<span style="color:' + self.meaningnumberingcolor + '">' + number + '</span>'
-        else:
-            return number
-    
-    def numbermeanings(self, meanings, offset):
-        # Don't add meaning numbers if it is disabled or there is only one meaning
-        if len(meanings) > 1 and self.meaningnumberingstrings != None:
-            # Add numbers to all the meanings in the list
-            return self.meaningseperatorstring.join([self.meaningnumber(offset + n + 1) + " " + meaning for n, meaning in enumerate(meanings)])
-        else:
-            # Concatenate together all the meanings directly
-            return self.meaningseperatorstring.join(meanings)
+    """
+    A digest of the settings that affect what we write into fields, that changes whenever any of them does.
+    """
+    def fingerprint(self):
+        return self.compiled().fingerprint()
     
-    def formatmeanings(self, meanings):
-        if self.emphasisemainmeaning and len(meanings) > 1:
-            # Call out the first meaning specially
-            starttag, endtag = self.mainmeaningemphasistag.endswith("/") and ("<%s />" % self.mainmeaningemphasistag[:-1], "") \
-                                                                          or ("<%s>" % self.mainmeaningemphasistag, "</%s>" % self.mainmeaningemphasistag)
-            return meanings[0] + self.meaningseperatorstring + starttag + self.numbermeanings(meanings[1:], 1) + endtag
-        else:
-            # No header, just format all the meanings together
-            return self.numbermeanings(meanings, 0)
+    """
+    A frozen snapshot of the settings as they are right now, for use while generating fields. It
+    is only built again once the settings have changed.
+    """
+    def compiled(self):
+        if self.__dict__.get("snapshot") is None:
+            self.__dict__["snapshot"] = CompiledConfig(self)
+        
+        return self.__dict__["snapshot"]
     
-    def formathanzimaskingcharacter(self):
-        if self.colormeaningnumbers:
-            return '<span style="color:' + self.meaningnumberingcolor + '">' + self.hanzimaskingcharacter + '</span>'
-        else:
-            return self.hanzimaskingcharacter
-
-    def getmodeltagslist(self):
-        return self.modelTags.split(',')
+    """
+    Lets us know that the settings have changed behind our back, e.g. because an item of one of
+    the lists in them was assigned to directly.
+    """
+    def changed(self):
+        self.__dict__["snapshot"] = None
     
     def getshouldusegoogletranslate(self):
         # Fail fast if the user has turned Google off:
@@ -407,3 +469,60 @@ class Config(object):
         return self.__googletranslateworking
 
     shouldusegoogletranslate = property(getshouldusegoogletranslate)
+
+
+"""
+The settings that don't change anything we write into fields, so that changing them shouldn't make
+us think that the fields we filled before are out of date.
+"""
+nonoutputsettings = ["mandarinsoundsurl", "mandarinsoundsmd5", "extraquickaccesscolors", "incrementalbulkfill", "bulkfillworkers", "resultcachesize", "bulkfilltimings"]
+
+# We pre-render the meaning numbers at least this far, which covers nearly every entry in the dictionary
+prerenderedmeaningnumbers = 20
+
+"""
+A frozen snapshot of a Config, made for the inner loops that generate fields. The settings and derived
+settings are plain attributes, the HTML for the meaning numbers and the Hanzi masking character is
+rendered in advance, and the fingerprint is only computed once.
+"""
+class CompiledConfig(SettingsFormatting):
+    def __init__(self, config):
+        settings = copy.deepcopy(config.settings)
+        
+        # NB: we can't go through our own __setattr__, as that would refuse
+        self.__dict__.update(settings)
+        self.__dict__.update({
+            "settings" : settings,
+            "source" : config,
+            "shouldtonify" : config.shouldtonify,
+            "needmeanings" : config.needmeanings,
+            "meaningnumberingstrings" : config.meaningnumberingstrings,
+            "meaningseperatorstring" : config.meaningseperatorstring
+          })
+        
+        self.__dict__.update({
+            "meaningnumbers" : [SettingsFormatting.meaningnumber(self, n) for n in range(1, max(len(self.meaningnumberingstrings or []), prerenderedmeaningnumbers) + 1)],
+            "hanzimaskingcharacterhtml" : SettingsFormatting.formathanzimaskingcharacter(self),
+            "outputfingerprint" : utils.md5(canonicalrepr(dict([(key, value) for key, value in settings.items() if key not in nonoutputsettings])))
+          })
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("The compiled configuration is a frozen snapshot, so can't set %s: change the Config it was made from instead" % name)
+    
+    def meaningnumber(self, n):
+        if 0 < n <= len(self.meaningnumbers):
+            return self.meaningnumbers[n - 1]
+        else:
+            return SettingsFormatting.meaningnumber(self, n)
+    
+    def formathanzimaskingcharacter(self):
+        return self.hanzimaskingcharacterhtml
+    
+    def fingerprint(self):
+        return self.outputfingerprint
+    
+    def compiled(self):
+        return self
+    
+    # Whether Google Translate is working isn't a setting, so ask the Config that knows about it
+    shouldusegoogletranslate = property(lambda self: self.source.shouldusegoogletranslate)
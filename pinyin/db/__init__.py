@@ -1,3 +1,5 @@
+import threading
+
 import cjklib.dbconnector
 import sqlalchemy
 
@@ -7,4 +9,39 @@ from pinyin.logger import log
 
 dbpath = pinyin.utils.toolkitdir("pinyin", "db", "cjklib.db")
 
-database = pinyin.utils.Thunk(lambda: cjklib.dbconnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) }))
+"""
+A connection to the database for each thread that uses it. A SQLite connection can only be
+used on the thread that made it, and we look things up on background threads as well as the
+one that started up (e.g. while filling in notes), so we can't all share the one cjklib makes.
+"""
+class ThreadConnector(cjklib.dbconnector.DatabaseConnector):
+    def __init__(self, configuration):
+        self.connections = threading.local()
+        cjklib.dbconnector.DatabaseConnector.__init__(self, configuration)
+        
+        # Tables are loaded through the engine, whose pool gives each thread a connection of its own too
+        self.metadata.bind = self.engine
+    
+    def getconnection(self):
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            log.info("Connecting to the database from thread %s", threading.currentThread().getName())
+            connection = self.connections.connection = self.engine.connect()
+        
+        return connection
+    
+    def setconnection(self, connection):
+        self.connections.connection = connection
+    
+    connection = property(getconnection, setconnection)
+
+database = pinyin.utils.Thunk(lambda: ThreadConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) }))
+
+"""
+Give this process a connection of its own to the database. Processes forked from one that was
+already using the database need this, because a SQLite connection must not be used by both.
+"""
+def reconnect():
+    connector = database()
+    connector.engine.dispose()
+    connector.connections = threading.local()
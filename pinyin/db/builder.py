@@ -2,11 +2,13 @@
 # -*- coding: utf-8 -*-
 import re
 import shutil
+import sqlite3
 import tempfile
 import os
 import zipfile
 
 from pinyin.logger import log
+import pinyin.meanings
 import pinyin.utils
 
 import sqlalchemy
@@ -42,12 +44,12 @@ class DBBuilder(object):
             pass
     
     def build(self):
-        # [1/4]: copy and extract necessary files into a location cjklib can deal with
+        # [1/5]: copy and extract necessary files into a location cjklib can deal with
         log.info("Copying in dictionary data")
         for requirement, satisfier in self.satisfiers:
             satisfier(os.path.join(self.dictionarydatapath, requirement))
         
-        # [2/4]: setup the database builder with a standard set of requirements
+        # [2/5]: setup the database builder with a standard set of requirements
         log.info("Initializing builder")
         database = cjklib.dbconnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=self.builtdatabasepath) })
         self.cjkdbbuilder = cjklib.build.DatabaseBuilder(
@@ -60,15 +62,58 @@ class DBBuilder(object):
                     'CombinedCharacterResidualStrokeCountBuilder',
                     'HanDeDictFulltextSearchBuilder', 'UnihanBMPBuilder'])
         
-        # [3/4]: build the database
+        # [3/5]: build the database
         log.info("Building the cjklib database: the target file is %s", self.builtdatabasepath)
         self.cjkdbbuilder.build(DBBuilder.wantgroups)
         
-        # [4/4]: clean up, so that we don't get errors if (when) the temporary database is deleted
+        # [4/5]: clean up, so that we don't get errors if (when) the temporary database is deleted
         database.connection.close()
         del database.connection
         database.engine.dispose()
         del database.engine
+        
+        # [5/5]: pull the measure words out of the dictionaries, so we needn't parse meanings to find them
+        log.info("Extracting the measure words from the dictionaries")
+        connection = sqlite3.connect(self.builtdatabasepath)
+        try:
+            buildmeasurewords(connection)
+        finally:
+            connection.close()
+
+# The dictionary tables, and the index of the simplified characters in their embedded Chinese
+measurewordtables = [("CEDICT", 1), ("HanDeDict", 0), ("CFDICT", 0)]
+
+"""
+Builds the MeasureWords table: the measure words given for each headword by each of the dictionaries
+in the database, in the order they appear in its meaning.
+"""
+def buildmeasurewords(connection):
+    connection.execute("drop table if exists MeasureWords")
+    connection.execute("""create table MeasureWords (Dictionary text, HeadwordTraditional text, HeadwordSimplified text, HeadwordReading text,
+                                                     Position integer, MeasureWordSimplified text, MeasureWordTraditional text, MeasureWordReading text)""")
+    
+    existingtables = set([name for name, in connection.execute("select name from sqlite_master where type = 'table'")])
+    for tablename, simptradindex in measurewordtables:
+        if tablename not in existingtables:
+            log.info("No %s table to extract measure words from", tablename)
+            continue
+        
+        rows, seen = [], set()
+        for traditional, simplified, reading, translation in connection.execute("select HeadwordTraditional, HeadwordSimplified, Reading, Translation from %s order by rowid" % tablename):
+            # If a headword is given more than once, we look up measure words for it alongside whichever meaning comes first
+            key = (traditional, simplified, reading)
+            if key in seen or translation is None:
+                continue
+            seen.add(key)
+            
+            for position, (mwsimplified, mwtraditional, mwreading) in enumerate(pinyin.meanings.measurewordsindefinition(translation, simptradindex)):
+                rows.append((tablename, traditional, simplified, reading, position, mwsimplified, mwtraditional, mwreading))
+        
+        log.info("Found %d measure words in the %s table", len(rows), tablename)
+        connection.executemany("insert into MeasureWords values (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    
+    connection.execute("create index MeasureWords__Headword on MeasureWords (Dictionary, HeadwordSimplified, HeadwordTraditional, HeadwordReading)")
+    connection.commit()
 
 
 def getSatisfiers():
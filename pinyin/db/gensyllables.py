@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Regenerates pinyin/syllables.py from the PinyinSyllables table of a built database. The
+# table stays the source of truth, but parsing pinyin shouldn't have to open the database
+# just to find out which syllables exist, so we freeze the list into a module instead.
+# Run this from the root of the Toolkit after cjklib's pinyin data changes:
+#   python pinyin/db/gensyllables.py [path/to/cjklib.db]
+
+import codecs
+import sys
+
+# NB: import the Toolkit first, so that the vendored copies of cjklib and SQLAlchemy are on the path
+import pinyin.db
+from pinyin.model import substituteForUUmlaut
+import pinyin.utils
+
+import cjklib.dbconnector
+import sqlalchemy
+
+
+def readsyllables(database):
+    table = sqlalchemy.Table("PinyinSyllables", database.metadata, autoload=True)
+    syllables = set([substituteForUUmlaut(row[0]).lower() for row in database.selectRows(sqlalchemy.select([table.c.Pinyin]))])
+    
+    # Not in the table, but we want to accept the erhua suffix on its own
+    syllables.add(u"r")
+    return syllables
+
+def writesyllables(syllables, path):
+    output = codecs.open(path, "w", encoding="utf-8")
+    try:
+        output.write(u"# -*- coding: utf-8 -*-\n")
+        output.write(u"# Generated from the PinyinSyllables table by pinyin/db/gensyllables.py: do not edit by hand.\n")
+        output.write(u"\n")
+        output.write(u"validpinyin = frozenset([\n")
+        for syllable in sorted(syllables):
+            output.write(u"    u\"%s\",\n" % syllable)
+        output.write(u"  ])\n")
+    finally:
+        output.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        database = cjklib.dbconnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=sys.argv[1]) })
+    else:
+        database = pinyin.db.database()
+    
+    writesyllables(readsyllables(database), pinyin.utils.toolkitdir("pinyin", "syllables.py"))
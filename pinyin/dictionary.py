@@ -4,6 +4,8 @@
 import codecs
 import os
 import re
+
+import characters
 import meanings
 
 import sqlalchemy
@@ -12,17 +14,39 @@ from sqlalchemy.schema import Table
 from model import *
 from utils import *
 
-from db import database
+from db import database, dbpath
 
 from logger import log
 
 
-def parseMeaning(meaning, simptradindex):
+def parseMeaning(meaning, simptradindex, rawmeasurewords=None):
     meaning = zapempty(meaning)
     if meaning is None:
         return None
     
-    return lambda prefersimptrad, tonedcharscallback: meanings.MeaningFormatter(simptradindex, prefersimptrad).parsedefinition(meaning, tonedcharscallback)
+    return DictionaryMeaning(meaning, simptradindex, rawmeasurewords)
+
+"""
+The meaning of a dictionary entry, which is only parsed once someone asks for it by calling this
+with their simplified/traditional preference and a function to find the tones of characters.
+
+The measure words alone can be asked for too. If they were found when the database was built, we
+are given a function that looks them up, so that we don't have to parse the meaning at all.
+"""
+class DictionaryMeaning(object):
+    def __init__(self, meaning, simptradindex, rawmeasurewords=None):
+        self.meaning = meaning
+        self.simptradindex = simptradindex
+        self.rawmeasurewords = rawmeasurewords
+    
+    def __call__(self, prefersimptrad, tonedcharscallback):
+        return meanings.MeaningFormatter(self.simptradindex, prefersimptrad).parsedefinition(self.meaning, tonedcharscallback)
+    
+    def measurewords(self, prefersimptrad, tonedcharscallback):
+        if self.rawmeasurewords is None:
+            return self(prefersimptrad, tonedcharscallback)[1]
+        
+        return meanings.MeaningFormatter(self.simptradindex, prefersimptrad).formatmeasurewords(self.rawmeasurewords())
 
 def fileSource(dictname):
     filename = toolkitdir("pinyin", "dictionaries", dictname)
@@ -61,19 +85,51 @@ def fileSource(dictname):
     
     return maxcharacterlen, lambda word: [(reading, parseMeaning(meaning, 0)) for reading, meaning in readingsmeanings[word]]
 
+"""
+Something that changes whenever any of the data the dictionaries are built from does: the
+database, and the files that loadall reads. Anything that remembers what was looked up in the
+dictionaries between sessions should check it.
+"""
+def dataversion():
+    stamps = []
+    for path in [dbpath, toolkitdir("pinyin", "dictionaries", 'dict-userdict.txt'), toolkitdir("pinyin", "dictionaries", 'pinyin_toolkit_sydict.u8')]:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamps.append((os.path.basename(path), stat.st_mtime, stat.st_size))
+    
+    return repr(stamps)
+
 def databaseDictionarySource(tablename, simptradindex):
     log.info("Loading full dictionary from database table %s", tablename)
     
     dicttable = Table(tablename, database.metadata, autoload=True)
     maxcharacterlen = database.selectScalar(sqlalchemy.func.max(sqlalchemy.func.length(dicttable.c.HeadwordSimplified)))
     
+    # Databases built before we started extracting the measure words don't have them to hand
+    if database.hasTable("MeasureWords"):
+        measurewordtable = Table("MeasureWords", database.metadata, autoload=True)
+        rawmeasurewords = lambda traditional, simplified, reading: lambda: database.selectRows(sqlalchemy.select(
+                [measurewordtable.c.MeasureWordSimplified,
+                 measurewordtable.c.MeasureWordTraditional,
+                 measurewordtable.c.MeasureWordReading],
+                sqlalchemy.and_(measurewordtable.c.Dictionary == tablename,
+                                measurewordtable.c.HeadwordSimplified == simplified,
+                                measurewordtable.c.HeadwordTraditional == traditional,
+                                measurewordtable.c.HeadwordReading == reading),
+                order_by=[measurewordtable.c.Position]))
+    else:
+        log.info("The database has no table of measure words, so we will find them by parsing the meanings")
+        rawmeasurewords = lambda traditional, simplified, reading: None
+    
     def inner(word):
-        for reading, meaning in database.selectRows(sqlalchemy.select(
-                [dicttable.c.Reading,
+        for traditional, simplified, reading, meaning in database.selectRows(sqlalchemy.select(
+                [dicttable.c.HeadwordTraditional,
+                 dicttable.c.HeadwordSimplified,
+                 dicttable.c.Reading,
                  dicttable.c.Translation],
                 sqlalchemy.or_(dicttable.c.HeadwordSimplified == word,
                                dicttable.c.HeadwordTraditional == word))):
-            yield (reading, parseMeaning(meaning, simptradindex))
+            yield (reading, parseMeaning(meaning, simptradindex, rawmeasurewords(traditional, simplified, reading)))
     
     return maxcharacterlen, inner
 
@@ -92,14 +148,24 @@ def squelchMeaning(maxlensource):
             if meaningfun is None:
                 yield reading, None
             else:
-                def squelch(*meanargs):
-                    meaning, measurewords = meaningfun(*meanargs)
-                    return None, measurewords
-                
-                yield reading, squelch
+                yield reading, SquelchedMeaning(meaningfun)
     
     return maxlensource[0], inner
 
+"""
+A meaning that only contributes its measure words.
+"""
+class SquelchedMeaning(object):
+    def __init__(self, meaning):
+        self.meaning = meaning
+    
+    def __call__(self, *meanargs):
+        meaning, measurewords = self.meaning(*meanargs)
+        return None, measurewords
+    
+    def measurewords(self, *meanargs):
+        return self.meaning.measurewords(*meanargs)
+
 """
 Encapsulates one or more Chinese dictionaries, and provides the ability to transform
 strings of Hanzi into their pinyin equivalents.
@@ -155,7 +221,7 @@ class PinyinDictionary(object):
             # punctuation is typically followed by a space whereas the Chinese
             # equivalents are not.
             words_need_space = needsspacebeforeappend(words)
-            is_punctuation = ispunctuation(flatten(readingtokens))
+            is_punctuation = characters.ispunctuation(flatten(readingtokens))
             reading_starts_with_er = len(readingtokens) > 0 and readingtokens[0].iser
             if words_need_space and not(is_punctuation) and not(reading_starts_with_er):
                 words.append(Word(Text(u' ')))
@@ -199,11 +265,44 @@ class PinyinDictionary(object):
     """
     def meanings(self, sentence, prefersimptrad):
         log.info("Requested meanings for %s", sentence)
+        return self.meaningsof(self.findmeaning(sentence), prefersimptrad)
+    
+    """
+    Given a string of Hanzi, return just the measure words that meanings would.
+    """
+    def measurewords(self, sentence, prefersimptrad):
+        log.info("Requested measure words for %s", sentence)
+        return self.measurewordsof(self.findmeaning(sentence), prefersimptrad)
+    
+    """
+    The meanings and measure words of something found by findmeaning.
+    """
+    def meaningsof(self, meaning, prefersimptrad):
+        if meaning is None:
+            return None, None
+        
+        # Instantiate the raw definition with our particular requirements
+        return meaning(prefersimptrad, self.tonedchars)
+    
+    """
+    The measure words of something found by findmeaning. This avoids parsing the meanings if the
+    database was built with a table of the measure words.
+    """
+    def measurewordsof(self, meaning, prefersimptrad):
+        if meaning is None:
+            return None
         
+        return meaning.measurewords(prefersimptrad, self.tonedchars)
+    
+    """
+    Finds the dictionary entry for the first recognisable thing in the string, without instantiating
+    it. Returns None if there isn't one, or if the string looks like a phrase.
+    """
+    def findmeaning(self, sentence):
         isfirstparsedthing = True
-        foundmeanings, foundmeasurewords = None, None
+        foundmeaning = None
         for readingsmeanings, text in self.parse(sentence):
-            if readingsmeanings is None and (ispunctuation(text.strip()) or text.strip() == u""):
+            if readingsmeanings is None and (characters.ispunctuation(text.strip()) or text.strip() == u""):
                 # Discard punctuation and whitespace from consideration, or we don't return a reading for e.g. "你好!"
                 continue
             
@@ -213,7 +312,7 @@ class PinyinDictionary(object):
                 # see <http://github.com/batterseapower/pinyin-toolkit/issues/unreads#issue/71>.
                 # We want to translate things like U盘 using Google rather than just returning "tray".
                 log.info("We found a phrase, so returning no meanings")
-                return None, None
+                return None
             
             isfirstparsedthing = False
             
@@ -227,12 +326,11 @@ class PinyinDictionary(object):
                     # NB: we return None if there is no meaning in the codomain. This case can
                     # occur if the character only comes
                     log.info("We found a reading but no meaning for some text")
-                    return None, None
+                    return None
                 else:
-                    # Instantiate the raw definition with our particular requirements
-                    foundmeanings, foundmeasurewords = readingsmeanings[0][1](prefersimptrad, self.tonedchars)
+                    foundmeaning = readingsmeanings[0][1]
                     
-        return foundmeanings, foundmeasurewords
+        return foundmeaning
 
     def parse(self, sentence):
         assert type(sentence)==unicode
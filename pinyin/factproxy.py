@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import copy
+
 from pinyin.logger import log
 
 """
@@ -11,13 +13,10 @@ class FactProxy(object):
         self.fact = fact
         
         # NB: the fieldnames dictionary IS part of the interface of this class
-        self.fieldnames = {}
-        for key, candidateFieldNames in candidateFieldNamesByKey.items():
-            # Don't add a key into the dictionary if we can't find a field, or we end
-            # up reporting that we the contain the field but die during access
-            fieldname = chooseField(candidateFieldNames, fact)
-            if fieldname is not None:
-                self.fieldnames[key] = fieldname
+        self.fieldnames = dict(fieldmapping(candidateFieldNamesByKey, fact))
+        
+        # The keys of those fields we have actually changed the value of
+        self.dirtyfields = set()
 
     def __contains__(self, key):
         return key in self.fieldnames
@@ -26,7 +25,48 @@ class FactProxy(object):
         return self.fact[self.fieldnames[key]]
     
     def __setitem__(self, key, value):
-        self.fact[self.fieldnames[key]] = value
+        # Writing back the value that is already there doesn't count as a change
+        fieldname = self.fieldnames[key]
+        if self.fact[fieldname] != value:
+            self.fact[fieldname] = value
+            self.dirtyfields.add(key)
+    
+    dirty = property(lambda self: len(self.dirtyfields) != 0)
+
+"""
+Which field of the fact we use for each key. This only depends on the model of the fact, so we
+work it out once for each model (and each version of it, since the user may change the fields)
+and the field names it has, and remember it for all the other facts of that model.
+"""
+def fieldmapping(candidateFieldNamesByKey, fact):
+    model = hasattr(fact, "model") and fact.model() or None
+    cachekey = (model and (model["id"], model["mod"]), tuple(fact.keys()))
+    
+    # NB: the candidates are usually the very same dictionary every time, but we check they are still
+    # equal to the ones we worked the mapping out for, in case they were changed in the meantime
+    cached = fieldmappings.get(cachekey)
+    if cached is not None and cached[0] == candidateFieldNamesByKey:
+        return cached[1]
+    
+    mapping = {}
+    for key, candidateFieldNames in candidateFieldNamesByKey.items():
+        # Don't add a key into the dictionary if we can't find a field, or we end
+        # up reporting that we the contain the field but die during access
+        fieldname = chooseField(candidateFieldNames, fact)
+        if fieldname is not None:
+            mapping[key] = fieldname
+    
+    if len(fieldmappings) >= maxfieldmappings:
+        fieldmappings.clear()
+    fieldmappings[cachekey] = (copy.deepcopy(candidateFieldNamesByKey), mapping)
+    
+    return mapping
+
+# (model ID and modification time, field names) -> (candidate field names, mapping from keys to field names)
+fieldmappings = {}
+
+# There are only ever a few models, so this many mappings means something odd is going on: start again
+maxfieldmappings = 1000
 
 def chooseField(candidateFieldNames, fact):
     # Find the first field that is present in the fact
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import Queue
+import sys
+import threading
+
+import bulkfill
+from logger import log
+
+
+"""
+Works out updates on a background thread, and hands them back to be applied on the thread that
+asked for them (in Anki, the UI thread) when it next calls applyready.
+
+Each update is for a key (e.g. a note), and every update asked for gives the key a new generation.
+Only the update of the latest generation is ever applied: if the key has been asked for again by
+the time the worker gets to an update, it isn't even worked out, and if it has been asked for
+again by the time the update is ready, it is dropped.
+
+Updates are worked out one at a time, in the order they were asked for, so that someone typing
+quickly doesn't start a pile of dictionary lookups or Google Translate requests all at once.
+"""
+class BackgroundUpdates(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        
+        # key -> the latest generation asked for, until that generation has been dealt with
+        self.generations = {}
+        
+        # Updates asked for but not yet applied or dropped
+        self.pending = 0
+        
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+        self.worker = None
+    
+    """
+    Asks for compute() to be called on the background thread, and apply() to be called with what
+    it returns by applyready, unless another update for the same key was asked for in the meantime.
+    """
+    def submit(self, key, compute, apply):
+        self.lock.acquire()
+        try:
+            generation = self.generations.get(key, 0) + 1
+            self.generations[key] = generation
+            self.pending += 1
+            
+            if self.worker is None:
+                # NB: a daemon, so that Anki can exit without waiting for a Google Translate request
+                self.worker = threading.Thread(target=self.work)
+                self.worker.setDaemon(True)
+                self.worker.start()
+        finally:
+            self.lock.release()
+        
+        self.jobs.put((key, generation, compute, apply))
+    
+    def iscurrent(self, key, generation):
+        self.lock.acquire()
+        try:
+            return self.generations.get(key) == generation
+        finally:
+            self.lock.release()
+    
+    def work(self):
+        while True:
+            key, generation, compute, apply = self.jobs.get()
+            try:
+                if not(self.iscurrent(key, generation)):
+                    # There is a later update for this key on its way, so don't bother
+                    outcome = None
+                else:
+                    try:
+                        outcome = ("result", compute())
+                    except Exception, e:
+                        outcome = ("exception", sys.exc_info())
+                
+                self.results.put((key, generation, outcome, apply))
+            finally:
+                self.jobs.task_done()
+    
+    """
+    Waits until the background thread has worked out every update asked for so far.
+    """
+    def join(self):
+        self.jobs.join()
+    
+    """
+    Applies the updates that are ready and still current. Must be called on the thread that asked
+    for them. Returns how many updates were applied.
+    """
+    def applyready(self):
+        applied = 0
+        while True:
+            try:
+                key, generation, outcome, apply = self.results.get_nowait()
+            except Queue.Empty:
+                return applied
+            
+            self.lock.acquire()
+            try:
+                self.pending -= 1
+                current = outcome is not None and self.generations.get(key) == generation
+                if current:
+                    # NB: nothing older for this key can still be on its way, so we can forget it
+                    del self.generations[key]
+            finally:
+                self.lock.release()
+            
+            if not(current):
+                log.info("Dropping an out of date update for %s", key)
+            elif outcome[0] == "exception":
+                log.error("Had to suppress an exception while working out an update for %s", key, exc_info=outcome[1])
+            else:
+                apply(outcome[1])
+                applied += 1
+
+"""
+Runs a copy of the updater on a copy of the fields, so that it can be done on a background thread.
+The copy must be made with bulkfill.deferredcopy on the thread the update will be applied on. Returns
+what the updater wrote into the fields, and what it wanted to tell the user.
+"""
+def computeupdate(updater, updatehow, fields, value):
+    fact = bulkfill.RecordingFact(fields)
+    getattr(updater, updatehow)(fact, value)
+    
+    notifier = getattr(updater, "notifier", None)
+    return fact.written, notifier is not None and notifier.calls or []
+
+"""
+Makes the writes computed by computeupdate from the given fields to the fact, importing any media
+they mention and passing on anything the user should be told to the real notifier. Fields that no
+longer hold what they did when the update was computed (e.g. because the user has typed into them
+since) are left alone. Returns how many fields were written.
+"""
+def applyupdate(notifier, mediamanager, fact, fields, update):
+    written, notifications = update
+    for method, args in notifications:
+        getattr(notifier, method)(*args)
+    
+    applied = 0
+    for key, value in written.items():
+        if fact[key] != fields.get(key):
+            log.info("Not updating the %s field, because it has changed since we worked out the update", key)
+            continue
+        
+        fact[key] = bulkfill.importmedia(mediamanager, value)
+        applied += 1
+    
+    return applied
@@ -290,6 +290,9 @@ class Mapping(object):
 
     def updateModelValue(self, value):
         exec ("model." + self.key + " = value") in { "model" : self.model, "value" : value }
+        
+        # The key might name an item inside one of the settings, which the model doesn't see being set
+        self.model.changed()
         self.modelchanged.fire()
 
 class RadioMapping(Mapping):
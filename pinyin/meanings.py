@@ -28,20 +28,11 @@ class MeaningFormatter(object):
             
             # Detect measure-word ness
             if definition.startswith("CL:"):
-                ismeasureword = True
-                
-                # Measure words are comma-seperated
-                for mw in definition[3:].strip().split(","):
-                    # Attempt to parse the measure words as structured data
-                    match = self.embeddedchineseregex.match(mw)
-                    if match is None:
-                        log.info("Could not parse the apparent measure word %s", mw)
-                        continue
-                    
+                for simplified, traditional, rawpinyin in measurewordsin(definition, self.simplifiedcharindex):
                     # They SHOULD have pinyin information
-                    characterswords, pinyinwords = self.formatmatch(match, tonedchars_callback)
+                    characterswords, pinyinwords = self.formatcharacters(simplified, traditional, rawpinyin, tonedchars_callback)
                     if characterswords is None or pinyinwords is None:
-                        log.info("The measure word %s was missing some information in the dictionary", mw)
+                        log.info("The measure word %s was missing some information in the dictionary", simplified)
                         continue
                     
                     measurewords.append((characterswords, pinyinwords))
@@ -67,22 +58,21 @@ class MeaningFormatter(object):
         return meanings, measurewords
     
     def formatmatch(self, match, tonedchars_callback):
-        if match.group(4) != None:
-            # A single character standing by itself, with no | - just use the character
-            character = match.group(4)
-        elif self.prefersimptrad == "simp":
-            # A choice of characters, and we want the simplified one
-            character = match.group(1 + self.simplifiedcharindex)
-        else:
-            # A choice of characters, and we want the traditional one
-            character = match.group(1 + (1 - self.simplifiedcharindex))
-        
-        if match.group(4) != None:
-            # Pinyin tokens (if any) will be present in single-character match case
-            rawpinyin = match.group(5)
+        simplified, traditional, rawpinyin = matchedcharacters(match, self.simplifiedcharindex)
+        return self.formatcharacters(simplified, traditional, rawpinyin, tonedchars_callback)
+    
+    """
+    Formats measure words as they were found by measurewordsin (e.g. when the dictionary was built)
+    in the same way as parsedefinition would, without having to parse the definition again.
+    """
+    def formatmeasurewords(self, rawmeasurewords):
+        return [self.formatcharacters(simplified, traditional, rawpinyin, None) for simplified, traditional, rawpinyin in rawmeasurewords]
+    
+    def formatcharacters(self, simplified, traditional, rawpinyin, tonedchars_callback):
+        if self.prefersimptrad == "simp":
+            character = simplified
         else:
-            # Pinyin tokens (if any) will be present in conjunctive character match case
-            rawpinyin = match.group(3)
+            character = traditional
         
         if rawpinyin != None:
             # There was some pinyin for the character after it - include it
@@ -91,3 +81,46 @@ class MeaningFormatter(object):
         else:
             # Look up the tone for the character so we can display it more nicely, as in the other branch
             return (tonedchars_callback(character), None)
+
+"""
+The simplified and traditional characters of a match of embeddedchineseregex, and the pinyin given
+for them (or None if there wasn't any).
+"""
+def matchedcharacters(match, simplifiedcharindex):
+    if match.group(4) != None:
+        # A single character standing by itself, with no | - just use the character.
+        # Pinyin tokens (if any) will be present in single-character match case
+        return match.group(4), match.group(4), match.group(5)
+    else:
+        # A choice of characters. Pinyin tokens (if any) will be present in conjunctive character match case
+        return match.group(1 + simplifiedcharindex), match.group(1 + (1 - simplifiedcharindex)), match.group(3)
+
+"""
+The measure words in one CL: part of a definition, as (simplified, traditional, pinyin) triples.
+"""
+def measurewordsin(definition, simplifiedcharindex):
+    measurewords = []
+    
+    # Measure words are comma-seperated
+    for mw in definition.strip()[3:].strip().split(","):
+        # Attempt to parse the measure words as structured data
+        match = MeaningFormatter.embeddedchineseregex.match(mw)
+        if match is None:
+            log.info("Could not parse the apparent measure word %s", mw)
+            continue
+        
+        measurewords.append(matchedcharacters(match, simplifiedcharindex))
+    
+    return measurewords
+
+"""
+All the measure words in a raw definition that come with their pinyin, which are the ones that
+parsedefinition reports, as (simplified, traditional, pinyin) triples.
+"""
+def measurewordsindefinition(raw_definition, simplifiedcharindex):
+    measurewords = []
+    for definition in raw_definition.strip().lstrip("/").rstrip("/").split("/"):
+        if definition.strip().startswith("CL:"):
+            measurewords.extend([measureword for measureword in measurewordsin(definition, simplifiedcharindex) if measureword[2] is not None])
+    
+    return measurewords
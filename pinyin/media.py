@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cPickle
 import os
 import re
-import urllib
 import shutil
+import sys
 import tempfile
+import threading
+import urllib2
 import zipfile
 
 from logger import log
+import model
 import utils
 
 
@@ -19,14 +23,15 @@ def downloadAndInstallMandarinSounds(notifier, mediamanager, config):
         # Download ZIP, using cache if necessary
         downloader = MediaDownloader(mediamanager.mediadir())
         the_media = downloader.download("Chinese-Lessons.com Mandarin Sounds", config.mandarinsoundsurl,
-                                        lambda: notifier.info("Downloading the sounds - this might take a while!"))
+                                        lambda: notifier.info("Downloading the sounds - this might take a while!"),
+                                        progress=logprogress, md5=config.mandarinsoundsmd5)
     except IOError, e:
         notifier.exception("Error while downloading the sound pack: are you connected to the internet?")
         return
 
     try:
         # Install each file from the ZIP into our media folder
-        the_media.installpack(mediamanager.mediadir())
+        the_media.installpack(mediamanager.mediadir(), workers=4)
     except zipfile.BadZipfile, e:
         notifier.exception("The downloaded sound pack appeared to be corrupt")
         return
@@ -36,7 +41,16 @@ def downloadAndInstallMandarinSounds(notifier, mediamanager, config):
     notifier.info("Finished installing Mandarin sounds! These sound files will be used automatically as long as you have "
                   + " the: <b>" + exampleAudioField + "</b> field in your deck, and the text: <b>%(" + exampleAudioField + ")s</b> in your card template")
 
+"""
+Progress callback for downloads that just notes every megabyte in the log.
+"""
+def logprogress(downloaded, total):
+    if downloaded % (1024 * 1024) < MediaDownloader.chunksize:
+        log.info("Downloaded %d of %s bytes", downloaded, total or "an unknown number of")
+
 class MediaDownloader(object):
+    chunksize = 65536
+    
     def __init__(self, mediadir):
         # Where shall we save downloaded files?
         self.__cachedir = os.path.join(mediadir, "downloads")
@@ -45,29 +59,141 @@ class MediaDownloader(object):
         log.info("Initialising cache directory at %s", self.__cachedir)
         utils.ensuredirexists(self.__cachedir)
     
-    def download(self, name, zipurl, downloadprompt=None):
+    """
+    Download the ZIP at the URL, unless it's already in the cache. The progress callback, if any, is
+    told the number of bytes we have so far and the total (or None if the server didn't say) as each
+    chunk arrives. If we have the MD5 digest the file should have, we check the download against it.
+    """
+    def download(self, name, zipurl, downloadprompt=None, progress=None, md5=None):
         # First check the cache to see if we have the download already
         cachepath = self.urlcachepath(zipurl)
         if os.path.exists(cachepath):
-            log.info("Found %s in the cache at %s", zipurl, cachepath)
-            return DownloadedMedia(name, cachepath)
+            if md5 is None or utils.md5file(cachepath) == md5:
+                log.info("Found %s in the cache at %s", zipurl, cachepath)
+                return DownloadedMedia(name, cachepath)
+            
+            log.info("The copy of %s in the cache at %s is damaged, so downloading it again", zipurl, cachepath)
+            os.remove(cachepath)
         
         # Can we actually write to the cache?
+        partialpath = cachepath + ".part"
         if utils.canwriteto(cachepath):
-            # We CAN write to the cache - download straight into it
+            # We CAN write to the cache - download straight into it, picking up where any earlier attempt left off
             log.info("Have write access to cache - downloading into it")
-            downloadto = cachepath
+            os.remove(cachepath)
+            downloadto = partialpath
         else:
             # Use a temporary path instead, the user doesn't have enough permissions
             log.info("No write access to cache - downloading to temporary location")
             downloadto = tempfile.mktemp()
 
-        # Actually do the download and return the result
+        # Actually do the download
         if downloadprompt is not None:
             downloadprompt()
-        urllib.urlretrieve(zipurl, downloadto)
+        self.fetch(zipurl, downloadto, progress)
+        
+        # Make sure we got what we were expecting
+        if md5 is not None and utils.md5file(downloadto) != md5:
+            os.remove(downloadto)
+            if os.path.exists(self.validatorpath(downloadto)):
+                os.remove(self.validatorpath(downloadto))
+            raise IOError("The download of %s did not have the expected MD5 digest %s" % (zipurl, md5))
+        
+        # We don't need to resume this download any more
+        if os.path.exists(self.validatorpath(downloadto)):
+            os.remove(self.validatorpath(downloadto))
+        
+        if downloadto == partialpath:
+            os.rename(partialpath, cachepath)
+            downloadto = cachepath
+        
         return DownloadedMedia(name, downloadto)
     
+    """
+    Where we keep what the server said identifies the version of the file we are downloading to the
+    path (its ETag or Last-Modified header), so we only add to what we have if it hasn't changed.
+    """
+    def validatorpath(self, path):
+        return path + ".validator"
+    
+    def fetch(self, url, path, progress):
+        if os.path.exists(path):
+            have = os.path.getsize(path)
+        else:
+            have = 0
+        
+        validator = None
+        if have > 0 and os.path.exists(self.validatorpath(path)):
+            validator = utils.filecontents(self.validatorpath(path))
+        
+        # Ask for just the rest of the file if we already have some of it, as long as it's the same file.
+        # If we can't tell, we had better start again, or we might end up with the start of another file
+        request = urllib2.Request(url)
+        if have > 0 and validator:
+            log.info("Resuming the download of %s from byte %d", url, have)
+            request.add_header("Range", "bytes=%d-" % have)
+            request.add_header("If-Range", validator)
+        elif have > 0:
+            log.info("Can't tell if the partial download of %s is of the file on the server now, so starting again", url)
+            have = 0
+        
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code != 416:
+                raise
+            
+            # Range Not Satisfiable: what we have can't be resumed, so start again from scratch
+            log.info("Couldn't resume the download of %s, so starting again", url)
+            os.remove(path)
+            return self.fetch(url, path, progress)
+        
+        try:
+            # Servers that don't understand ranges, or have a different file now, just send us the whole file again
+            if have > 0 and response.code != 206:
+                log.info("Server can't resume the download of %s, so starting again", url)
+                have = 0
+            
+            if have == 0:
+                validator = response.info().getheader("ETag") or response.info().getheader("Last-Modified")
+                if validator:
+                    validatorfile = open(self.validatorpath(path), "w")
+                    try:
+                        validatorfile.write(validator)
+                    finally:
+                        validatorfile.close()
+                elif os.path.exists(self.validatorpath(path)):
+                    os.remove(self.validatorpath(path))
+            
+            length = response.info().getheader("Content-Length")
+            if length is not None:
+                total = have + int(length)
+            else:
+                total = None
+            
+            # Stream the response to disk a chunk at a time
+            if have > 0:
+                file = open(path, "ab")
+            else:
+                file = open(path, "wb")
+            
+            try:
+                downloaded = have
+                chunk = response.read(self.chunksize)
+                while chunk:
+                    file.write(chunk)
+                    downloaded += len(chunk)
+                    if progress is not None:
+                        progress(downloaded, total)
+                    chunk = response.read(self.chunksize)
+            finally:
+                file.close()
+        finally:
+            response.close()
+        
+        if total is not None and downloaded < total:
+            raise IOError("The download of %s was cut short after %d of %d bytes" % (url, downloaded, total))
+    
     def urlcachepath(self, url):
         # What the hell, just use a hash of the URL. Not meant to be human readable anyway.
         return os.path.join(self.__cachedir, utils.md5(url))
@@ -78,22 +204,73 @@ class DownloadedMedia(object):
         self.name = name
         self.zippath = zippath
     
-    def installpack(self, mediadir):
+    """
+    Extract the ZIP into a new pack directory in the media directory. Members are copied across a
+    chunk at a time, so we never need more than a few chunks in memory however big the sounds are.
+    Extraction can be shared out between several threads, each reading the ZIP through its own handle.
+    """
+    def installpack(self, mediadir, workers=1):
         # Work out the pack directory we want to extract to
         packpath = utils.mkdirfallback(mediadir, self.name)
         log.info("Extracting downloaded media into %s", packpath)
         
-        # Extract the ZIP into a new directory
+        # Deal out the members round robin, so each thread gets a similar amount of work
         thezip = zipfile.ZipFile(self.zippath)
-        for info in thezip.infolist():
-            # Create the directory
-            extractfilepath = os.path.join(packpath, info.filename)
-            utils.ensuredirexists(os.path.dirname(extractfilepath))
-            
-            # Extract the file. NB: must use binary mode - this important for for Windows!
-            file = open(extractfilepath, 'wb')
-            file.write(thezip.read(info.filename))
-            file.close()
+        try:
+            infos = thezip.infolist()
+        finally:
+            thezip.close()
+        
+        workers = max(1, min(workers, len(infos)))
+        if workers == 1:
+            self.extract(packpath, infos)
+            return
+        
+        failures = []
+        def extract(infos):
+            try:
+                self.extract(packpath, infos)
+            except Exception, e:
+                failures.append(sys.exc_info())
+        
+        threads = [threading.Thread(target=extract, args=(infos[n::workers],)) for n in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        # Let the caller know about the first thing that went wrong
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
+    
+    def extract(self, packpath, infos):
+        thezip = zipfile.ZipFile(self.zippath)
+        try:
+            for info in infos:
+                # Create the directory
+                extractfilepath = os.path.join(packpath, info.filename)
+                utils.ensuredirexists(os.path.dirname(extractfilepath))
+                
+                # Directories have entries of their own in some ZIPs, but there is nothing to extract
+                if info.filename.endswith("/"):
+                    continue
+                
+                # Extract the file. NB: must use binary mode - this important for for Windows!
+                file = open(extractfilepath, 'wb')
+                try:
+                    if hasattr(thezip, "open"):
+                        member = thezip.open(info)
+                        try:
+                            shutil.copyfileobj(member, file, MediaDownloader.chunksize)
+                        finally:
+                            member.close()
+                    else:
+                        # Python 2.5 and below can only give us the whole member at once
+                        file.write(thezip.read(info.filename))
+                finally:
+                    file.close()
+        finally:
+            thezip.close()
 
 class MediaPack(object):
     def __init__(self, packpath, media):
@@ -101,6 +278,9 @@ class MediaPack(object):
         
         # Normalize capitalisation for ease of lookup
         self.media = dict([(name.lower(), filename) for name, filename in media.items()])
+        
+        # Which syllables we have sounds for, one index per list of audio extensions we are asked about
+        self.coverages = utils.FactoryDict(lambda audioextensions: MediaCoverage(self.media, audioextensions))
     
     def __str__(self):
         return self.name
@@ -140,15 +320,371 @@ class MediaPack(object):
         # No suitable media existed!
         return None
     
+    def coverage(self, audioextensions):
+        return self.coverages[tuple(audioextensions)]
+    
     @classmethod
     def frompath(cls, packpath):
         media = {}
         for filename in os.listdir(packpath):
-            log.info("Discovered media %s in %s", filename, packpath)
             media[filename] = os.path.join(packpath, filename)
         
+        log.info("Discovered %d media files in %s", len(media), packpath)
         return MediaPack(packpath, media)
 
+"""
+Stamp that changes whenever files are added to or removed from a directory, or None if
+the directory can't be examined.
+"""
+def directorystamp(path):
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime, stat.st_size)
+    except OSError:
+        return None
+
+"""
+Keeps hold of the media packs found in a media directory, so that we only need to list the
+files in a pack again when its directory has changed. Spotting a change takes one stat of the
+media directory and one of each pack. If given a path, the registry also saves what it has found
+there, so a new session can start without listing every pack.
+"""
+class MediaPackRegistry(object):
+    version = 1
+    
+    def __init__(self, indexpath=None):
+        self.indexpath = indexpath
+        
+        # The media directory we last looked at, its stamp then, and the pack directories inside it
+        self.mediadir, self.mediadirstamp, self.packpaths = None, None, []
+        
+        # Pack path -> (stamp of the pack directory, MediaPack)
+        self.packs = {}
+        
+        self.load()
+    
+    def discovermediapacks(self, mediadir):
+        changed = False
+        
+        # We only need to look for new or removed packs if the media directory itself has changed
+        mediadirstamp = directorystamp(mediadir)
+        if mediadir != self.mediadir or mediadirstamp is None or mediadirstamp != self.mediadirstamp:
+            self.mediadir, self.mediadirstamp, self.packpaths = mediadir, mediadirstamp, self.findpackpaths(mediadir)
+            changed = True
+        
+        packs = []
+        for packpath in self.packpaths:
+            stamp = directorystamp(packpath)
+            if stamp is None:
+                # The pack vanished from under us: make sure we look at the media directory again next time
+                log.info("The media pack at %s has disappeared", packpath)
+                self.mediadirstamp = None
+                continue
+            
+            known = self.packs.get(packpath)
+            if known is None or known[0] != stamp:
+                log.info("Indexing the media pack at %s", packpath)
+                known = (stamp, MediaPack.frompath(packpath))
+                self.packs[packpath] = known
+                changed = True
+            
+            packs.append(known[1])
+        
+        if changed:
+            # Forget about packs that are no longer there, and remember what we found for next session
+            for packpath in [packpath for packpath in self.packs if packpath not in self.packpaths]:
+                del self.packs[packpath]
+            self.save()
+        
+        return packs
+    
+    """
+    Runs a function that puts files (never packs) into the media directory, such as an import of
+    a sound, and brings our stamp for the directory up to date afterwards, so that the next
+    discovery doesn't look for packs all over again. If the directory had already changed in some
+    other way, we leave the stamp alone so that the next discovery still notices.
+    """
+    def addingfiles(self, mediadir, function):
+        stamp = directorystamp(mediadir)
+        result = function()
+        
+        if mediadir == self.mediadir and stamp is not None and stamp == self.mediadirstamp:
+            self.mediadirstamp = directorystamp(mediadir)
+        
+        return result
+    
+    def findpackpaths(self, mediadir):
+        packpaths = []
+        for packname in sorted(os.listdir(mediadir)):
+            # Skip the download cache directory
+            if packname.lower() == "downloads":
+                continue
+            
+            # Only try and process directories as packs:
+            packpath = os.path.join(mediadir, packname)
+            if os.path.isdir(packpath):
+                log.info("Considering %s as a media pack", packname)
+                packpaths.append(packpath)
+            else:
+                log.info("Ignoring the file %s in the media directory", packname)
+        
+        return packpaths
+    
+    def load(self):
+        if self.indexpath is None or not(os.path.exists(self.indexpath)):
+            return
+        
+        try:
+            indexfile = open(self.indexpath, "rb")
+            try:
+                index = cPickle.load(indexfile)
+            finally:
+                indexfile.close()
+            
+            if index["version"] != self.version:
+                log.info("Ignoring the media pack index at %s because it is from another version", self.indexpath)
+                return
+            
+            self.mediadir, self.mediadirstamp, self.packpaths = index["mediadir"], index["mediadirstamp"], index["packpaths"]
+            self.packs = dict([(packpath, (stamp, MediaPack(packpath, media))) for packpath, (stamp, media) in index["packs"].items()])
+            log.info("Loaded the index of %d media packs from %s", len(self.packs), self.indexpath)
+        except Exception, e:
+            # The index is only a cache, so if it is damaged we can just build it again
+            log.exception("Error while loading the media pack index from %s", self.indexpath)
+            self.mediadir, self.mediadirstamp, self.packpaths, self.packs = None, None, [], {}
+    
+    def save(self):
+        if self.indexpath is None:
+            return
+        
+        index = {
+            "version" : self.version,
+            "mediadir" : self.mediadir,
+            "mediadirstamp" : self.mediadirstamp,
+            "packpaths" : self.packpaths,
+            "packs" : dict([(packpath, (stamp, pack.media)) for packpath, (stamp, pack) in self.packs.items()])
+          }
+        
+        try:
+            indexfile = open(self.indexpath, "wb")
+            try:
+                cPickle.dump(index, indexfile, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                indexfile.close()
+        except IOError, e:
+            log.exception("Error while saving the media pack index to %s", self.indexpath)
+
+"""
+Index of the sound a media pack has for each syllable, keyed by the lowercased syllable and its
+spoken tone, with None for those it can't say. The fallbacks for the neutral tone and for ü are
+already applied, so answering for a syllable is a single lookup once it has been asked about.
+"""
+class MediaCoverage(utils.FactoryDict):
+    def __init__(self, media, audioextensions):
+        utils.FactoryDict.__init__(self, self.findmedia)
+        self.media = media
+        self.audioextensions = [extension.lower() for extension in audioextensions]
+    
+    def findmedia(self, (word, tone)):
+        # Find possible base sounds we could accept
+        possiblebases = [word + str(tone)]
+        substitutions = model.waysToSubstituteAwayUUmlaut(word)
+        if tone == 5:
+            # Sometimes we can replace tone 5 with 4 in order to deal with lack of '[xx]5.ogg's
+            possiblebases.extend([word, word + '4'])
+        elif substitutions is not None:
+            # Typically u: is written as v in filenames
+            possiblebases.extend([substitution + str(tone) for substitution in substitutions])
+        
+        # Find the first suitable media in the possibility list, checking extensions in order of priority
+        for possiblebase in possiblebases:
+            for extension in self.audioextensions:
+                media = self.media.get(possiblebase + extension)
+                if media is not None:
+                    return media
+        
+        return None
+
+"""
+Remembers which files we have already copied into a media directory, and the name they were given
+there, so that importing the same sound again is just a lookup. A file counts as the same if its
+size and modification time are unchanged and the copy is still present in the media directory.
+"""
+class MediaImportCache(object):
+    def __init__(self):
+        # (media directory, source path, source stamp) -> name in the media directory
+        self.imported = {}
+        
+        # How many files we actually copied, and how many imports we could skip
+        self.imports = 0
+        self.skipped = 0
+    
+    def importfile(self, mediadir, path, importfile):
+        try:
+            stat = os.stat(path)
+            key = (mediadir, path, (stat.st_size, stat.st_mtime))
+        except OSError:
+            # Leave it to the real import to complain about the file
+            key = None
+        
+        name = self.imported.get(key)
+        if name is not None and os.path.exists(os.path.join(mediadir, name)):
+            self.skipped += 1
+            return name
+        
+        name = importfile(path)
+        self.imports += 1
+        if key is not None:
+            self.imported[key] = name
+        
+        return name
+
+# Layer III bitrates in kbit/s by bitrate index, for MPEG 1 and for MPEG 2 and 2.5
+mp3bitrates = { 3 : [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+                2 : [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+                0 : [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160] }
+
+# Sampling rates by sampling rate index, for each MPEG version (3 for MPEG 1, 2 for MPEG 2, 0 for MPEG 2.5)
+mp3samplerates = { 3 : [44100, 48000, 32000], 2 : [22050, 24000, 16000], 0 : [11025, 12000, 8000] }
+
+"""
+The length of the frame at the start of some MP3 data if it holds a Xing, Info or VBRI header
+rather than audio, or 0 if it doesn't. Encoders put one of these at the start of a file to
+describe it (e.g. how many frames it has), so they would be wrong in the middle of a joined file.
+"""
+def mp3headerframelength(data):
+    if len(data) < 4 or ord(data[0]) != 0xff or (ord(data[1]) & 0xe0) != 0xe0:
+        return 0
+    
+    # We only need to know about layer III, which is what everyone uses
+    version, layer = (ord(data[1]) >> 3) & 3, (ord(data[1]) >> 1) & 3
+    bitrateindex, samplerateindex, padding = ord(data[2]) >> 4, (ord(data[2]) >> 2) & 3, (ord(data[2]) >> 1) & 1
+    if version == 1 or layer != 1 or bitrateindex in [0, 15] or samplerateindex == 3:
+        return 0
+    
+    bitrate, samplerate = mp3bitrates[version][bitrateindex] * 1000, mp3samplerates[version][samplerateindex]
+    length = (version == 3 and 144 or 72) * bitrate // samplerate + padding
+    
+    # The Xing or Info tag comes after the side information, which depends on the version and whether it's mono
+    mono = (ord(data[3]) >> 6) == 3
+    if version == 3:
+        sideinfo = mono and 17 or 32
+    else:
+        sideinfo = mono and 9 or 17
+    
+    if data[4 + sideinfo:8 + sideinfo] in ["Xing", "Info"] or data[36:40] == "VBRI":
+        return length
+    
+    return 0
+
+"""
+Strip the ID3 tags from the contents of an MP3 file, leaving just the frames of audio. Any frame
+at the start describing the file rather than holding audio goes too.
+"""
+def mp3frames(data):
+    # A leading ID3v2 tag: "ID3", the version, flags and a "synchsafe" size with 7 bits per byte
+    if data[:3] == "ID3" and len(data) >= 10:
+        size = 10
+        for n in range(4):
+            size += (ord(data[6 + n]) & 0x7f) << (7 * (3 - n))
+        
+        # The tag may be followed by a footer of the same size as the header
+        if ord(data[5]) & 0x10:
+            size += 10
+        
+        data = data[size:]
+    
+    # A trailing ID3v1 tag is always 128 bytes long
+    if len(data) >= 128 and data[-128:-125] == "TAG":
+        data = data[:-128]
+    
+    return data[mp3headerframelength(data):]
+
+"""
+Join MP3 files into one by concatenating their frames, which players are happy to treat as a
+single stream. This only sounds right if the files were all encoded in the same way, as those
+in one media pack usually are.
+"""
+def concatenatemp3s(inputpaths, outputpath):
+    output = open(outputpath, "wb")
+    try:
+        for inputpath in inputpaths:
+            input = open(inputpath, "rb")
+            try:
+                output.write(mp3frames(input.read()))
+            finally:
+                input.close()
+    finally:
+        output.close()
+
+"""
+Makes and remembers the files that join together the sounds for whole readings. Files are named
+after a hash of the contents of the clips that went into them, so the same reading never needs
+to be joined up twice, even if it comes up for a different note or in a later session.
+"""
+class AudioConcatenator(object):
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        
+        # (path, size, modification time) -> MD5 digest of the contents of a clip
+        self.digests = {}
+        
+        # How many files we had to make, and how many times we could use one we made earlier
+        self.made = 0
+        self.reused = 0
+    
+    def digest(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+        if key not in self.digests:
+            self.digests[key] = utils.md5file(path)
+        
+        return self.digests[key]
+    
+    """
+    Join the clips of several phrases into one MP3, with a gap in between each phrase, and
+    return the path of the result.
+    """
+    def concatenate(self, phrases, gappath):
+        clips = []
+        for phrase in phrases:
+            if len(clips) != 0:
+                clips.append(gappath)
+            clips.extend(phrase)
+        
+        outputpath = os.path.join(self.cachedir, "reading-%s.mp3" % utils.md5(" ".join([self.digest(clip) for clip in clips])))
+        if os.path.exists(outputpath):
+            self.reused += 1
+            return outputpath
+        
+        # Build the file to one side, so nobody can pick up a half written one
+        log.info("Joining %d clips into %s", len(clips), outputpath)
+        utils.ensuredirexists(self.cachedir)
+        temporarypath = outputpath + ".part"
+        concatenatemp3s(clips, temporarypath)
+        os.rename(temporarypath, outputpath)
+        
+        self.made += 1
+        return outputpath
+
+"""
+The files referenced by the media database, as a map from the filename (with its case normalized)
+to the path it was originally imported from. Build one to check a lot of directory listings
+against the same media database without normalizing all of its filenames every time.
+"""
+class MediaIndex(object):
+    def __init__(self, entries=[]):
+        self.origpaths = dict([(os.path.normcase(filename), origpath) for origpath, filename in entries])
+    
+    def __len__(self):
+        return len(self.origpaths)
+    
+    def __contains__(self, filename):
+        return os.path.normcase(filename) in self.origpaths
+    
+    def __iter__(self):
+        return iter([(origpath, filename) for filename, origpath in self.origpaths.items()])
+
 # Use to discover files in the media directory that are not referenced in the media
 # database. If this is true, the user has just copied them in - and we consider
 # such things "legacy" sounds that should be replaced with a true media pack.
@@ -158,24 +694,22 @@ def discoverlegacymedia(mediadircontents, mediaindex):
         log.info("Couldn't discover legacy media because the media directory was not accessible")
         return None
     
-    # Normalize case from the directory listing so that the removal check works reliably
+    # The index may just be the (original path, filename) pairs from the media database
+    if not(isinstance(mediaindex, MediaIndex)):
+        mediaindex = MediaIndex(mediaindex)
+    
+    # Normalize case from the directory listing so that the membership checks work reliably
     mediadircontents = [os.path.normcase(mediadircontent) for mediadircontent in mediadircontents]
     
-    # Iterate over files and pluck them out into this dictionary of dictionaries
-    for orig_path, filename in mediaindex:
-        # Remove the file from consideration for the manual media lookup stage
-        try:
-            # NB: we can only do this reliably because we normalized the case above
-            mediadircontents.remove(os.path.normcase(filename))
-        except:
-            # Tried to remove the file from the directory listing, but it's not actually
-            # in the list.  This means that the database entry is actually out of date and
-            # we should ignore it
+    # Entries for files that aren't actually in the directory listing mean that the database
+    # is out of date, and we should ignore them
+    present = set(mediadircontents)
+    for filename, orig_path in mediaindex.origpaths.items():
+        if filename not in present:
             log.info("Out of date database entry for %s -> %s", orig_path, filename)
-            continue
     
     # Return the remaining files
-    return mediadircontents
+    return [mediadircontent for mediadircontent in mediadircontents if mediadircontent not in mediaindex.origpaths]
 
 """
 # initial work on an importer for the SWAC audio files
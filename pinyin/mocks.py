@@ -44,4 +44,97 @@ class MockMediaManager(object):
         return self.mediapacks
     
     def importtocurrentdeck(self, filename):
-        return filename
\ No newline at end of file
+        return filename
+
+"""
+A note as seen by the bulk filler: a dictionary of fields that can be flushed.
+"""
+class MockNote(dict):
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.flushes = 0
+        self.mod = 0
+    
+    def flush(self):
+        import time
+        self.flushes += 1
+        self.mod = int(time.time())
+
+"""
+A collection of notes used in tests and benchmarks of the bulk filler.
+"""
+class MockCollection(object):
+    def __init__(self, notes):
+        # Note ID -> MockNote
+        self.notes = notes
+        self.saves = 0
+    
+    def getNote(self, noteid):
+        return self.notes[noteid]
+    
+    def save(self):
+        self.saves += 1
+
+"""
+A stand-in web server used in tests. It serves the same content at every path, and honours
+requests for a range of it unless told not to, or unless the If-Range header doesn't match the
+ETag of the content (which can be changed between requests). It can also be made to hang up
+partway through, as if the connection had dropped.
+"""
+class MockHTTPServer(object):
+    def __init__(self, content, supportsranges=True, cutoff=None):
+        import BaseHTTPServer
+        import threading
+        
+        import utils
+        
+        self.content = content
+        self.supportsranges = supportsranges
+        self.cutoff = cutoff
+        
+        # The Range and If-Range headers of each request we get, or None if there wasn't one
+        self.ranges = []
+        self.ifranges = []
+        
+        server = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                rangeheader, ifrangeheader = self.headers.getheader("Range"), self.headers.getheader("If-Range")
+                server.ranges.append(rangeheader)
+                server.ifranges.append(ifrangeheader)
+                
+                start, etag = 0, '"%s"' % utils.md5(server.content)
+                if rangeheader is not None and server.supportsranges and ifrangeheader in [None, etag]:
+                    start = int(rangeheader[len("bytes="):-len("-")])
+                    if start >= len(server.content):
+                        self.send_error(416)
+                        return
+                    
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(server.content) - 1, len(server.content)))
+                else:
+                    self.send_response(200)
+                
+                body = server.content[start:]
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                
+                if server.cutoff is not None:
+                    # Just the once, hang up early
+                    body, server.cutoff = body[:server.cutoff], None
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        
+        self.httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=lambda: self.httpd.serve_forever(poll_interval=0.01))
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    url = property(lambda self: "http://127.0.0.1:%d/pack.zip" % self.httpd.server_address[1])
+    
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -4,11 +4,11 @@
 import htmlentitydefs
 import re
 from BeautifulSoup import BeautifulSoup, Tag
-import sqlalchemy
 import unicodedata
 
+import characters
+import syllables
 import utils
-from db import database
 
 from logger import log
 
@@ -116,10 +116,10 @@ class Text(unicode):
 Represents a single Pinyin character in the system.
 """
 class Pinyin(object):
-    # Extract a simple regex of all the possible pinyin.
-    # NB: we have to delay-load  this in order to give the UI a chance to create the database if it is missing
-    # NB: we only need to consider the ü versions because the regex is used to check *after* we have normalised to ü
-    validpinyin = utils.Thunk(lambda: set(["r"] + [substituteForUUmlaut(pinyin[0]).lower() for pinyin in database.selectRows(sqlalchemy.select([sqlalchemy.Table("PinyinSyllables", database.metadata, autoload=True).c.Pinyin]))]))
+    # Every syllable we will accept, frozen from the database into pinyin/syllables.py. That isn't done
+    # as part of the build: rerun pinyin/db/gensyllables.py by hand whenever the pinyin data changes.
+    # NB: we only need to consider the ü versions because this is used to check *after* we have normalised to ü
+    validpinyin = syllables.validpinyin
     
     def __init__(self, word, toneinfo, htmlattrs=None):
         self.word = word
@@ -162,7 +162,7 @@ class Pinyin(object):
             return self.word + str(getattr(self.toneinfo, tone))
     
     def tonifiedformat(self):
-        return PinyinTonifier().tonify(self.numericformat(hideneutraltone=False))
+        return tonifiedsyllables[self.numericformat(hideneutraltone=False)]
 
     """
     Constructs a Pinyin object from text representing a single character and numeric tone mark
@@ -215,13 +215,121 @@ class Pinyin(object):
             word = unicodedata.normalize('NFC', word)
         
         # Sanity check to catch English/French/whatever that doesn't look like pinyin
-        if word.lower() not in cls.validpinyin():
+        if word.lower() not in cls.validpinyin:
             log.info("Couldn't find %s in the valid pinyin list", word)
             raise ValueError(u"The proposed pinyin '%s' doesn't look like pinyin after all" % text)
         
         # We now have a word and tone info, whichever route we took
         return Pinyin(word, toneinfo)
 
+"""
+Splits runs of pinyin with no spaces between the syllables, such as "nihao" or
+"xiexie3ni", using a trie of every valid syllable. Each syllable may carry a
+tone mark or be followed by a tone number.
+
+The segmentation is worked out backwards from the end of the run so that
+we can prefer the longest syllable at each point while still backtracking
+out of dead ends (e.g. "jiangu" has to be "jian" + "gu", because "u" is
+not a syllable on its own). As no syllable is more than 6 letters long, this takes time
+linear in the length of the run.
+"""
+class PinyinSegmenter(object):
+    def __init__(self, syllables):
+        # Nested dictionaries keyed by letter: the None key marks the end of a syllable
+        self.trie, self.longest = {}, 0
+        for syllable in syllables:
+            self.longest = max(self.longest, len(syllable))
+            node = self.trie
+            for letter in syllable:
+                node = node.setdefault(letter, {})
+            node[None] = True
+    
+    def segment(self, text, forcenumeric=False):
+        letters, marks = self.splittonemarks(substituteForUUmlaut(text))
+        if letters is None:
+            return None
+        
+        lowered = u"".join(letters).lower()
+        
+        # plan[i] is the (syllable end, tone, continuation) used to segment the text from position i
+        # onwards, or None if there is no way to do it. The end of the text is trivially segmentable.
+        plan = [None] * len(lowered) + [True]
+        for i in xrange(len(lowered) - 1, -1, -1):
+            # Find every syllable starting at this position. No syllable is longer than the
+            # longest one in the trie, so this inner loop is what keeps the whole thing linear.
+            ends, node = [], self.trie
+            for j in xrange(i, min(i + self.longest, len(lowered))):
+                node = node.get(lowered[j])
+                if node is None:
+                    break
+                elif None in node:
+                    ends.append(j + 1)
+            
+            # Try the longest syllables first, and take the first one that leaves a segmentable remainder
+            for end in reversed(ends):
+                tones = [mark for mark in marks[i:end] if mark is not None]
+                if len(tones) > 1:
+                    continue
+                
+                if end < len(lowered) and lowered[end] in u"12345":
+                    if len(tones) != 0:
+                        # Can't have both a tone mark and a tone number
+                        continue
+                    tone, continuation = int(lowered[end]), end + 1
+                elif forcenumeric:
+                    continue
+                elif len(tones) != 0:
+                    tone, continuation = tones[0], end
+                else:
+                    tone, continuation = 5, end
+                
+                if plan[continuation] is not None:
+                    plan[i] = (end, tone, continuation)
+                    break
+        
+        if plan[0] is None:
+            return None
+        
+        tokens, i = [], 0
+        while i < len(lowered):
+            end, tone, continuation = plan[i]
+            tokens.append(Pinyin(u"".join(letters[i:end]), tone))
+            i = continuation
+        
+        return tokens
+    
+    def splittonemarks(self, text):
+        # Peel the tone marks off each character, so we are left with the plain letters
+        # and a parallel list recording the tone (if any) that was marked on each one
+        letters, marks = [], []
+        for char in unicodedata.normalize('NFC', text):
+            letter, mark = splittonemark[char]
+            if letter is None:
+                return None, None
+            
+            letters.append(letter)
+            marks.append(mark)
+        
+        return letters, marks
+
+def splittonemarkuncached(char):
+    decomposed, mark = unicodedata.normalize('NFD', char), None
+    for n, tonecombiningmark in enumerate(tonecombiningmarks):
+        if tonecombiningmark != "" and tonecombiningmark in decomposed:
+            if mark is not None:
+                # Two tone marks on the one letter
+                return None, None
+            
+            mark = n + 1
+            decomposed = decomposed.replace(tonecombiningmark, "")
+    
+    return unicodedata.normalize('NFC', decomposed), mark
+
+# Only a handful of distinct characters ever turn up in pinyin, so remember how each one splits
+splittonemark = utils.FactoryDict(splittonemarkuncached)
+
+pinyinsegmenter = utils.Thunk(lambda: PinyinSegmenter(Pinyin.validpinyin))
+
 """
 Represents a Chinese character with tone information in the system.
 """
@@ -287,11 +395,11 @@ def tokenizeone(possible_token, forcenumeric=False):
     except ValueError:
         return Text(possible_token)
 
-def tokenizeonewitherhua(possible_token, forcenumeric=False):
+def tokenizeonewitherhua(possible_token, forcenumeric=False, segment=False):
     # The intention here is that if we fail to parse something as pinyin
-    # which has an 'r' suffix, then we'll try again without it:
-    
-    # TODO: be much smarter about parsing erhua. They can appear *inside* the pinyin too!
+    # which has an 'r' suffix, then we'll try again without it. If we are
+    # allowed to segment, we'll then try to split it into several syllables
+    # (which also takes care of erhua appearing *inside* the pinyin).
     
     # First attempt: parse as vanilla pinyin
     try:
@@ -307,32 +415,38 @@ def tokenizeonewitherhua(possible_token, forcenumeric=False):
         except ValueError:
             pass
     
+    if segment:
+        # Last chance: a run of several syllables. We insist on there being more than one,
+        # so that lone English words like "a" don't suddenly turn into pinyin
+        tokens = pinyinsegmenter().segment(possible_token, forcenumeric=forcenumeric)
+        if tokens is not None and len(tokens) > 1:
+            return tokens
+    
     # Nope, we're just going to have to fail :(
     return [Text(possible_token)]
 
-def tokenizetext(text, forcenumeric):
+def tokenizetext(text, forcenumeric, segment=False):
     # To recognise pinyin amongst the rest of the text, for now just look for maximal
     # sequences of alphanumeric characters as defined by Unicode. This should catch
     # the pinyin, its tone marks, tone numbers (if any) and allow umlauts.
     tokens = []
     for recognised, match in utils.regexparse(re.compile(u"(\w|:)+", re.UNICODE), text):
         if recognised:
-            tokens.extend(tokenizeonewitherhua(match.group(0), forcenumeric=forcenumeric))
+            tokens.extend(tokenizeonewitherhua(match.group(0), forcenumeric=forcenumeric, segment=segment))
         else:
             tokens.append(Text(match))
     
     # TODO: for robustness, we should explicitly parse around HTML tags
-    
-    # TODO: could be much smarter about segmentation here. For example, we could use the
-    # pinyin regex to split up run on groups of pinyin-like characters.
     return tokens
 
 """
 Turns an arbitrary string containing pinyin and HTML into a sequence of tokens. Does its best
-to seperate pinyin out from normal text, but no guarantees!
+to seperate pinyin out from normal text, but no guarantees! Pass segment=True to split up
+runs of several syllables written without spaces: this is only sensible where we expect the
+text to be pinyin, because plenty of English words (like "women") look like run-on pinyin.
 """
 
-def tokenize(html, forcenumeric=False):
+def tokenize(html, forcenumeric=False, segment=False):
     def extract_attr_maybe(attrs, attr, into, extractor):
         if attr not in attrs:
             return {}
@@ -408,7 +522,7 @@ def tokenize(html, forcenumeric=False):
     def recurse(attributesstack, parent):
         for child in parent.contents:
             if not isinstance(child, Tag):
-                tokens.extend([contextify(attributesstack, token) for token in tokenizetext(unicode(child), forcenumeric)])
+                tokens.extend([contextify(attributesstack, token) for token in tokenizetext(unicode(child), forcenumeric, segment)])
             elif child.isSelfClosing:
                 tokens.append(Text("<%s />" % child.name))
             else:
@@ -502,35 +616,74 @@ class Word(list):
         return word
 
 """
-Flattens the supplied tokens down into a single string.
+Flattens the supplied tokens down into a single string. If coalesce is set,
+runs of adjacent tokens sharing a color are wrapped in a single <span>, and
+colorclasses may map colors to CSS class names to use instead of inline styles.
 """
-def flatten(words, tonify=False):
-    visitor = FlattenTokensVisitor(tonify)
-    for word in words:
-        word.accept(visitor)
-    return visitor.output
-
-class FlattenTokensVisitor(TokenVisitor):
-    def __init__(self, tonify):
-        self.output = u""
-        self.tonify = tonify
+def flatten(words, tonify=False, coalesce=False, colorclasses=None):
+    return FlattenRenderer(tonify, coalesce, colorclasses).render(words)
 
-    def visitText(self, text):
-        self.wrapHtml(text, unicode(text))
-
-    def visitPinyin(self, pinyin):
-        self.wrapHtml(pinyin, self.tonify and pinyin.tonifiedformat() or unicode(pinyin))
+"""
+Renders words straight from the token stream into a list of fragments
+that is joined once at the end, rather than visiting each token in turn.
+"""
+class FlattenRenderer(object):
+    def __init__(self, tonify=False, coalesce=False, colorclasses=None):
+        self.tonify = tonify
+        self.coalesce = coalesce
+        self.colorclasses = colorclasses or {}
 
-    def visitTonedCharacter(self, tonedcharacter):
-        self.wrapHtml(tonedcharacter, unicode(tonedcharacter))
+    def tokencolor(self, token):
+        return token.htmlattrs.get("color")
     
-    def wrapHtml(self, token, text):
-        if "color" in token.htmlattrs:
-            self.output += '<span style="color:%s">' % token.htmlattrs["color"]
-            self.output += text
-            self.output += '</span>'
+    def opentag(self, color):
+        if color in self.colorclasses:
+            return '<span class="%s">' % self.colorclasses[color]
         else:
-            self.output += text
+            return '<span style="color:%s">' % color
+
+    def render(self, words):
+        fragments = []
+        opencolor, pending = None, []
+        for word in words:
+            # Some callers hand us a bare list of tokens rather than a list of Words
+            if isinstance(word, list):
+                tokens = word
+            else:
+                tokens = [word]
+            
+            for token in tokens:
+                if isinstance(token, Pinyin):
+                    text = self.tonify and token.tonifiedformat() or token.numericformat(hideneutraltone=True)
+                else:
+                    # Text and TonedCharacter are already unicode
+                    text = token
+                
+                color = self.tokencolor(token)
+                if self.coalesce and opencolor is not None and color is None and text.isspace():
+                    # Hold back uncolored whitespace: if the same color carries on after
+                    # it then the whitespace can go inside the span we already have open
+                    pending.append(text)
+                    continue
+                
+                if opencolor is not None and (color != opencolor or not(self.coalesce)):
+                    fragments.append('</span>')
+                    opencolor = None
+                
+                fragments.extend(pending)
+                pending = []
+                
+                if color is not None and color != opencolor:
+                    fragments.append(self.opentag(color))
+                    opencolor = color
+                
+                fragments.append(text)
+        
+        if opencolor is not None:
+            fragments.append('</span>')
+        fragments.extend(pending)
+        
+        return u"".join(fragments)
 
 """
 Report whether the supplied list of words ends with a space
@@ -547,7 +700,7 @@ class NeedsSpaceBeforeAppendVisitor(TokenVisitor):
     
     def visitText(self, text):
         lastchar = text[-1]
-        self.needsspacebeforeappend = (not(lastchar.isspace()) and not(utils.ispunctuation(lastchar))) or utils.ispostspacedpunctuation(unicode(text))
+        self.needsspacebeforeappend = (not(lastchar.isspace()) and not(characters.ispunctuation(lastchar))) or utils.ispostspacedpunctuation(unicode(text))
     
     def visitPinyin(self, pinyin):
         self.needsspacebeforeappend = True
@@ -635,3 +788,6 @@ class PinyinTonifier(object):
         # Turn combining marks into real characters - saves us doing this in all the test (Python
         # unicode string comparison does not appear to normalise!! Very bad!)
         return unicodedata.normalize('NFC', line)
+
+# There are only a few thousand distinct syllables, so we can remember how to tonify every one we see
+tonifiedsyllables = utils.FactoryDict(lambda syllable: PinyinTonifier().tonify(syllable))
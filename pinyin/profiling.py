@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import codecs
+import threading
+import time
+
+from logger import log
+
+
+"""
+The stages that the work done on a note is broken down into, in the order we report them.
+"""
+stages = ["segmentation", "meanings", "rendering", "audio", "media import", "translation", "flush"]
+
+"""
+Records where the time goes while a bulk operation works through the notes, broken down by
+note and by stage. The time for a stage doesn't include any stages run from within it, so e.g.
+asking Google Translate while looking up meanings only counts towards the translation.
+
+Work is put down to whichever note was last started, so this only makes sense for one bulk
+operation at a time. Notes that are filled in from the same update as an earlier one only
+have their flush to account for.
+"""
+class NoteTimings(object):
+    def __init__(self):
+        self.current = None
+        
+        # note -> stage -> seconds
+        self.notes = {}
+        
+        # stage -> (seconds, number of times run)
+        self.totals = {}
+        
+        # The time spent in stages run from within each stage we are in the middle of
+        self.nested = []
+    
+    def startnote(self, note):
+        self.current = note
+    
+    def timed(self, stage, action):
+        self.nested.append(0.0)
+        start = time.time()
+        try:
+            return action()
+        finally:
+            elapsed = time.time() - start
+            nested = self.nested.pop()
+            if len(self.nested) != 0:
+                self.nested[-1] += elapsed
+            
+            self.add(stage, elapsed - nested)
+    
+    def add(self, stage, seconds):
+        notetimings = self.notes.setdefault(self.current, {})
+        notetimings[stage] = notetimings.get(stage, 0.0) + seconds
+        
+        total, count = self.totals.get(stage, (0.0, 0))
+        self.totals[stage] = (total + seconds, count + 1)
+    
+    def slowest(self, howmany):
+        notetotals = [(sum(timings.values()), note) for note, timings in self.notes.items()]
+        notetotals.sort(reverse=True)
+        return [(note, total, self.notes[note]) for total, note in notetotals[:howmany]]
+    
+    def report(self, slowest=25):
+        ordered = [stage for stage in stages if stage in self.totals] + sorted([stage for stage in self.totals if stage not in stages])
+        
+        lines = [u"Time spent in each stage, over %d notes:" % len(self.notes), u""]
+        for stage in ordered:
+            total, count = self.totals[stage]
+            lines.append(u"%-20s %10.3fs %8d times %10.3fms each" % (stage, total, count, 1000.0 * total / count))
+        lines.append(u"%-20s %10.3fs" % ("total", sum([total for total, count in self.totals.values()])))
+        
+        lines.extend([u"", u"The %d slowest notes:" % min(slowest, len(self.notes)), u""])
+        for note, total, timings in self.slowest(slowest):
+            breakdown = u", ".join([u"%s %.1fms" % (stage, 1000.0 * timings[stage]) for stage in ordered if stage in timings])
+            lines.append(u"%10.1fms  %s: %s" % (1000.0 * total, note, breakdown))
+        
+        return u"\n".join(lines) + u"\n"
+    
+    def write(self, path):
+        log.info("Writing the timings of %d notes to %s", len(self.notes), path)
+        reportfile = codecs.open(path, "w", "utf-8")
+        try:
+            reportfile.write(self.report())
+        finally:
+            reportfile.close()
+
+# The timings being recorded by each thread right now, if any. NB: per thread, so that work done on
+# other threads in the meantime (e.g. updates when the user moves between fields) isn't counted
+recorders = threading.local()
+
+def recorder():
+    return getattr(recorders, "timings", None)
+
+"""
+Runs the action with the given timings recording the stages run by it on this thread. Timings
+can be None, in which case nothing is recorded.
+"""
+def recording(timings, action):
+    previous, recorders.timings = recorder(), timings
+    try:
+        return action()
+    finally:
+        recorders.timings = previous
+
+"""
+Hands the action to the run function to do on another thread while this one waits, recording
+what it does in the timings this thread is recording. This thread records nothing meanwhile,
+as anything it does while it waits (e.g. handling UI events) has nothing to do with the action.
+"""
+def elsewhere(run, action):
+    timings = recorder()
+    return recording(None, lambda: run(lambda: recording(timings, action)))
+
+def startnote(note):
+    timings = recorder()
+    if timings is not None:
+        timings.startnote(note)
+
+"""
+Runs the action, putting the time it takes down to the stage if we are recording timings.
+"""
+def timed(stage, action):
+    timings = recorder()
+    if timings is None:
+        return action()
+    
+    return timings.timed(stage, action)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+
+import config
+import utils
+from logger import log
+
+
+"""
+Remembers values we have generated between sessions, in a SQLite database. Keys are any tuple of
+things with a stable repr (e.g. the expression, and fingerprints of the dictionary and settings
+the value was made with), and values are unicode strings or None.
+
+Once it holds more than maxentries values, the ones that have gone unused the longest are thrown
+away, a tenth of them at a time so that we don't have to do it on every put.
+
+It can be used from several threads, and by several processes at once: each process opens its
+own connection to the database. So that we don't keep others waiting to write, we never leave a
+transaction open between calls, and note down that entries were used a batch at a time.
+"""
+class ResultCache(object):
+    def __init__(self, path=":memory:", maxentries=50000):
+        self.path = path
+        self.maxentries = maxentries
+        
+        self.lock = threading.RLock()
+        self.connection, self.pid = None, None
+        
+        # Each use of an entry gets the next tick, so we know which to evict first
+        self.tick = 0
+        self.count = 0
+        
+        # (tick, key) for the uses we haven't written down yet
+        self.touched = []
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return self.withconnection(lambda connection: self.count)
+    
+    def digest(self, key):
+        return utils.md5(config.canonicalrepr(key).encode("utf-8"))
+    
+    """
+    The value remembered for the key, or the default if we don't have one.
+    """
+    def get(self, key, default=None):
+        def do(connection):
+            digest = self.digest(key)
+            row = connection.execute("select value from results where key = ?", (digest,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            self.tick += 1
+            self.touched.append((self.tick, digest))
+            if len(self.touched) >= 100:
+                self.writetouched(connection)
+                connection.commit()
+            
+            return row
+        
+        result = self.withconnection(do)
+        if result is None:
+            return default
+        
+        return result[0]
+    
+    def put(self, key, value):
+        def do(connection):
+            digest = self.digest(key)
+            self.tick += 1
+            if connection.execute("select 1 from results where key = ?", (digest,)).fetchone() is None:
+                self.count += 1
+            connection.execute("insert or replace into results (key, value, used) values (?, ?, ?)", (digest, value, self.tick))
+            self.writetouched(connection)
+            
+            if self.count > self.maxentries:
+                self.evict(connection, self.count - self.maxentries + self.maxentries // 10)
+            
+            connection.commit()
+        
+        self.withconnection(do)
+    
+    def writetouched(self, connection):
+        connection.executemany("update results set used = ? where key = ?", self.touched)
+        self.touched = []
+    
+    def evict(self, connection, howmany):
+        log.info("Evicting the %d least recently used entries from the result cache", howmany)
+        connection.execute("delete from results where key in (select key from results order by used limit ?)", (howmany,))
+        self.count = connection.execute("select count(*) from results").fetchone()[0]
+        self.evictions += howmany
+    
+    def flush(self):
+        def do(connection):
+            self.writetouched(connection)
+            connection.commit()
+        
+        self.withconnection(do)
+    
+    def report(self):
+        # NB: other processes may have added entries too, so ask the database how many there are
+        lookups = self.hits + self.misses
+        count = self.withconnection(lambda connection: connection.execute("select count(*) from results").fetchone()[0])
+        return "Result cache: %d hits and %d misses (%.1f%% hit rate), %d entries, %d evicted" % \
+                 (self.hits, self.misses, lookups and 100.0 * self.hits / lookups or 0.0, count or 0, self.evictions)
+    
+    def withconnection(self, action):
+        self.lock.acquire()
+        try:
+            try:
+                if self.connection is None or self.pid != os.getpid():
+                    self.connect()
+                
+                return action(self.connection)
+            except sqlite3.Error, e:
+                # We can always generate the values again, so this is no reason to stop
+                log.exception("Error while using the result cache at %s", self.path)
+                return None
+        finally:
+            self.lock.release()
+    
+    def connect(self):
+        try:
+            self.open()
+        except sqlite3.DatabaseError, e:
+            log.exception("The result cache at %s is damaged, so we will start it afresh", self.path)
+            if self.path != ":memory:" and os.path.exists(self.path):
+                os.remove(self.path)
+            self.open()
+    
+    def open(self):
+        # NB: we never close the connection we might have inherited from another process, as it is still theirs
+        self.connection, self.pid = sqlite3.connect(self.path, timeout=10, check_same_thread=False), os.getpid()
+        
+        # This is only a cache, so it's not worth waiting for the disk to be sure that it is written
+        self.connection.execute("pragma synchronous = off")
+        self.connection.execute("create table if not exists results (key text primary key, value text, used integer)")
+        self.connection.execute("create index if not exists results_used on results (used)")
+        self.connection.commit()
+        
+        self.tick = self.connection.execute("select coalesce(max(used), 0) from results").fetchone()[0]
+        self.count = self.connection.execute("select count(*) from results").fetchone()[0]
+        log.info("Opened the result cache at %s, holding %d entries", self.path, self.count)
@@ -3,6 +3,7 @@
 
 import time
 
+import characters
 import utils
 
 # Defines the HSK grade character
@@ -78,7 +79,7 @@ hanzi500sTrad = [
 hanziGrades = [grade for grade, _ in hanziByGrades]
 
 def hanziGrade(hanzi):
-    if not utils.isHanzi(hanzi):
+    if not characters.ishanzi(hanzi):
         return None
     
     for grade, hanzis in hanziByGrades:
@@ -1,13 +1,18 @@
 import unittest
 
+from bulkfill import *
+from characters import *
 from config import *
 from dictionary import *
 from dictionaryonline import *
 from factproxy import *
+from focusupdates import *
 from meanings import *
 from media import *
 from model import *
 from numberutils import *
+from profiling import *
+from resultcache import *
 from statistics import *
 from transformations import *
 from updater import *
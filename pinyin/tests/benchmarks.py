@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+
+# Rough timings for the hot paths of the Toolkit. These are not unit tests, so they
+# are deliberately left out of alltests. Run all of them, or just the named ones, with:
+#   python pinyin/tests/benchmarks.py [name ...]
+
+import codecs
+import os
+import re
+import sys
+import time
+import unicodedata
+
+import pinyin.bulkfill
+import pinyin.characters
+from pinyin.config import Config, canonicalrepr
+from pinyin.model import *
+import pinyin.dictionary
+import pinyin.factproxy
+import pinyin.media
+import pinyin.mocks
+import pinyin.resultcache
+import pinyin.statistics
+import pinyin.transformations
+import pinyin.updater
+import pinyin.utils
+
+
+def timeit(what, action, repeat=5):
+    # Report the best of several runs, which is the least noisy number we can get
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        action()
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+
+    print "%-60s %8.2fms" % (what, best * 1000)
+    return best
+
+def longcolorizedreading(syllables=2000):
+    colors = [u"#ff0000", u"#ffaa00", u"#00aa00", u"#0000ff", u"#545454"]
+    words = []
+    for n in range(syllables):
+        tone = (n / 3) % 5 + 1
+        words.append(Word(Pinyin(u"zhuang", tone, { "color" : colors[tone - 1] })))
+        words.append(Word(Text(u" ")))
+
+    return words
+
+def sampledeck():
+    # Every HSK Basic character as a note of its own, plus each line of a graded reading
+    expressions = list(pinyin.statistics.hanziByGrades[0][1])
+    
+    reading = codecs.open(pinyin.utils.toolkitdir("pinyin", "Readings", "Iowa-Beg-2.u8"), "r", encoding="utf-8")
+    try:
+        expressions.extend([line.strip() for line in reading if line.strip() != u""])
+    finally:
+        reading.close()
+    
+    return expressions
+
+englishdict = pinyin.utils.Thunk(lambda: pinyin.dictionary.PinyinDictionary.loadall()('en'))
+
+def benchmarkflatten():
+    words = longcolorizedreading()
+    timeit("flatten, long colorized reading", lambda: flatten(words))
+    timeit("flatten, long colorized reading, tonified", lambda: flatten(words, tonify=True))
+    timeit("flatten, long colorized reading, coalesced", lambda: flatten(words, coalesce=True))
+
+def benchmarkcompacthtml():
+    expressions = sampledeck()
+    readings = [pinyin.transformations.tonesandhi(englishdict().reading(expression)) for expression in expressions]
+    tonedchars = [pinyin.transformations.tonesandhi(englishdict().tonedchars(expression)) for expression in expressions]
+    
+    basesize = None
+    for description, settings in [("inline styles", {}),
+                                  ("merged spans", { "compactcoloredhtml" : True }),
+                                  ("merged spans and classes", { "compactcoloredhtml" : True, "usetonecolorclasses" : True })]:
+        config = Config(settings)
+        render = lambda: [pinyin.updater.preparetokens(config, reading) for reading in readings] + \
+                         [pinyin.updater.flattentokens(config, pinyin.transformations.colorize(config.tonecolors, chars)) for chars in tonedchars]
+        
+        timeit("reading and color fields for %d notes, %s" % (len(expressions), description), render)
+        size = sum([len(field.encode("utf-8")) for field in render()])
+        if basesize is None:
+            basesize = size
+        
+        print "%-60s %8d bytes (%.1f%% saved)" % ("", size, 100.0 * (basesize - size) / basesize)
+
+def benchmarksegmentation():
+    text = u" ".join([u"nihao", u"wo3xi3huan1", u"xuexi", u"Han4yu3", u"yidianr", u"Bei3jing1", u"xiexie3ni"] * 200)
+    runon = text.replace(u" ", u"")
+    
+    # The greedy regex alternation most people reach for first: it can't backtrack, so it is not
+    # actually correct, but it gives us something to compare the segmenter against
+    syllables = sorted(Pinyin.validpinyin, key=len, reverse=True)
+    regex = re.compile(u"(?:%s)[1-5]?" % u"|".join(syllables), re.IGNORECASE | re.UNICODE)
+    
+    timeit("tokenize, %d space seperated runs, no segmentation" % len(text.split()), lambda: tokenize(text))
+    timeit("tokenize, %d space seperated runs, segmented" % len(text.split()), lambda: tokenize(text, segment=True))
+    timeit("regex alternation, one %d character run" % len(runon), lambda: regex.findall(runon))
+    timeit("segmenter, one %d character run" % len(runon), lambda: pinyinsegmenter().segment(runon))
+
+def benchmarkcharacters():
+    # About a million characters of realistic field content: hanzi, pinyin, punctuation and markup
+    deck = u"".join([expression + u"，" + flatten(englishdict().reading(expression)) + u"<br />" for expression in sampledeck()])
+    text = (deck * (1000000 / len(deck) + 1))[:1000000]
+    punctuation = u"，。！？《》、“”.,!?()"
+    punctuation = (punctuation * (1000000 / len(punctuation) + 1))[:1000000]
+    
+    # What we used to do: look up the character name in the Unicode database
+    def namedhanzi(char):
+        try:
+            return unicodedata.name(char).find('CJK UNIFIED IDEOGRAPH') >= 0
+        except ValueError:
+            return False
+    
+    timeit("hanzi by character name, %d characters" % len(text), lambda: [char for char in text if namedhanzi(char)], repeat=1)
+    timeit("hanzi by range table, %d characters" % len(text), lambda: [char for char in text if pinyin.characters.ishanzi(char)], repeat=1)
+    timeit("hanzi by bulk filterhanzi, %d characters" % len(text), lambda: pinyin.characters.filterhanzi(text))
+    timeit("punctuation by category, %d characters" % len(punctuation), lambda: [char for char in punctuation if 'P' not in unicodedata.category(char)], repeat=1)
+    timeit("punctuation by range table, %d characters" % len(punctuation), lambda: [char for char in punctuation if not pinyin.characters.ispunctuationcharacter(char)], repeat=1)
+    timeit("punctuation by bulk ispunctuation, %d characters" % len(punctuation), lambda: pinyin.characters.ispunctuation(punctuation))
+
+def benchmarksandhi():
+    sentences = [englishdict().reading(expression) for expression in sampledeck()]
+    passage = [word for sentence in sentences for word in sentence]
+    
+    timeit("tone sandhi, one passage of %d words" % len(passage), lambda: pinyin.transformations.tonesandhi(passage))
+    timeit("tone sandhi, %d sentences one at a time" % len(sentences), lambda: [pinyin.transformations.tonesandhi(sentence) for sentence in sentences])
+    timeit("tone sandhi, %d sentences as a batch" % len(sentences), lambda: pinyin.transformations.tonesandhibatch(sentences))
+
+def benchmarkrender():
+    expressions = sampledeck()
+    readings = [englishdict().reading(expression) for expression in expressions]
+    tonedchars = [englishdict().tonedchars(expression) for expression in expressions]
+    config = Config({ "tonedisplay" : "tonified" })
+    
+    def multistep():
+        for chars in tonedchars:
+            pinyin.updater.flattentokens(config, pinyin.transformations.colorize(config.tonecolors, pinyin.transformations.tonesandhi(chars)))
+        for reading in readings:
+            flatten(pinyin.transformations.colorize(config.tonecolors, pinyin.transformations.tonesandhi(reading)), tonify=True)
+    
+    def fused():
+        for chars in tonedchars:
+            pinyin.updater.flattentokens(config, chars, colorlist=config.tonecolors, sandhi=True)
+        for reading in readings:
+            pinyin.updater.preparetokens(config, reading, sandhi=True)
+    
+    timeit("color and reading fields for %d notes, multi-step" % len(expressions), multistep)
+    timeit("color and reading fields for %d notes, fused" % len(expressions), fused)
+
+def benchmarkpalette():
+    # A bulk reformat of the reading and color fields of the whole sample deck
+    expressions = sampledeck()
+    readings = [englishdict().reading(expression) for expression in expressions]
+    tonedchars = [englishdict().tonedchars(expression) for expression in expressions]
+    config = Config({ "tonedisplay" : "tonified", "compactcoloredhtml" : True })
+    
+    def reformat():
+        for chars in tonedchars:
+            pinyin.updater.flattentokens(config, chars, colorlist=config.tonecolors, sandhi=True)
+        for reading in readings:
+            pinyin.updater.preparetokens(config, reading, sandhi=True)
+    
+    # Start from scratch, as if the user had just saved their preferences
+    pinyin.transformations.tonepalettes.clear()
+    before = pinyin.transformations.colorwork.copy()
+    timeit("reformat of color and reading fields for %d notes" % len(expressions), reformat, repeat=1)
+    work = dict([(key, pinyin.transformations.colorwork[key] - before[key]) for key in before])
+    
+    # Before we had palettes, every sandhied token meant converting its color afresh (and logging about it)
+    sandhied = len([tone for words in pinyin.transformations.tonesandhibatch(tonedchars + readings) for word in words for tone in word
+                    if not isinstance(tone, Text) and tone.toneinfo.spoken != tone.toneinfo.written])
+    print "%-60s %8d" % ("tokens colored", work["colored"])
+    print "%-60s %8d" % ("palettes built", work["palettes"])
+    print "%-60s %8d" % ("colors sandhified, with palettes", work["sandhifications"])
+    print "%-60s %8d" % ("colors sandhified, one per sandhied token", sandhied)
+    print "%-60s %8d" % ("color log lines, with palettes", work["palettes"] + work["sandhifications"])
+    print "%-60s %8d" % ("color log lines, one per word plus one per sandhied token", sum([len(words) for words in tonedchars + readings]) + sandhied)
+
+def benchmarkmasking():
+    # What we used to do: replace every hanzi substring of the expression, longest first, in every Text token
+    class ReplaceSubstringsVisitor(TokenVisitor):
+        def __init__(self, expression):
+            self.expression = expression
+        
+        def visitText(self, text):
+            for substring in pinyin.utils.substrings(self.expression):
+                if pinyin.characters.isallhanzi(substring):
+                    text = text.replace(substring, u"~")
+            return Text(text)
+        
+        def visitPinyin(self, pinyin):
+            return pinyin
+        
+        def visitTonedCharacter(self, tonedcharacter):
+            return tonedcharacter
+    
+    def replacesubstrings(expression, meanings):
+        return [[word.map(ReplaceSubstringsVisitor(expression)) for word in meaning] for meaning in meanings]
+    
+    def masker(expression, meanings):
+        masker = pinyin.transformations.HanziMasker(expression, u"~")
+        return [masker.mask(meaning) for meaning in meanings]
+    
+    # The meanings of every note in the sample deck
+    notes = []
+    for expression in sampledeck():
+        meanings, _measurewords = englishdict().meanings(expression, "simp")
+        notes.append((expression, meanings or []))
+    
+    # A long expression with verbose definitions that quote it, and parts of it, several times
+    expression = u"孩子问妈妈我什么时候过生日"
+    definitions = [[Word(Text(u"the child asked: "), Text(expression), Text(u" (%s), " % expression[:n]), Text(expression[n:]), Text(u"!"))] for n in range(len(expression))] * 20
+    
+    for description, mask in [("replacing substrings", replacesubstrings), ("masker", masker)]:
+        timeit("mask meanings for %d notes, %s" % (len(notes), description), lambda: [mask(expression, meanings) for expression, meanings in notes])
+        timeit("mask %d verbose definitions, %s" % (len(definitions), description), lambda: mask(expression, definitions))
+
+def benchmarkaudiopacks():
+    # Ten installed packs, each of them missing a different scattering of the syllables
+    packs = []
+    for n in range(10):
+        media = {}
+        for i, syllable in enumerate(sorted(Pinyin.validpinyin)):
+            for tone in range(1, 5):
+                if (i * 4 + tone) % (n + 11) != 0:
+                    filename = syllable.replace(u"ü", u"v") + str(tone) + [".mp3", ".ogg"][n % 2]
+                    media[filename] = filename
+        packs.append(pinyin.media.MediaPack("Pack %d" % n, media))
+    
+    readings = [englishdict().reading(expression) for expression in sampledeck()]
+    
+    # What we used to do: run the fallback rules for every syllable against every pack in turn
+    def probeeverypack(reading):
+        bestmissingcount, bestpack = None, None
+        for pack in packs:
+            missingcount = 0
+            for word in pinyin.transformations.trimerhua(reading):
+                for token in pinyin.transformations.trimerhua([word])[0]:
+                    if not isinstance(token, Pinyin):
+                        continue
+                    
+                    possiblebases = [token.numericformat(hideneutraltone=False, tone="spoken")]
+                    substitutions = waysToSubstituteAwayUUmlaut(token.word)
+                    if token.toneinfo.spoken == 5:
+                        possiblebases.extend([token.word, token.word + '4'])
+                    elif substitutions is not None:
+                        possiblebases.extend([substitution + str(token.toneinfo.spoken) for substitution in substitutions])
+                    
+                    if not [() for possiblebase in possiblebases if pack.mediafor(possiblebase, [".mp3", ".ogg"])]:
+                        missingcount += 1
+            
+            if bestmissingcount is None or missingcount < bestmissingcount:
+                bestmissingcount, bestpack = missingcount, pack
+        
+        return bestpack
+    
+    timeit("choose from %d packs for %d readings, probing every pack" % (len(packs), len(readings)), lambda: [probeeverypack(reading) for reading in readings])
+    
+    for pack in packs:
+        pack.coverages.clear()
+    timeit("choose from %d packs for %d readings, coverage index, cold" % (len(packs), len(readings)),
+           lambda: [pinyin.transformations.PinyinAudioReadings(packs, [".mp3", ".ogg"]).audioreading(reading) for reading in readings], repeat=1)
+    timeit("choose from %d packs for %d readings, coverage index" % (len(packs), len(readings)),
+           lambda: [pinyin.transformations.PinyinAudioReadings(packs, [".mp3", ".ogg"]).audioreading(reading) for reading in readings])
+
+def benchmarkmediapacks():
+    # Ten installed packs of two thousand sounds each, asked for once per note of a bulk fill
+    def do(mediadir):
+        for n in range(10):
+            packpath = os.path.join(mediadir, "Pack %d" % n)
+            os.mkdir(packpath)
+            for i in range(2000):
+                pinyin.utils.touch(os.path.join(packpath, "sound%d.mp3" % i))
+        
+        notes = 100
+        registry = pinyin.media.MediaPackRegistry()
+        timeit("discover %d packs for %d notes, listing every pack" % (10, notes),
+               lambda: [pinyin.media.MediaPackRegistry().discovermediapacks(mediadir) for _ in range(notes)], repeat=1)
+        timeit("discover %d packs for %d notes, registry" % (10, notes),
+               lambda: [registry.discovermediapacks(mediadir) for _ in range(notes)], repeat=1)
+    
+    pinyin.utils.withtempdir(do)
+
+def benchmarklegacymedia():
+    # What we used to do: pluck each indexed file out of the directory listing in turn
+    def removeeach(mediadircontents, mediaindex):
+        mediadircontents = [os.path.normcase(mediadircontent) for mediadircontent in mediadircontents]
+        for orig_path, filename in mediaindex:
+            try:
+                mediadircontents.remove(os.path.normcase(filename))
+            except ValueError:
+                continue
+        
+        return mediadircontents
+    
+    # A synthetic media directory where nine in ten files came in through the media database
+    def mediadirectory(files):
+        mediadircontents = ["%s.mp3" % pinyin.utils.md5(str(n)) for n in range(files)]
+        mediaindex = [("sound%d.mp3" % n, filename) for n, filename in enumerate(mediadircontents) if n % 10 != 0]
+        mediaindex.reverse()
+        return mediadircontents, mediaindex
+    
+    mediadircontents, mediaindex = mediadirectory(5000)
+    timeit("legacy media among %d files, removing each" % len(mediadircontents), lambda: removeeach(mediadircontents, mediaindex), repeat=1)
+    timeit("legacy media among %d files, sets" % len(mediadircontents), lambda: pinyin.media.discoverlegacymedia(mediadircontents, mediaindex))
+    
+    mediadircontents, mediaindex = mediadirectory(50000)
+    timeit("legacy media among %d files, sets" % len(mediadircontents), lambda: pinyin.media.discoverlegacymedia(mediadircontents, mediaindex))
+    index = pinyin.media.MediaIndex(mediaindex)
+    timeit("legacy media among %d files, prebuilt index" % len(mediadircontents), lambda: pinyin.media.discoverlegacymedia(mediadircontents, index))
+
+def benchmarkconcatenation():
+    # A pack with a sound for every syllable, each as big as our bit of silence
+    def do(mediadir):
+        packpath = os.path.join(mediadir, "Pack")
+        os.mkdir(packpath)
+        clip = open(pinyin.updater.silencepath, "rb").read()
+        for syllable in [syllable.replace(u"ü", u"v") for syllable in Pinyin.validpinyin if u"ê" not in syllable]:
+            for tone in range(1, 6):
+                file = open(os.path.join(packpath, syllable + str(tone) + ".mp3"), "wb")
+                file.write(clip)
+                file.close()
+        
+        mediamanager = pinyin.mocks.MockMediaManager([pinyin.media.MediaPack.frompath(packpath)], themediadir=mediadir)
+        # The sample deck is mostly single characters, so make up some longer notes from neighbouring ones
+        expressions = sampledeck()
+        readings = [englishdict().reading(expression) for expression in expressions + [a + b for a, b in zip(expressions, expressions[1:])]]
+        
+        # Only readings of more than one syllable have anything to join up
+        separate = Config({ "audioextensions" : [".mp3"] })
+        readings = [reading for reading in readings if pinyin.updater.generateaudio(pinyin.mocks.NullNotifier(), mediamanager, separate, reading).count("[sound:") > 1]
+        for description, settings in [("one sound per syllable", {}), ("concatenated", { "concatenateaudio" : True })]:
+            config = Config(pinyin.utils.updated({ "audioextensions" : [".mp3"] }, settings))
+            generate = lambda: [pinyin.updater.generateaudio(pinyin.mocks.NullNotifier(), mediamanager, config, reading) for reading in readings]
+            
+            timeit("audio for %d notes, %s, first time" % (len(readings), description), generate, repeat=1)
+            timeit("audio for %d notes, %s, again" % (len(readings), description), generate)
+            
+            files = sum([output.count("[sound:") for output in generate()])
+            print "%-60s %8d" % ("files played", files)
+            print "%-60s %8.2f" % ("files played per note", float(files) / len(readings))
+    
+    pinyin.utils.withtempdir(do)
+
+def benchmarkbulkfill():
+    # A synthetic collection of 20k notes, whose expressions are drawn from the sample deck
+    expressions = sampledeck()
+    def collection(size):
+        notes = {}
+        for n in range(size):
+            notes[n] = pinyin.mocks.MockNote({ "Expression" : expressions[n % len(expressions)], "Reading" : u"", "Meaning" : u"", "Color" : u"", "MW" : u"" })
+        
+        return pinyin.mocks.MockCollection(notes)
+    
+    config = Config({ "fallbackongoogletranslate" : False, "audiogeneration" : False, "mwaudiogeneration" : False, "weblinkgeneration" : False })
+    updater = pinyin.updater.FieldUpdaterFromExpression(pinyin.mocks.NullNotifier(), pinyin.mocks.MockMediaManager([]), config)
+    updater.updatefact({ "expression" : u"书", "reading" : u"" }, u"书")
+    
+    # Every note needs a fact proxy, whose mapping from keys to fields only depends on the model
+    proxied = collection(20000).notes.values()
+    def proxies(remember):
+        for note in proxied:
+            if not(remember):
+                pinyin.factproxy.fieldmappings.clear()
+            pinyin.factproxy.FactProxy(config.candidateFieldNamesByKey, note)
+    
+    timeit("make fact proxies for %d notes, choosing fields every time" % len(proxied), lambda: proxies(False), repeat=1)
+    timeit("make fact proxies for %d notes, remembering fields per model" % len(proxied), lambda: proxies(True), repeat=1)
+    
+    # What we used to do: update and flush the notes one at a time
+    def notebynote(collection):
+        for noteid in range(len(collection.notes)):
+            note = collection.getNote(noteid)
+            factproxy = pinyin.factproxy.FactProxy(config.candidateFieldNamesByKey, note)
+            if "expression" not in factproxy:
+                continue
+            
+            updater.updatefact(factproxy, factproxy["expression"])
+            note.flush()
+    
+    def bulkfill(collection):
+        result = pinyin.bulkfill.BulkFill(config.candidateFieldNamesByKey, updater, "expression").run(collection, range(len(collection.notes)))
+        print result.summarize()
+    
+    # Going note by note takes minutes for the whole collection, so just try a tenth of it
+    for description, fill, size in [("note by note", notebynote, 2000), ("bulk fill", bulkfill, 2000), ("bulk fill", bulkfill, 20000)]:
+        filled = collection(size)
+        timeit("fill %d notes with %d distinct expressions, %s" % (len(filled.notes), len(set(expressions)), description), lambda: fill(filled), repeat=1)
+        print "%-60s %8d" % ("collection saves", filled.saves)
+        print "%-60s %8d" % ("notes flushed", sum([note.flushes for note in filled.notes.values()]))
+    
+    # Filling in again should find nothing to do
+    timeit("fill the same %d notes again, bulk fill" % len(filled.notes), lambda: bulkfill(filled), repeat=1)
+    print "%-60s %8d" % ("notes flushed", sum([note.flushes for note in filled.notes.values()]))
+    
+    # An incremental fill only has to look at the notes modified since the one before
+    incremental = pinyin.bulkfill.IncrementalBulkFill(pinyin.bulkfill.BulkFill(config.candidateFieldNamesByKey, updater, "expression"), pinyin.bulkfill.Watermarks(), "benchmark", config.fingerprint())
+    def incrementalfill(collection):
+        modifiedsince = lambda noteids, since: [(noteid, collection.notes[noteid].mod) for noteid in noteids if collection.notes[noteid].mod >= since]
+        result = incremental.run(collection, range(len(collection.notes)), modifiedsince)
+        print result.summarize()
+        return result
+    
+    result = incrementalfill(filled)
+    
+    modified = range(0, len(filled.notes), 100)
+    for noteid in modified:
+        filled.notes[noteid]["Reading"] = u""
+        filled.notes[noteid].mod = result.watermark + 1
+    
+    timeit("fill the %d of %d notes modified since, incremental fill" % (len(modified), len(filled.notes)), lambda: incrementalfill(filled), repeat=1)
+
+def benchmarkbulkfillworkers():
+    # Every note is of a different kind, so that nearly all the time goes on running the updater
+    expressions = sampledeck()
+    config = Config({ "fallbackongoogletranslate" : False, "audiogeneration" : False, "mwaudiogeneration" : False, "weblinkgeneration" : False })
+    updater = pinyin.updater.FieldUpdaterFromExpression(pinyin.mocks.NullNotifier(), pinyin.mocks.MockMediaManager([]), config)
+    updater.updatefact({ "expression" : u"书", "reading" : u"" }, u"书")
+    
+    filled = {}
+    for workers in range(1, 9):
+        collection = pinyin.mocks.MockCollection(dict([(n, pinyin.mocks.MockNote({ "Expression" : expression, "Reading" : u"", "Meaning" : u"", "Color" : u"", "MW" : u"" })) for n, expression in enumerate(expressions)]))
+        bulkfill = pinyin.bulkfill.BulkFill(config.candidateFieldNamesByKey, updater, "expression", workers=workers)
+        timeit("fill %d notes with %d workers" % (len(collection.notes), workers), lambda: bulkfill.run(collection, range(len(collection.notes))), repeat=1)
+        filled[workers] = [dict(note) for noteid, note in sorted(collection.notes.items())]
+    
+    print "%-60s %8d" % ("worker counts giving different notes to 1 worker", len([workers for workers in filled if filled[workers] != filled[1]]))
+
+def benchmarkresultcache():
+    expressions = sampledeck()
+    config = Config({ "fallbackongoogletranslate" : False, "audiogeneration" : False, "mwaudiogeneration" : False, "weblinkgeneration" : False })
+    
+    def fill(updater):
+        for expression in expressions:
+            updater.updatefact({ "expression" : expression, "reading" : u"", "meaning" : u"", "color" : u"", "mw" : u"" }, expression)
+    
+    def do(tempdir):
+        updaters = []
+        for cache in [None, pinyin.resultcache.ResultCache(os.path.join(tempdir, "resultcache.db")), pinyin.resultcache.ResultCache(os.path.join(tempdir, "resultcache.db"))]:
+            updater = pinyin.updater.FieldUpdaterFromExpression(pinyin.mocks.NullNotifier(), pinyin.mocks.MockMediaManager([]), config, cache)
+            updater.updatefact({ "expression" : u"书", "reading" : u"" }, u"书")
+            updaters.append(updater)
+        
+        # NB: the third updater opens the cache afresh, as if in a later session
+        timeit("fill %d expressions, no cache" % len(expressions), lambda: fill(updaters[0]), repeat=1)
+        timeit("fill %d expressions, empty cache" % len(expressions), lambda: fill(updaters[1]), repeat=1)
+        timeit("fill %d expressions, cache from an earlier session" % len(expressions), lambda: fill(updaters[2]), repeat=1)
+        print updaters[2].cache.report()
+    
+    pinyin.utils.withtempdir(do)
+
+def benchmarkcompiledconfig():
+    config = Config()
+    meanings = [u"meaning %d" % n for n in range(1, 6)]
+    
+    def use(config):
+        for _ in range(20000):
+            config.shouldtonify, config.colorizedpinyingeneration and config.tonecolors, config.compactcoloredhtml
+            config.formathanzimaskingcharacter()
+            config.formatmeanings(meanings)
+    
+    timeit("read and format with the settings 20000 times, live config", lambda: use(config))
+    timeit("read and format with the settings 20000 times, compiled snapshot", lambda: use(config.compiled()))
+    timeit("fingerprint the settings 2000 times, recomputing it", lambda: [pinyin.utils.md5(canonicalrepr(config.settings)) for _ in range(2000)])
+    timeit("fingerprint the settings 2000 times, compiled snapshot", lambda: [config.fingerprint() for _ in range(2000)])
+
+benchmarks = [
+    ("flatten", benchmarkflatten),
+    ("compacthtml", benchmarkcompacthtml),
+    ("segmentation", benchmarksegmentation),
+    ("characters", benchmarkcharacters),
+    ("sandhi", benchmarksandhi),
+    ("render", benchmarkrender),
+    ("palette", benchmarkpalette),
+    ("masking", benchmarkmasking),
+    ("audiopacks", benchmarkaudiopacks),
+    ("mediapacks", benchmarkmediapacks),
+    ("legacymedia", benchmarklegacymedia),
+    ("concatenation", benchmarkconcatenation),
+    ("bulkfill", benchmarkbulkfill),
+    ("bulkfillworkers", benchmarkbulkfillworkers),
+    ("resultcache", benchmarkresultcache),
+    ("compiledconfig", benchmarkcompiledconfig)
+  ]
+
+if __name__ == '__main__':
+    for name, benchmark in benchmarks:
+        if len(sys.argv) <= 1 or name in sys.argv[1:]:
+            benchmark()
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+from pinyin.bulkfill import *
+from pinyin.config import Config
+from pinyin.mocks import *
+from pinyin.profiling import NoteTimings
+from pinyin.updater import FieldUpdaterFromExpression, FieldUpdaterFromReading
+
+
+class BulkFillTest(unittest.TestCase):
+    def testFill(self):
+        collection, updater, result = self.fill([{ "Expression" : u"书", "Reading" : u"" }])
+        self.assertEquals(collection.notes[0], { "Expression" : u"书", "Reading" : u"READING OF 书" })
+        self.assertEquals(collection.notes[0].flushes, 1)
+        self.assertEquals((result.scanned, result.changed, result.skipped, result.computed), (1, 1, 0, 1))
+    
+    def testUpdateEachExpressionOnce(self):
+        collection, updater, result = self.fill([{ "Expression" : u"书", "Reading" : u"" } for _ in range(5)] + [{ "Expression" : u"马", "Reading" : u"" }])
+        self.assertEquals(updater.expressions, [u"书", u"马"])
+        self.assertEquals([note["Reading"] for note in collection.notes.values()], [u"READING OF 书"] * 5 + [u"READING OF 马"])
+        self.assertEquals([note.flushes for note in collection.notes.values()], [1] * 6)
+    
+    def testShareUpdatesBetweenBatches(self):
+        collection, updater, result = self.fill([{ "Expression" : u"书", "Reading" : u"" } for _ in range(5)], batchsize=2)
+        self.assertEquals(updater.expressions, [u"书"])
+        self.assertEquals(result.batches, 3)
+        self.assertEquals(collection.saves, 3)
+    
+    def testDontShareBetweenDifferentlyFilledNotes(self):
+        collection, updater, result = self.fill([{ "Expression" : u"书", "Reading" : u"" }, { "Expression" : u"书", "Reading" : u"shu1" }])
+        self.assertEquals(updater.expressions, [u"书", u"书"])
+        self.assertEquals([note["Reading"] for note in collection.notes.values()], [u"READING OF 书", u"shu1"])
+    
+    def testDontShareBetweenBlankExpressions(self):
+        collection, updater, result = self.fill([{ "Expression" : u"", "Reading" : u"" }, { "Expression" : u" ", "Reading" : u"" }, { "Expression" : u"", "Reading" : u"" }])
+        self.assertEquals(updater.expressions, [u"", u" ", u""])
+    
+    def testSkipNotesWithoutField(self):
+        collection, updater, result = self.fill([{ "Meaning" : u"book" }, { "Expression" : u"书", "Reading" : u"" }])
+        self.assertEquals(collection.notes[0], { "Meaning" : u"book" })
+        self.assertEquals(collection.notes[0].flushes, 0)
+        self.assertEquals((result.scanned, result.skipped), (1, 1))
+    
+    def testDontFlushUnchangedNotes(self):
+        collection, updater, result = self.fill([{ "Expression" : u"书", "Reading" : u"" }, { "Expression" : u"书", "Reading" : u"shu1" }, { "Expression" : u"马", "Meaning" : u"" }])
+        self.assertEquals([note.flushes for note in collection.notes.values()], [1, 0, 0])
+        self.assertEquals((result.scanned, result.changed, result.unchanged), (3, 1, 2))
+    
+    def testDontSaveUnchangedBatches(self):
+        collection, updater, result = self.fill([{ "Expression" : u"书", "Reading" : u"shu1" }, { "Expression" : u"书", "Reading" : u"" }], batchsize=1)
+        self.assertEquals(collection.saves, 1)
+    
+    def testDontFlushRewrittenValue(self):
+        collection = MockCollection({ 0 : MockNote({ "Expression" : u"书", "Reading" : u"READING OF 书" }) })
+        class RewritingUpdater(object):
+            def updatefact(self, fact, expression):
+                fact["expression"] = expression
+                fact["reading"] = u"READING OF " + expression
+        
+        result = BulkFill(Config().candidateFieldNamesByKey, RewritingUpdater(), "expression").run(collection, [0])
+        self.assertEquals(collection.notes[0].flushes, 0)
+        self.assertEquals(result.changed, 0)
+    
+    def testDontShareBetweenDifferentlyRewrittenNotes(self):
+        collection = MockCollection({ 0 : MockNote({ "Expression" : u"书", "Reading" : u"READING OF 书" }),
+                                      1 : MockNote({ "Expression" : u"书", "Reading" : u"out of date" }) })
+        class RewritingUpdater(object):
+            rewrittenkeys = ["reading"]
+            
+            def updatefact(self, fact, expression):
+                if fact["reading"] != u"READING OF " + expression:
+                    fact["reading"] = u"READING OF " + expression
+        
+        result = BulkFill(Config().candidateFieldNamesByKey, RewritingUpdater(), "expression").run(collection, [0, 1])
+        self.assertEquals([note["Reading"] for note in collection.notes.values()], [u"READING OF 书", u"READING OF 书"])
+        self.assertEquals((result.computed, result.changed), (2, 1))
+    
+    def testTimings(self):
+        collection, updater, result = self.fill([{ "Expression" : u"书", "Reading" : u"" }])
+        self.assertEquals(sorted(result.timings.keys()), ["compute", "load", "save", "write"])
+        self.assertTrue(result.summarize().startswith("Scanned 1 notes: 1 changed, 0 unchanged, 0 skipped; load "))
+    
+    def testNoteTimings(self):
+        collection = MockCollection(dict([(n, MockNote(note)) for n, note in enumerate([{ "Expression" : u"书", "Reading" : u"" }, { "Expression" : u"马", "Reading" : u"ma3" }])]))
+        timings = NoteTimings()
+        BulkFill(Config().candidateFieldNamesByKey, MockUpdater(), "expression", timings=timings).run(collection, [0, 1])
+        self.assertEquals(timings.notes.keys(), [u"note 0 (书)"])
+        self.assertEquals(timings.totals["flush"][1], 1)
+    
+    def testProgress(self):
+        progress = []
+        self.fill([{ "Expression" : u"书", "Reading" : u"" } for _ in range(5)], batchsize=2, progress=lambda done, total: progress.append((done, total)))
+        self.assertEquals(progress, [(2, 5), (4, 5), (5, 5)])
+    
+    def testCancel(self):
+        collection, updater, result = self.fill([{ "Expression" : u"书", "Reading" : u"" } for _ in range(5)], batchsize=2, progress=lambda done, total: False)
+        self.assertTrue(result.cancelled)
+        self.assertEquals(result.scanned, 2)
+        self.assertEquals([note["Reading"] for note in collection.notes.values()], [u"READING OF 书"] * 2 + [u""] * 3)
+        self.assertEquals(collection.saves, 1)
+    
+    def testRunInBackground(self):
+        threads = []
+        def runinbackground(function):
+            threads.append(threading.currentThread())
+            return function()
+        
+        self.fill([{ "Expression" : u"书", "Reading" : u"" }, { "Expression" : u"马", "Reading" : u"" }], runinbackground=runinbackground)
+        self.assertEquals(len(threads), 1)
+    
+    def testSameAsNoteByNote(self):
+        readings = [u"hen3 hao3", u"ni3hao3", u"hen3 hao3", u"ma3", u"ni3hao3"]
+        config = Config({ "tonedisplay" : "tonified", "colorizedpinyingeneration" : True })
+        
+        collection = MockCollection(dict([(n, MockNote({ "Reading" : reading })) for n, reading in enumerate(readings)]))
+        BulkFill(config.candidateFieldNamesByKey, FieldUpdaterFromReading(config), "reading", "updatefactalways").run(collection, range(len(readings)))
+        
+        for n, reading in enumerate(readings):
+            fact = { "reading" : reading }
+            FieldUpdaterFromReading(config).updatefactalways(fact, reading)
+            self.assertEquals(collection.notes[n]["Reading"], fact["reading"])
+    
+    def testWatermark(self):
+        collection = MockCollection({ 0 : MockNote({ "Expression" : u"书", "Reading" : u"shu1" }), 1 : MockNote({ "Expression" : u"马", "Reading" : u"ma3" }) })
+        collection.notes[0].mod, collection.notes[1].mod = 10, 20
+        result = BulkFill(Config().candidateFieldNamesByKey, MockUpdater(), "expression").run(collection, [0, 1])
+        self.assertEquals((result.watermark, result.atwatermark), (20, set([1])))
+    
+    def testWatermarkIncludesSkippedNotes(self):
+        collection = MockCollection({ 0 : MockNote({ "Expression" : u"书", "Reading" : u"shu1" }), 1 : MockNote({ "Meaning" : u"horse" }), 2 : MockNote({ "Expression" : u"马", "Reading" : u"ma3" }) })
+        collection.notes[0].mod, collection.notes[1].mod, collection.notes[2].mod = 10, 20, 20
+        result = BulkFill(Config().candidateFieldNamesByKey, MockUpdater(), "expression").run(collection, [0, 1, 2])
+        self.assertEquals((result.watermark, result.atwatermark), (20, set([1, 2])))
+    
+    def testRealDictionaryInBackground(self):
+        # NB: look something up on this thread first, so the database is in use by more than one thread
+        def fill(runinbackground):
+            collection = MockCollection({ 0 : MockNote({ "Expression" : u"书", "Reading" : u"", "Meaning" : u"" }) })
+            updater = FieldUpdaterFromExpression(MockNotifier(), MockMediaManager([]), Config({ "dictlanguage" : "en", "fallbackongoogletranslate" : False }))
+            BulkFill(Config().candidateFieldNamesByKey, updater, "expression").run(collection, [0], runinbackground=runinbackground)
+            return collection.notes[0]
+        
+        here = fill(None)
+        self.assertNotEquals(here["Reading"], u"")
+        self.assertEquals(fill(BackgroundRunner()), here)
+    
+    def testWatermarkIncludesOwnWrites(self):
+        collection, updater, result = self.fill([{ "Expression" : u"书", "Reading" : u"" }])
+        self.assertEquals(result.watermark, collection.notes[0].mod)
+        self.assertTrue(result.watermark > 0)
+    
+    # Test helpers
+    def fill(self, notes, batchsize=500, progress=None, runinbackground=None):
+        collection = MockCollection(dict([(n, MockNote(note)) for n, note in enumerate(notes)]))
+        updater = MockUpdater()
+        result = BulkFill(Config().candidateFieldNamesByKey, updater, "expression", batchsize=batchsize).run(collection, range(len(notes)), progress=progress, runinbackground=runinbackground)
+        return collection, updater, result
+
+class MockUpdater(object):
+    def __init__(self):
+        self.expressions = []
+    
+    def updatefact(self, fact, expression):
+        self.expressions.append(expression)
+        if "reading" in fact and fact["reading"].strip() == u"":
+            fact["reading"] = u"READING OF " + expression
+
+class ParallelBulkFillTest(unittest.TestCase):
+    def testSameAsSerial(self):
+        readings = [u"hen3 hao3", u"ni3hao3", u"ma3", u"shu1", u"ren2", u"zhong1guo2"] * 3
+        config = Config({ "tonedisplay" : "tonified", "colorizedpinyingeneration" : True })
+        
+        serial, parallel = [self.fill(config.candidateFieldNamesByKey, FieldUpdaterFromReading(config), "reading", "updatefactalways", [{ "Reading" : reading } for reading in readings], workers) for workers in [1, 2]]
+        self.assertEquals([note["Reading"] for note in parallel.notes.values()], [note["Reading"] for note in serial.notes.values()])
+        self.assertEquals([note.flushes for note in parallel.notes.values()], [1] * len(readings))
+    
+    def testRandomChoicesSameAsSerial(self):
+        notes = [{ "Expression" : unicode(n), "Audio" : u"" } for n in range(20)]
+        serial, parallel = [self.fill(Config().candidateFieldNamesByKey, MockAudioUpdater(MockNotifier(), RecordingMediaManager()), "expression", "updatefact", notes, workers) for workers in [1, 3]]
+        self.assertEquals([note["Audio"] for note in parallel.notes.values()], [note["Audio"] for note in serial.notes.values()])
+    
+    def testRunInWorkers(self):
+        class ProcessUpdater(object):
+            def updatefact(self, fact, expression):
+                fact["reading"] = unicode(os.getpid())
+        
+        collection = self.fill(Config().candidateFieldNamesByKey, ProcessUpdater(), "expression", "updatefact", [{ "Expression" : u"书", "Reading" : u"" }], 2)
+        self.assertNotEquals(collection.notes[0]["Reading"], unicode(os.getpid()))
+    
+    def testDontDisturbRandomState(self):
+        random.seed(1234)
+        expected = random.random()
+        random.seed(1234)
+        self.fill(Config().candidateFieldNamesByKey, MockAudioUpdater(MockNotifier(), RecordingMediaManager()), "expression", "updatefact", [{ "Expression" : u"书", "Audio" : u"" }], 1)
+        self.assertEquals(random.random(), expected)
+    
+    def testNotifyHere(self):
+        notifier = MockNotifier()
+        self.fill(Config().candidateFieldNamesByKey, MockAudioUpdater(notifier, RecordingMediaManager()), "expression", "updatefact", [{ "Expression" : u"书", "Audio" : u"" }, { "Expression" : u"马", "Audio" : u"" }], 2)
+        self.assertEquals(notifier.infos, [u"Filling in audio for 书", u"Filling in audio for 马"])
+    
+    def testImportMediaHere(self):
+        mediamanager = RecordingMediaManager()
+        collection = self.fill(Config().candidateFieldNamesByKey, MockAudioUpdater(MockNotifier(), mediamanager), "expression", "updatefact", [{ "Expression" : u"书", "Audio" : u"" }], 2)
+        self.assertEquals(len(mediamanager.imports), 1)
+        self.assertEquals(collection.notes[0]["Audio"], u"[sound:imported-%s]" % mediamanager.imports[0])
+    
+    def testFillHereIfWorkersFail(self):
+        class BrokenPool(object):
+            def map(self, function, jobs, chunksize):
+                raise IOError("Worker died")
+            
+            def terminate(self):
+                pass
+            
+            def join(self):
+                pass
+        
+        bulkfill = BulkFill(Config().candidateFieldNamesByKey, MockUpdater(), "expression", workers=2)
+        bulkfill.startworkers = lambda: BrokenPool()
+        collection = MockCollection({ 0 : MockNote({ "Expression" : u"书", "Reading" : u"" }) })
+        self.assertEquals(bulkfill.run(collection, [0]).changed, 1)
+        self.assertEquals(collection.notes[0]["Reading"], u"READING OF 书")
+    
+    # Test helpers
+    def fill(self, candidateFieldNamesByKey, updater, field, updatehow, notes, workers):
+        collection = MockCollection(dict([(n, MockNote(note)) for n, note in enumerate(notes)]))
+        BulkFill(candidateFieldNamesByKey, updater, field, updatehow, batchsize=4, workers=workers).run(collection, range(len(notes)))
+        return collection
+
+class MockAudioUpdater(object):
+    def __init__(self, notifier, mediamanager):
+        self.notifier = notifier
+        self.mediamanager = mediamanager
+    
+    def updatefact(self, fact, expression):
+        self.notifier.info(u"Filling in audio for " + expression)
+        fact["audio"] = u"[sound:%s]" % self.mediamanager.importtocurrentdeck(random.choice([u"a.mp3", u"b.mp3", u"c.mp3", u"d.mp3"]))
+
+class RecordingMediaManager(MockMediaManager):
+    def __init__(self):
+        MockMediaManager.__init__(self, [])
+        self.imports = []
+    
+    def importtocurrentdeck(self, filename):
+        self.imports.append(filename)
+        return u"imported-" + filename
+
+class WatermarksTest(unittest.TestCase):
+    def testUnknown(self):
+        self.assertEquals(Watermarks().since("collection", "operation", "fingerprint"), None)
+    
+    def testKnown(self):
+        watermarks = Watermarks()
+        watermarks.update("collection", "operation", "fingerprint", 10, [1, 2])
+        self.assertEquals(watermarks.since("collection", "operation", "fingerprint"), (10, set([1, 2])))
+    
+    def testOtherFingerprint(self):
+        watermarks = Watermarks()
+        watermarks.update("collection", "operation", "fingerprint", 10)
+        self.assertEquals(watermarks.since("collection", "operation", "other fingerprint"), None)
+    
+    def testOtherCollectionOrOperation(self):
+        watermarks = Watermarks()
+        watermarks.update("collection", "operation", "fingerprint", 10)
+        self.assertEquals(watermarks.since("other collection", "operation", "fingerprint"), None)
+        self.assertEquals(watermarks.since("collection", "other operation", "fingerprint"), None)
+    
+    def testPersist(self):
+        path = tempfile.mktemp()
+        try:
+            Watermarks(path).update("collection", "operation", "fingerprint", 10, [1])
+            self.assertEquals(Watermarks(path).since("collection", "operation", "fingerprint"), (10, set([1])))
+        finally:
+            os.remove(path)
+    
+    def testFilled(self):
+        watermarks = Watermarks()
+        watermarks.update("collection", "operation", "fingerprint", 10)
+        self.assertEquals(watermarks.filled("collection", "operation", "fingerprint"), None)
+        watermarks.update("collection", "operation", "fingerprint", 10, [1], [1, 2, 3])
+        self.assertEquals(watermarks.filled("collection", "operation", "fingerprint"), set([1, 2, 3]))
+        self.assertEquals(watermarks.filled("collection", "operation", "other fingerprint"), None)
+    
+    def testIgnoreCorruptFile(self):
+        path = tempfile.mktemp()
+        try:
+            open(path, "wb").write("rubbish")
+            self.assertEquals(Watermarks(path).since("collection", "operation", "fingerprint"), None)
+        finally:
+            os.remove(path)
+
+class IncrementalBulkFillTest(unittest.TestCase):
+    def testFillEverythingFirstTime(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        self.fill(collection, updater, watermarks)
+        self.assertEquals(updater.expressions, [u"书", u"马"])
+        self.assertEquals(watermarks.since("collection", ("expression", "updatefact"), "fingerprint"), (20, set([1])))
+    
+    def testOnlyFillModifiedNotes(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        watermarks.update("collection", ("expression", "updatefact"), "fingerprint", 15)
+        result = self.fill(collection, updater, watermarks)
+        self.assertEquals(updater.expressions, [u"马"])
+        self.assertEquals(result.total, 1)
+        self.assertEquals(watermarks.since("collection", ("expression", "updatefact"), "fingerprint"), (20, set([1])))
+    
+    def testFillUnseenNotesModifiedAtWatermark(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        collection.notes[0].mod = 20
+        watermarks.update("collection", ("expression", "updatefact"), "fingerprint", 20, [1])
+        self.fill(collection, updater, watermarks)
+        self.assertEquals(updater.expressions, [u"书"])
+        self.assertEquals(watermarks.since("collection", ("expression", "updatefact"), "fingerprint"), (20, set([0, 1])))
+    
+    def testKeepWatermarkIfNothingModified(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        watermarks.update("collection", ("expression", "updatefact"), "fingerprint", 30, [5])
+        self.fill(collection, updater, watermarks)
+        self.assertEquals(updater.expressions, [])
+        self.assertEquals(watermarks.since("collection", ("expression", "updatefact"), "fingerprint"), (30, set([5])))
+    
+    def testFillEverythingWhenSettingsChange(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        watermarks.update("collection", ("expression", "updatefact"), "old fingerprint", 30)
+        self.fill(collection, updater, watermarks)
+        self.assertEquals(updater.expressions, [u"书", u"马"])
+        self.assertEquals(watermarks.since("collection", ("expression", "updatefact"), "old fingerprint"), None)
+    
+    def testFillEverythingAfterSync(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        self.fill(collection, updater, watermarks, fingerprint=("fingerprint", 100))
+        
+        # A sync brings down a change made on another device before our last fill
+        collection.notes[0]["Expression"], collection.notes[0].mod = u"书本", 15
+        self.fill(collection, updater, watermarks, fingerprint=("fingerprint", 100))
+        self.fill(collection, updater, watermarks, fingerprint=("fingerprint", 200))
+        self.assertEquals(updater.expressions, [u"书", u"马", u"书本", u"马"])
+    
+    def testDontRecordCancelledFill(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        self.fill(collection, updater, watermarks, progress=lambda done, total: False)
+        self.assertEquals(watermarks.since("collection", ("expression", "updatefact"), "fingerprint"), None)
+    
+    def testFillNotesNewToTheFill(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        self.fill(collection, updater, watermarks, noteids=[1])
+        
+        # e.g. the cards of note 0 were moved into the deck, which doesn't change its modification time
+        self.fill(collection, updater, watermarks)
+        self.assertEquals(updater.expressions, [u"马", u"书"])
+        self.assertEquals(watermarks.filled("collection", ("expression", "updatefact"), "fingerprint"), set([0, 1]))
+    
+    def testFillNotesThatLeftAndCameBack(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        self.fill(collection, updater, watermarks)
+        self.fill(collection, updater, watermarks, noteids=[1])
+        self.fill(collection, updater, watermarks)
+        self.assertEquals(updater.expressions, [u"书", u"马", u"书"])
+    
+    def testDontRefillOwnWrites(self):
+        collection, updater, watermarks = self.collection(), MockUpdater(), Watermarks()
+        collection.notes[0]["Reading"] = u""
+        self.fill(collection, updater, watermarks)
+        self.fill(collection, updater, watermarks)
+        self.assertEquals(updater.expressions, [u"书", u"马"])
+    
+    # Test helpers
+    def collection(self):
+        collection = MockCollection({ 0 : MockNote({ "Expression" : u"书", "Reading" : u"shu1" }), 1 : MockNote({ "Expression" : u"马", "Reading" : u"ma3" }) })
+        collection.notes[0].mod, collection.notes[1].mod = 10, 20
+        return collection
+    
+    def fill(self, collection, updater, watermarks, noteids=None, fingerprint="fingerprint", **kwargs):
+        modifiedsince = lambda noteids, since: [(noteid, collection.getNote(noteid).mod) for noteid in noteids if collection.getNote(noteid).mod >= since]
+        bulkfill = BulkFill(Config().candidateFieldNamesByKey, updater, "expression", batchsize=1)
+        return IncrementalBulkFill(bulkfill, watermarks, "collection", fingerprint).run(collection, noteids or sorted(collection.notes.keys()), modifiedsince, **kwargs)
+
+class BackgroundRunnerTest(unittest.TestCase):
+    def testResult(self):
+        self.assertEquals(BackgroundRunner()(lambda: 1 + 1), 2)
+    
+    def testRunsOnAnotherThread(self):
+        self.assertFalse(BackgroundRunner()(lambda: threading.currentThread()) is threading.currentThread())
+    
+    def testException(self):
+        def fail():
+            raise ValueError("Oh no")
+        
+        self.assertRaises(ValueError, lambda: BackgroundRunner()(fail))
+    
+    def testCallOnWaitingThread(self):
+        runner = BackgroundRunner()
+        self.assertTrue(runner(lambda: runner.callonwaitingthread(lambda: threading.currentThread())) is threading.currentThread())
+    
+    def testCallOnWaitingThreadException(self):
+        def fail():
+            raise ValueError("Oh no")
+        
+        runner = BackgroundRunner()
+        self.assertRaises(ValueError, lambda: runner(lambda: runner.callonwaitingthread(fail)))
+    
+    def testCallOnWaitingThreadWhenNotRunning(self):
+        self.assertEquals(BackgroundRunner().callonwaitingthread(lambda: 3), 3)
+    
+    def testIdle(self):
+        idled = []
+        def slow():
+            import time
+            time.sleep(0.05)
+        
+        BackgroundRunner(idle=lambda: idled.append(True))(slow)
+        self.assertTrue(len(idled) > 0)
+
+if __name__ == '__main__':
+    unittest.main()
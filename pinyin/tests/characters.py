@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from pinyin.characters import *
+
+
+class IsHanziTest(unittest.TestCase):
+    def testUnified(self):
+        self.assertTrue(ishanzi(u"好"))
+        self.assertTrue(ishanzi(u"一"))
+    
+    def testExtensionA(self):
+        self.assertTrue(ishanzi(u"㐀"))
+    
+    def testCompatibility(self):
+        self.assertTrue(ishanzi(u"豈"))
+    
+    def testNotHanzi(self):
+        self.assertFalse(ishanzi(u"a"))
+        self.assertFalse(ishanzi(u"。"))
+        self.assertFalse(ishanzi(u"　"))
+        self.assertFalse(ishanzi(u"\n"))
+    
+    def testByteString(self):
+        self.assertFalse(ishanzi("a"))
+
+class IsAllHanziTest(unittest.TestCase):
+    def testAllHanzi(self):
+        self.assertTrue(isallhanzi(u"你好"))
+    
+    def testMixed(self):
+        self.assertFalse(isallhanzi(u"你好!"))
+        self.assertFalse(isallhanzi(u"a你好"))
+    
+    def testEmpty(self):
+        self.assertTrue(isallhanzi(u""))
+    
+    def testByteString(self):
+        self.assertFalse(isallhanzi("ab"))
+
+class FilterHanziTest(unittest.TestCase):
+    def testFilter(self):
+        self.assertEquals(filterhanzi(u"我喜欢 Python，你呢？"), u"我喜欢你呢")
+    
+    def testNone(self):
+        self.assertEquals(filterhanzi(u"hello"), u"")
+    
+    def testCount(self):
+        self.assertEquals(counthanzi(u"我喜欢 Python，你呢？"), 5)
+
+class IsPunctuationTest(unittest.TestCase):
+    def testWestern(self):
+        self.assertTrue(ispunctuation(u".,!?()-"))
+    
+    def testChinese(self):
+        self.assertTrue(ispunctuation(u"，。！？《》「」、"))
+    
+    def testOutsideTabulatedBlocks(self):
+        # Arabic comma: we fall back on unicodedata for this
+        self.assertTrue(ispunctuation(u"،"))
+        self.assertFalse(ispunctuation(u"ا"))
+    
+    def testNotPunctuation(self):
+        self.assertFalse(ispunctuation(u"a."))
+        self.assertFalse(ispunctuation(u"你。"))
+        self.assertFalse(ispunctuation(u" "))
+        self.assertFalse(ispunctuation(u"$"))
+    
+    def testEmpty(self):
+        self.assertTrue(ispunctuation(u""))
+    
+    def testByteString(self):
+        self.assertTrue(ispunctuation("."))
+    
+    def testCharacter(self):
+        self.assertTrue(ispunctuationcharacter(u"、"))
+        self.assertFalse(ispunctuationcharacter(u"　"))
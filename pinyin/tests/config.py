@@ -136,6 +136,24 @@ class ConfigTest(unittest.TestCase):
     def testShouldUseGoogleTranslateShouldUse(self):
         self.assertTrue(Config({ "fallbackongoogletranslate" : True }).shouldusegoogletranslate)
 
+    def testFingerprintStable(self):
+        self.assertEquals(Config({ "tonedisplay" : "numeric" }).fingerprint(), Config({ "tonedisplay" : "numeric" }).fingerprint())
+    
+    def testFingerprintIgnoresDictionaryOrder(self):
+        self.assertEquals(canonicalrepr({ "a" : 1, "b" : [{ "c" : 2, "d" : 3 }] }), canonicalrepr(dict([("b", [dict([("d", 3), ("c", 2)])]), ("a", 1)])))
+    
+    def testFingerprintChangesWithSettings(self):
+        self.assertNotEquals(Config({ "tonedisplay" : "numeric" }).fingerprint(), Config({ "tonedisplay" : "tonified" }).fingerprint())
+    
+    def testFingerprintIgnoresNonOutputSettings(self):
+        self.assertEquals(Config({ "bulkfillworkers" : 1 }).fingerprint(), Config({ "bulkfillworkers" : 4 }).fingerprint())
+    
+    def testFingerprintChangesWhenSettingChanged(self):
+        config = Config({ "tonedisplay" : "numeric" })
+        fingerprint = config.fingerprint()
+        config.tonedisplay = "tonified"
+        self.assertNotEquals(config.fingerprint(), fingerprint)
+    
     def testPickle(self):
         import pickle
         config = Config({ "setting" : "value", "cheese" : "mice" })
@@ -161,6 +179,68 @@ class ConfigTest(unittest.TestCase):
         # clean up persisted settings
         os.unlink(SETTINGS_FILE)
 
+class CompiledConfigTest(unittest.TestCase):
+    def testSettingsAreAttributes(self):
+        self.assertEquals(Config({ "tonedisplay" : "numeric" }).compiled().tonedisplay, "numeric")
+        self.assertEquals(Config({ "tonedisplay" : "numeric" }).compiled().settings["tonedisplay"], "numeric")
+    
+    def testDerivedSettings(self):
+        compiled = Config({ "tonedisplay" : "tonified", "meaningnumbering" : "circledArabic", "meaningseperator" : "commas" }).compiled()
+        self.assertEquals(compiled.shouldtonify, True)
+        self.assertEquals(compiled.meaningnumberingstrings[0], u"①")
+        self.assertEquals(compiled.meaningseperatorstring, ", ")
+    
+    def testMeaningNumber(self):
+        for settings in [{ "meaningnumbering" : "arabicParens", "colormeaningnumbers" : False }, { "meaningnumbering" : "circledChinese", "colormeaningnumbers" : False },
+                         { "meaningnumbering" : "none", "colormeaningnumbers" : False }, { "meaningnumbering" : "circledArabic", "colormeaningnumbers" : True, "meaningnumberingcolor" : "#aabbcc" }]:
+            config = Config(settings)
+            self.assertEquals([config.compiled().meaningnumber(n) for n in [1, 10, 20, 21, 100]], [config.meaningnumber(n) for n in [1, 10, 20, 21, 100]])
+    
+    def testFormatMeanings(self):
+        config = Config({ "meaningnumbering" : "circledChinese", "meaningseperator" : "commas", "colormeaningnumbers" : False, "emphasisemainmeaning" : True, "mainmeaningemphasistag" : "br/" })
+        self.assertEquals(config.compiled().formatmeanings([u"a", u"b", u"c"]), u"a, <br />㊁ b, ㊂ c")
+    
+    def testFormatHanziMaskingCharacter(self):
+        self.assertEquals(Config({ "hanzimaskingcharacter" : "MASKED", "colormeaningnumbers" : True, "meaningnumberingcolor" : "#aabbcc" }).compiled().formathanzimaskingcharacter(),
+                          u'<span style="color:#aabbcc">MASKED</span>')
+    
+    def testFrozen(self):
+        compiled = Config({ "tonedisplay" : "numeric" }).compiled()
+        self.assertRaises(AttributeError, lambda: setattr(compiled, "tonedisplay", "tonified"))
+    
+    def testSnapshotUnaffectedByLaterChanges(self):
+        config = Config({ "tonecolors" : ["#ff0000"] })
+        compiled = config.compiled()
+        config.tonecolors[0] = "#00ff00"
+        self.assertEquals(compiled.tonecolors[0], "#ff0000")
+    
+    def testSnapshotReused(self):
+        config = Config()
+        self.assertTrue(config.compiled() is config.compiled())
+        self.assertTrue(config.compiled().compiled() is config.compiled())
+    
+    def testRebuiltWhenSettingChanged(self):
+        config = Config({ "tonedisplay" : "numeric" })
+        config.compiled()
+        config.tonedisplay = "tonified"
+        self.assertEquals(config.compiled().shouldtonify, True)
+    
+    def testRebuiltWhenSettingsReplaced(self):
+        config = Config({ "tonedisplay" : "numeric" })
+        config.compiled()
+        config.settings = Config({ "tonedisplay" : "tonified" }).settings
+        self.assertEquals(config.compiled().tonedisplay, "tonified")
+    
+    def testRebuiltWhenToldOfChange(self):
+        config = Config({ "tonecolors" : ["#ff0000"] })
+        config.compiled()
+        config.tonecolors[0] = "#00ff00"
+        config.changed()
+        self.assertEquals(config.compiled().tonecolors[0], "#00ff00")
+    
+    def testShouldUseGoogleTranslate(self):
+        self.assertFalse(Config({ "fallbackongoogletranslate" : False }).compiled().shouldusegoogletranslate)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import sqlite3
+import threading
 import unittest
 
 from pinyin.dictionary import *
 from pinyin.db import database
+from pinyin.db.builder import buildmeasurewords
 from pinyin.model import ToneInfo, flatten, tokenizespaceseperatedtext
 
 
@@ -127,11 +130,57 @@ class PinyinDictionaryTest(unittest.TestCase):
         self.assertEquals([(self.flattenall(dictmwcharacters)[0], self.flattenall(dictmwpinyin)[0]) for dictmwcharacters, dictmwpinyin in dictmeasurewords],
                           [(u"本", u"ben3"), (u"册", u"ce4"), (u"部", u"bu4")])
     
+    def testLookUpOnAnotherThread(self):
+        lookup = lambda: (flatten(englishdict.reading(u"马上")), self.flatmeanings(englishdict, u"鼓聲"))
+        here = lookup()
+        
+        results = []
+        def lookupelsewhere():
+            try:
+                results.append(lookup())
+            except Exception, e:
+                results.append(e)
+        
+        thread = threading.Thread(target=lookupelsewhere)
+        thread.start()
+        thread.join()
+        self.assertEquals(results, [here])
+    
+    def testMeasureWords(self):
+        for word in [u"书", u"上午", u"鼓聲", u"一杯啤酒", u"English"]:
+            for prefersimptrad in ["simp", "trad"]:
+                self.assertEquals(englishdict.measurewords(word, prefersimptrad), englishdict.meanings(word, prefersimptrad)[1])
+    
+    def testMeasureWordsFromTable(self):
+        meaning = parseMeaning(u"/book/CL:本[ben3]/", 1, lambda: [(u"册", u"冊", u"ce4")])
+        self.assertEquals(self.flattenmeasurewords(meaning.measurewords("simp", None)), [(u"册", u"ce4")])
+        self.assertEquals(self.flattenmeasurewords(meaning.measurewords("trad", None)), [(u"冊", u"ce4")])
+        self.assertEquals(self.flattenmeasurewords(meaning("simp", None)[1]), [(u"本", u"ben3")])
+    
+    def testMeasureWordsWithoutTable(self):
+        meaning = parseMeaning(u"/book/CL:本[ben3]/", 1)
+        self.assertEquals(self.flattenmeasurewords(meaning.measurewords("simp", None)), [(u"本", u"ben3")])
+    
+    def testBuildMeasureWords(self):
+        connection = sqlite3.connect(":memory:")
+        connection.execute("create table CEDICT (HeadwordTraditional text, HeadwordSimplified text, Reading text, Translation text)")
+        connection.executemany("insert into CEDICT values (?, ?, ?, ?)", [
+            (u"書", u"书", u"shu1", u"/book/CL:本[ben3],冊|册[ce4]/"),
+            (u"書", u"书", u"shu1", u"/a later entry/CL:部[bu4]/"),
+            (u"早上", u"早上", u"zao3 shang5", u"/early morning/")
+          ])
+        buildmeasurewords(connection)
+        self.assertEquals(connection.execute("select * from MeasureWords order by Position").fetchall(),
+                          [(u"CEDICT", u"書", u"书", u"shu1", 0, u"本", u"本", u"ben3"), (u"CEDICT", u"書", u"书", u"shu1", 1, u"册", u"冊", u"ce4")])
+    
     # Test helper 
     def flatmeanings(self, dictionary, what, prefersimptrad="simp"):
         dictmeanings = combinemeaningsmws(*(dictionary.meanings(what, prefersimptrad)))
         return self.flattenall(dictmeanings)
     
+    def flattenmeasurewords(self, measurewords):
+        return [(flatten(characters), flatten(pinyin)) for characters, pinyin in measurewords]
+    
     def flattenall(self, tokens):
         if tokens:
             return [flatten(token) for token in tokens]
@@ -35,6 +35,57 @@ class FactProxyTest(unittest.TestCase):
         FactProxy({"key" : ["foo"]}, fact)["key"] = "Bye"
         self.assertEquals(fact, { "Foo" : "Bye" })
 
+    def testDirty(self):
+        fact = { "Foo" : "Meh", "Bar" : "Hi" }
+        proxy = FactProxy({"foo" : ["Foo"], "bar" : ["Bar"]}, fact)
+        self.assertFalse(proxy.dirty)
+        
+        proxy["foo"] = "Meh"
+        self.assertFalse(proxy.dirty)
+        
+        proxy["bar"] = "Bye"
+        self.assertTrue(proxy.dirty)
+        self.assertEquals(proxy.dirtyfields, set(["bar"]))
+
+class FieldMappingTest(unittest.TestCase):
+    def testMapping(self):
+        self.assertEquals(fieldmapping({ "foo" : ["Foo"], "bar" : ["Bar", "Baz"], "missing" : ["Missing"] }, { "Foo" : "", "Baz" : "" }), { "foo" : "Foo", "bar" : "Baz" })
+    
+    def testRememberedForModel(self):
+        candidates = { "foo" : ["Foo"] }
+        self.assertTrue(fieldmapping(candidates, MockModelNote(1, 0, { "Foo" : "a" })) is fieldmapping(candidates, MockModelNote(1, 0, { "Foo" : "b" })))
+    
+    def testModelsDistinguished(self):
+        candidates = { "foo" : ["Foo", "Bar"] }
+        self.assertEquals(fieldmapping(candidates, MockModelNote(1, 0, { "Foo" : "" })), { "foo" : "Foo" })
+        self.assertEquals(fieldmapping(candidates, MockModelNote(2, 0, { "Bar" : "" })), { "foo" : "Bar" })
+    
+    def testForgottenWhenModelChanges(self):
+        candidates = { "foo" : ["Foo", "Bar"] }
+        self.assertEquals(fieldmapping(candidates, MockModelNote(1, 0, { "Foo" : "", "Bar" : "" })), { "foo" : "Foo" })
+        self.assertEquals(fieldmapping(candidates, MockModelNote(1, 1, { "Bar" : "" })), { "foo" : "Bar" })
+    
+    def testForgottenWhenCandidatesChange(self):
+        candidates = { "foo" : ["Foo", "Bar"] }
+        self.assertEquals(fieldmapping(candidates, MockModelNote(1, 0, { "Foo" : "", "Bar" : "" })), { "foo" : "Foo" })
+        candidates["foo"].reverse()
+        self.assertEquals(fieldmapping(candidates, MockModelNote(1, 0, { "Foo" : "", "Bar" : "" })), { "foo" : "Bar" })
+    
+    def testProxyHasOwnFieldNames(self):
+        candidates = { "foo" : ["Foo"] }
+        FactProxy(candidates, MockModelNote(1, 0, { "Foo" : "" })).fieldnames["bar"] = "Bar"
+        self.assertEquals(FactProxy(candidates, MockModelNote(1, 0, { "Foo" : "" })).fieldnames, { "foo" : "Foo" })
+
+# Test helpers
+
+class MockModelNote(dict):
+    def __init__(self, modelid, modelmod, fields):
+        dict.__init__(self, fields)
+        self.themodel = { "id" : modelid, "mod" : modelmod }
+    
+    def model(self):
+        return self.themodel
+
 if __name__ == '__main__':
     unittest.main()
 
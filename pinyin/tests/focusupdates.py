@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from pinyin.bulkfill import deferredcopy
+from pinyin.config import Config
+from pinyin.factproxy import FactProxy
+from pinyin.focusupdates import *
+from pinyin.mocks import *
+from pinyin.updater import FieldUpdaterFromExpression, FieldUpdaterFromReading
+
+
+class BackgroundUpdatesTest(unittest.TestCase):
+    def testApplyWhenReady(self):
+        updates, applied = BackgroundUpdates(), []
+        updates.submit("note", lambda: "result", applied.append)
+        updates.join()
+        self.assertEquals(applied, [])
+        self.assertEquals(updates.applyready(), 1)
+        self.assertEquals(applied, ["result"])
+        self.assertEquals(updates.pending, 0)
+    
+    def testComputeOnAnotherThread(self):
+        updates, threads = BackgroundUpdates(), []
+        updates.submit("note", lambda: threads.append(threading.currentThread()), lambda result: threads.append(threading.currentThread()))
+        updates.join()
+        updates.applyready()
+        self.assertNotEquals(threads[0], threading.currentThread())
+        self.assertEquals(threads[1], threading.currentThread())
+    
+    def testDropStaleResult(self):
+        updates, applied = BackgroundUpdates(), []
+        updates.submit("note", lambda: "first", applied.append)
+        updates.join()
+        updates.submit("note", lambda: "second", applied.append)
+        updates.join()
+        self.assertEquals(updates.applyready(), 1)
+        self.assertEquals(applied, ["second"])
+        self.assertEquals(updates.pending, 0)
+    
+    def testDontComputeSuperseded(self):
+        updates, computed, applied = BackgroundUpdates(), [], []
+        go = threading.Event()
+        updates.submit("other note", lambda: go.wait(), lambda result: None)
+        for n in range(3):
+            updates.submit("note", lambda n=n: computed.append(n) or n, applied.append)
+        go.set()
+        updates.join()
+        updates.applyready()
+        self.assertEquals(computed, [2])
+        self.assertEquals(applied, [2])
+    
+    def testKeysIndependent(self):
+        updates, applied = BackgroundUpdates(), []
+        updates.submit("note 1", lambda: 1, applied.append)
+        updates.submit("note 2", lambda: 2, applied.append)
+        updates.join()
+        self.assertEquals(updates.applyready(), 2)
+        self.assertEquals(applied, [1, 2])
+    
+    def testSuppressExceptions(self):
+        updates, applied = BackgroundUpdates(), []
+        updates.submit("note", lambda: 1 / 0, applied.append)
+        updates.join()
+        self.assertEquals(updates.applyready(), 0)
+        self.assertEquals(updates.pending, 0)
+        
+        updates.submit("note", lambda: "later", applied.append)
+        updates.join()
+        updates.applyready()
+        self.assertEquals(applied, ["later"])
+
+class ComputeUpdateTest(unittest.TestCase):
+    def testUpdateFact(self):
+        notifier, mediamanager = MockNotifier(), ImportRecordingMediaManager()
+        note = MockNote({ "Expression" : u"书", "Audio" : u"" })
+        fact = FactProxy(Config().candidateFieldNamesByKey, note)
+        updater = MockSoundUpdater(notifier, mediamanager)
+        
+        fields = { "expression" : u"书", "audio" : u"" }
+        update = computeupdate(deferredcopy(updater), "updatefact", fields, u"书")
+        self.assertEquals((note["Audio"], notifier.infos, mediamanager.imports), (u"", [], []))
+        
+        self.assertEquals(applyupdate(notifier, mediamanager, fact, fields, update), 1)
+        self.assertEquals(note["Audio"], u"[sound:imported-shu1.mp3]")
+        self.assertEquals(notifier.infos, [u"Filling in audio for 书"])
+        self.assertEquals(mediamanager.imports, [u"shu1.mp3"])
+    
+    def testUpdaterWithoutNotifier(self):
+        note = MockNote({ "Reading" : u"" })
+        fact = FactProxy(Config().candidateFieldNamesByKey, note)
+        update = computeupdate(deferredcopy(FieldUpdaterFromReading(Config({ "colorizedpinyingeneration" : False, "tonedisplay" : "numeric" }))), "updatefact", { "reading" : u"" }, u"shu1")
+        applyupdate(MockNotifier(), None, fact, { "reading" : u"" }, update)
+        self.assertEquals(note["Reading"], u"shu1")
+    
+    def testDontOverwriteFieldsChangedSince(self):
+        notifier, mediamanager = MockNotifier(), ImportRecordingMediaManager()
+        note = MockNote({ "Expression" : u"书", "Audio" : u"" })
+        fact = FactProxy(Config().candidateFieldNamesByKey, note)
+        fields = { "expression" : u"书", "audio" : u"" }
+        update = computeupdate(deferredcopy(MockSoundUpdater(notifier, mediamanager)), "updatefact", fields, u"书")
+        
+        # The user types into the field while we are working out what to put there
+        note["Audio"] = u"my own"
+        self.assertEquals(applyupdate(notifier, mediamanager, fact, fields, update), 0)
+        self.assertEquals(note["Audio"], u"my own")
+        self.assertEquals(mediamanager.imports, [])
+        self.assertFalse(fact.dirty)
+    
+    def testInBackground(self):
+        notifier, mediamanager = MockNotifier(), ImportRecordingMediaManager()
+        note = MockNote({ "Expression" : u"书", "Audio" : u"" })
+        fact = FactProxy(Config().candidateFieldNamesByKey, note)
+        updater = deferredcopy(MockSoundUpdater(notifier, mediamanager))
+        
+        updates = BackgroundUpdates()
+        updates.submit(1, lambda: computeupdate(updater, "updatefact", { "expression" : u"书", "audio" : u"" }, u"书"),
+                          lambda update: applyupdate(notifier, mediamanager, fact, { "expression" : u"书", "audio" : u"" }, update))
+        updates.join()
+        updates.applyready()
+        self.assertEquals(note["Audio"], u"[sound:imported-shu1.mp3]")
+        self.assertTrue(fact.dirty)
+    
+    def testRealDictionaryInBackground(self):
+        # NB: look something up on this thread first, so the database is in use by more than one thread
+        def fill(inbackground):
+            notifier, mediamanager = MockNotifier(), MockMediaManager([])
+            note = MockNote({ "Expression" : u"书", "Reading" : u"", "Meaning" : u"" })
+            fact = FactProxy(Config().candidateFieldNamesByKey, note)
+            fields = { "expression" : u"书", "reading" : u"", "meaning" : u"" }
+            updater = deferredcopy(FieldUpdaterFromExpression(notifier, mediamanager, Config({ "dictlanguage" : "en", "fallbackongoogletranslate" : False })))
+            compute = lambda: computeupdate(updater, "updatefact", fields, u"书")
+            apply = lambda update: applyupdate(notifier, mediamanager, fact, fields, update)
+            
+            if inbackground:
+                updates = BackgroundUpdates()
+                updates.submit(1, compute, apply)
+                updates.join()
+                self.assertEquals(updates.applyready(), 1)
+            else:
+                apply(compute())
+            
+            return note
+        
+        here = fill(False)
+        self.assertNotEquals(here["Reading"], u"")
+        self.assertEquals(fill(True), here)
+
+# Test helpers
+
+class MockSoundUpdater(object):
+    def __init__(self, notifier, mediamanager):
+        self.notifier = notifier
+        self.mediamanager = mediamanager
+    
+    def updatefact(self, fact, expression):
+        self.notifier.info(u"Filling in audio for " + expression)
+        fact["audio"] = u"[sound:%s]" % self.mediamanager.importtocurrentdeck(u"shu1.mp3")
+
+class ImportRecordingMediaManager(MockMediaManager):
+    def __init__(self):
+        MockMediaManager.__init__(self, [])
+        self.imports = []
+    
+    def importtocurrentdeck(self, filename):
+        self.imports.append(filename)
+        return u"imported-" + filename
+
+
+if __name__ == '__main__':
+    unittest.main()
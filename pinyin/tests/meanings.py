@@ -74,6 +74,21 @@ class MeaningFormatterTest(unittest.TestCase):
         self.assertEquals(means[0][0][2], Pinyin(u"hen", 3))
         self.assertEquals(means[0][0][-1], Pinyin(u"hao", 3))
         self.assertEquals(means[1][0][2], Text(u"hen"))
+    
+    def testMeasureWordsInDefinition(self):
+        self.assertEquals(measurewordsindefinition(self.shu_def, 1), [(u"本", u"本", u"ben3"), (u"册", u"冊", u"ce4"), (u"部", u"部", u"bu4"), (u"丛", u"叢", u"cong2")])
+        self.assertEquals(measurewordsindefinition(self.shu_def, 0), [(u"本", u"本", u"ben3"), (u"冊", u"册", u"ce4"), (u"部", u"部", u"bu4"), (u"叢", u"丛", u"cong2")])
+    
+    def testMeasureWordsInDefinitionNeedPinyin(self):
+        self.assertEquals(measurewordsindefinition(u"/morning/CL:個|个,本[ben3]/", 1), [(u"本", u"本", u"ben3")])
+        self.assertEquals(measurewordsindefinition(u"/morning/", 1), [])
+    
+    def testFormatMeasureWordsLikeParse(self):
+        for simplifiedcharindex in [0, 1]:
+            for prefersimptrad in ["simp", "trad"]:
+                formatter = MeaningFormatter(simplifiedcharindex, prefersimptrad)
+                self.assertEquals(formatter.formatmeasurewords(measurewordsindefinition(self.shu_def, simplifiedcharindex)),
+                                  formatter.parsedefinition(self.shu_def)[1])
         
     # Test helpers
     def parse(self, *args, **kwargs):
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import shutil
 import unittest
 
 from pinyin.media import *
+from pinyin.mocks import MockHTTPServer
 
 
 class MediaDownloaderTest(unittest.TestCase):
@@ -58,6 +60,108 @@ class MediaDownloaderTest(unittest.TestCase):
         downloaded = MediaDownloader(path).download(name, zipurl, downloadprompt=prompted)
         return gotprompt[0], downloaded
 
+class StreamingDownloadTest(unittest.TestCase):
+    content = "".join([chr(n % 256) for n in range(200000)])
+    
+    def testDownloadWithProgress(self):
+        def do(path, server):
+            progress = []
+            downloaded = MediaDownloader(path).download("Example Name", server.url, progress=lambda done, total: progress.append((done, total)))
+            self.assertEquals(utils.filecontents(downloaded.zippath), self.content)
+            self.assertEquals(progress[-1], (len(self.content), len(self.content)))
+            self.assertTrue(len(progress) > 1)
+            self.assertEquals(progress, sorted(progress))
+        
+        self.withserver(do)
+    
+    def testUseCache(self):
+        def do(path, server):
+            MediaDownloader(path).download("Example Name", server.url)
+            MediaDownloader(path).download("Example Name", server.url)
+            self.assertEquals(len(server.ranges), 1)
+        
+        self.withserver(do)
+    
+    def testResume(self):
+        def do(path, server):
+            self.assertRaises(IOError, lambda: MediaDownloader(path).download("Example Name", server.url))
+            
+            downloaded = MediaDownloader(path).download("Example Name", server.url)
+            self.assertEquals(utils.filecontents(downloaded.zippath), self.content)
+            self.assertEquals(server.ranges, [None, "bytes=100000-"])
+            self.assertFalse(os.path.exists(MediaDownloader(path).urlcachepath(server.url) + ".part.validator"))
+        
+        self.withserver(do, cutoff=100000)
+    
+    def testRestartIfFileChanged(self):
+        def do(path, server):
+            self.assertRaises(IOError, lambda: MediaDownloader(path).download("Example Name", server.url))
+            
+            server.content = "".join(reversed(self.content))
+            downloaded = MediaDownloader(path).download("Example Name", server.url)
+            self.assertEquals(utils.filecontents(downloaded.zippath), server.content)
+            self.assertEquals(server.ranges, [None, "bytes=100000-"])
+            self.assertEquals(server.ifranges, [None, '"%s"' % utils.md5(self.content)])
+            self.assertFalse(os.path.exists(MediaDownloader(path).urlcachepath(server.url) + ".part.validator"))
+        
+        self.withserver(do, cutoff=100000)
+    
+    def testRestartIfFileCantBeIdentified(self):
+        def do(path, server):
+            partialpath = MediaDownloader(path).urlcachepath(server.url) + ".part"
+            open(partialpath, "wb").write(self.content[:100000])
+            
+            downloaded = MediaDownloader(path).download("Example Name", server.url)
+            self.assertEquals(utils.filecontents(downloaded.zippath), self.content)
+            self.assertEquals(server.ranges, [None])
+        
+        self.withserver(do)
+    
+    def testRestartIfServerCantResume(self):
+        def do(path, server):
+            self.assertRaises(IOError, lambda: MediaDownloader(path).download("Example Name", server.url))
+            
+            downloaded = MediaDownloader(path).download("Example Name", server.url)
+            self.assertEquals(utils.filecontents(downloaded.zippath), self.content)
+            self.assertEquals(server.ranges, [None, "bytes=100000-"])
+        
+        self.withserver(do, supportsranges=False, cutoff=100000)
+    
+    def testChecksum(self):
+        def do(path, server):
+            downloaded = MediaDownloader(path).download("Example Name", server.url, md5=utils.md5(self.content))
+            self.assertEquals(utils.filecontents(downloaded.zippath), self.content)
+        
+        self.withserver(do)
+    
+    def testChecksumMismatch(self):
+        def do(path, server):
+            self.assertRaises(IOError, lambda: MediaDownloader(path).download("Example Name", server.url, md5=utils.md5("junk")))
+            
+            # Nothing should be left lying around to be mistaken for a good download
+            self.assertEquals(os.listdir(os.path.join(path, "downloads")), [])
+        
+        self.withserver(do)
+    
+    def testRedownloadDamagedCache(self):
+        def do(path, server):
+            downloaded = MediaDownloader(path).download("Example Name", server.url)
+            open(downloaded.zippath, "wb").write("damaged")
+            
+            downloaded = MediaDownloader(path).download("Example Name", server.url, md5=utils.md5(self.content))
+            self.assertEquals(utils.filecontents(downloaded.zippath), self.content)
+            self.assertEquals(len(server.ranges), 2)
+        
+        self.withserver(do)
+    
+    # Helpers
+    def withserver(self, do, **kwargs):
+        server = MockHTTPServer(self.content, **kwargs)
+        try:
+            utils.withtempdir(lambda path: do(path, server))
+        finally:
+            server.close()
+
 class DownloadedMediaTest(unittest.TestCase):
     binarycontents = "".join([chr(n) for n in range(0, 255)])
     
@@ -91,6 +195,38 @@ class DownloadedMediaTest(unittest.TestCase):
         
         utils.withtempdir(do)
     
+    def testInstallPackInParallel(self):
+        def do(path):
+            DownloadedMedia("Example Pack", self.createZipFile(path)).installpack(path, workers=3)
+            
+            packpath = os.path.join(path, "Example Pack")
+            self.assertEquals(sorted(os.listdir(packpath)), ["a.mp3", "b.mp3", "binary", "nested"])
+            self.assertEquals(utils.filecontents(os.path.join(packpath, "binary")), self.binarycontents)
+            self.assertEquals(utils.filecontents(os.path.join(packpath, "nested", "c.mp3")), "^_^")
+        
+        utils.withtempdir(do)
+    
+    def testInstallPackWithDirectoryEntries(self):
+        def do(path):
+            zippath = os.path.join(path, "junk.zip")
+            thezip = zipfile.ZipFile(zippath, 'w')
+            thezip.writestr("nested/", "")
+            thezip.writestr("nested/c.mp3", "^_^")
+            thezip.close()
+            
+            DownloadedMedia("Example Pack", zippath).installpack(path)
+            self.assertEquals(utils.filecontents(os.path.join(path, "Example Pack", "nested", "c.mp3")), "^_^")
+        
+        utils.withtempdir(do)
+    
+    def testInstallCorruptPack(self):
+        def do(path):
+            zippath = os.path.join(path, "junk.zip")
+            open(zippath, "wb").write("not a zip")
+            self.assertRaises(zipfile.BadZipfile, lambda: DownloadedMedia("Example Pack", zippath).installpack(path, workers=2))
+        
+        utils.withtempdir(do)
+    
     # Helpers
     def createZipFile(self, path):
         zippath = os.path.join(path, "junk.zip")
@@ -140,6 +276,21 @@ class MediaPackTest(unittest.TestCase):
     def testMediaForMissing(self):
         self.assertEquals(MediaPack("Example", {}).mediafor("hi", [".mp3"]), None)
     
+    def testCoverage(self):
+        pack = MediaPack("Example", {"Ni3.mp3" : "ni3.mp3", "ni3.ogg" : "ni3.ogg", "nv3.ogg" : "nv3.ogg", "de4.mp3" : "de4.mp3"})
+        coverage = pack.coverage([".mp3", ".ogg"])
+        self.assertEquals(coverage[(u"ni", 3)], "ni3.mp3")
+        self.assertEquals(coverage[(u"nü", 3)], "nv3.ogg")
+        self.assertEquals(coverage[(u"de", 5)], "de4.mp3")
+        self.assertEquals(coverage[(u"de", 4)], "de4.mp3")
+        self.assertEquals(coverage[(u"hao", 3)], None)
+        self.assertEquals(pack.coverage([".ogg"])[(u"ni", 3)], "ni3.ogg")
+    
+    def testCoverageShared(self):
+        pack = MediaPack("Example", {"ni3.mp3" : "ni3.mp3"})
+        self.assertTrue(pack.coverage([".mp3"]) is pack.coverage((".mp3",)))
+        self.assertFalse(pack.coverage([".mp3"]) is pack.coverage([".mp3", ".ogg"]))
+    
     def testFromPath(self):
         def do(path):
             # Create enclosing directory
@@ -161,6 +312,271 @@ class MediaPackTest(unittest.TestCase):
         # Create a temporary directory with which to do our test
         utils.withtempdir(do)
     
+class MediaPackRegistryTest(unittest.TestCase):
+    def testDiscoverPacks(self):
+        def do(path):
+            self.makepack(path, "Pack A", ["a1.mp3"])
+            self.makepack(path, "downloads", ["junk"])
+            utils.touch(os.path.join(path, "notapack.mp3"))
+            
+            packs = MediaPackRegistry().discovermediapacks(path)
+            self.assertEquals([pack.name for pack in packs], ["Pack A"])
+            self.assertEquals(packs[0].mediafor("a1", [".mp3"]), os.path.join(path, "Pack A", "a1.mp3"))
+        
+        utils.withtempdir(do)
+    
+    def testReuseUnchangedPacks(self):
+        def do(path):
+            self.makepack(path, "Pack A", ["a1.mp3"])
+            self.makepack(path, "Pack B", ["b1.mp3"])
+            
+            registry = MediaPackRegistry()
+            packs = registry.discovermediapacks(path)
+            packsagain = registry.discovermediapacks(path)
+            self.assertTrue(packs[0] is packsagain[0])
+            self.assertTrue(packs[1] is packsagain[1])
+        
+        utils.withtempdir(do)
+    
+    def testRescanChangedPack(self):
+        def do(path):
+            packpath = self.makepack(path, "Pack A", ["a1.mp3"])
+            self.makepack(path, "Pack B", ["b1.mp3"])
+            
+            registry = MediaPackRegistry()
+            packs = registry.discovermediapacks(path)
+            utils.touch(os.path.join(packpath, "a2.mp3"))
+            self.bumpmtime(packpath)
+            
+            packsagain = registry.discovermediapacks(path)
+            self.assertEquals(packsagain[0].mediafor("a2", [".mp3"]), os.path.join(packpath, "a2.mp3"))
+            self.assertTrue(packs[1] is packsagain[1])
+        
+        utils.withtempdir(do)
+    
+    def testAddAndRemovePacks(self):
+        def do(path):
+            self.makepack(path, "Pack A", ["a1.mp3"])
+            
+            registry = MediaPackRegistry()
+            self.assertEquals([pack.name for pack in registry.discovermediapacks(path)], ["Pack A"])
+            
+            self.makepack(path, "Pack B", ["b1.mp3"])
+            self.bumpmtime(path)
+            self.assertEquals([pack.name for pack in registry.discovermediapacks(path)], ["Pack A", "Pack B"])
+            
+            shutil.rmtree(os.path.join(path, "Pack A"))
+            self.bumpmtime(path, 20)
+            self.assertEquals([pack.name for pack in registry.discovermediapacks(path)], ["Pack B"])
+        
+        utils.withtempdir(do)
+    
+    def testDontLookForPacksAfterAddingFiles(self):
+        def do(path):
+            self.makepack(path, "Pack A", ["a1.mp3"])
+            
+            registry = MediaPackRegistry()
+            packs = registry.discovermediapacks(path)
+            registry.addingfiles(path, lambda: utils.touch(os.path.join(path, "imported.mp3")) or self.bumpmtime(path))
+            
+            registry.findpackpaths = lambda mediadir: self.fail("Looked for packs in %s again" % mediadir)
+            self.assertEquals(registry.discovermediapacks(path), packs)
+        
+        utils.withtempdir(do)
+    
+    def testLookForPacksIfChangedBeforeAddingFiles(self):
+        def do(path):
+            self.makepack(path, "Pack A", ["a1.mp3"])
+            
+            registry = MediaPackRegistry()
+            registry.discovermediapacks(path)
+            self.makepack(path, "Pack B", ["b1.mp3"])
+            self.bumpmtime(path)
+            registry.addingfiles(path, lambda: utils.touch(os.path.join(path, "imported.mp3")) or self.bumpmtime(path, 20))
+            
+            self.assertEquals([pack.name for pack in registry.discovermediapacks(path)], ["Pack A", "Pack B"])
+        
+        utils.withtempdir(do)
+    
+    def testPersistIndex(self):
+        def do(path):
+            mediadir = os.path.join(path, "media")
+            os.mkdir(mediadir)
+            self.makepack(mediadir, "Pack A", ["a1.mp3", "a2.mp3"])
+            indexpath = os.path.join(path, "index.p")
+            
+            packs = MediaPackRegistry(indexpath).discovermediapacks(mediadir)
+            
+            # A new session should use the saved index rather than listing the pack again
+            frompath = MediaPack.__dict__["frompath"]
+            try:
+                def failfrompath(packpath):
+                    self.fail("Listed the pack at %s again" % packpath)
+                MediaPack.frompath = staticmethod(failfrompath)
+                
+                self.assertEquals(MediaPackRegistry(indexpath).discovermediapacks(mediadir), packs)
+            finally:
+                MediaPack.frompath = frompath
+        
+        utils.withtempdir(do)
+    
+    def testIgnoreCorruptIndex(self):
+        def do(path):
+            mediadir = os.path.join(path, "media")
+            os.mkdir(mediadir)
+            self.makepack(mediadir, "Pack A", ["a1.mp3"])
+            indexpath = os.path.join(path, "index.p")
+            
+            indexfile = open(indexpath, "wb")
+            indexfile.write("garbage")
+            indexfile.close()
+            
+            self.assertEquals([pack.name for pack in MediaPackRegistry(indexpath).discovermediapacks(mediadir)], ["Pack A"])
+        
+        utils.withtempdir(do)
+    
+    # Test helpers
+    
+    def makepack(self, mediadir, name, filenames):
+        packpath = os.path.join(mediadir, name)
+        os.mkdir(packpath)
+        for filename in filenames:
+            utils.touch(os.path.join(packpath, filename))
+        
+        return packpath
+    
+    def bumpmtime(self, path, by=10):
+        # Don't rely on the resolution of the filesystem timestamps to notice the change
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + by))
+
+class MediaImportCacheTest(unittest.TestCase):
+    def testImportOnce(self):
+        def do(path):
+            cache, imported = MediaImportCache(), []
+            source = self.makesource(path, "ni3.mp3")
+            
+            self.assertEquals(cache.importfile(path, source, self.importer(path, imported)), "ni3.mp3")
+            self.assertEquals(cache.importfile(path, source, self.importer(path, imported)), "ni3.mp3")
+            self.assertEquals(imported, [source])
+            self.assertEquals((cache.imports, cache.skipped), (1, 1))
+        
+        utils.withtempdir(do)
+    
+    def testReimportChangedFile(self):
+        def do(path):
+            cache, imported = MediaImportCache(), []
+            source = self.makesource(path, "ni3.mp3")
+            cache.importfile(path, source, self.importer(path, imported))
+            
+            stat = os.stat(source)
+            os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+            cache.importfile(path, source, self.importer(path, imported))
+            self.assertEquals(imported, [source, source])
+        
+        utils.withtempdir(do)
+    
+    def testReimportDeletedCopy(self):
+        def do(path):
+            cache, imported = MediaImportCache(), []
+            source = self.makesource(path, "ni3.mp3")
+            os.remove(os.path.join(path, cache.importfile(path, source, self.importer(path, imported))))
+            
+            self.assertEquals(cache.importfile(path, source, self.importer(path, imported)), "ni3.mp3")
+            self.assertEquals(imported, [source, source])
+            self.assertEquals((cache.imports, cache.skipped), (2, 0))
+        
+        utils.withtempdir(do)
+    
+    def testMissingSource(self):
+        cache = MediaImportCache()
+        self.assertEquals(cache.importfile("dummy_dir", "nonexistent.mp3", lambda path: "imported.mp3"), "imported.mp3")
+        self.assertEquals(cache.imports, 1)
+    
+    # Test helpers
+    
+    def makesource(self, path, filename):
+        packpath = os.path.join(path, "Pack")
+        utils.ensuredirexists(packpath)
+        source = os.path.join(packpath, filename)
+        utils.touch(source)
+        return source
+    
+    def importer(self, mediadir, imported):
+        def importfile(path):
+            imported.append(path)
+            shutil.copy(path, mediadir)
+            return os.path.basename(path)
+        
+        return importfile
+
+class ConcatenateAudioTest(unittest.TestCase):
+    def testMp3FramesWithoutTags(self):
+        self.assertEquals(mp3frames("\xff\xfbFRAMES"), "\xff\xfbFRAMES")
+    
+    def testMp3FramesStripsId3v2(self):
+        self.assertEquals(mp3frames("ID3\x03\x00\x00\x00\x00\x00\x04TAGS\xff\xfbFRAMES"), "\xff\xfbFRAMES")
+        self.assertEquals(mp3frames("ID3\x03\x00\x00\x00\x00\x01\x00" + "x" * 128 + "\xff\xfbFRAMES"), "\xff\xfbFRAMES")
+    
+    def testMp3FramesStripsId3v2Footer(self):
+        self.assertEquals(mp3frames("ID3\x04\x00\x10\x00\x00\x00\x04TAGS3DI\x04\x00\x10\x00\x00\x00\x04\xff\xfbFRAMES"), "\xff\xfbFRAMES")
+    
+    def testMp3FramesStripsId3v1(self):
+        self.assertEquals(mp3frames("\xff\xfbFRAMES" + "TAG" + "x" * 125), "\xff\xfbFRAMES")
+    
+    def testMp3FramesStripsXingFrame(self):
+        # MPEG 1 layer III at 128kbit/s and 44.1kHz, so frames are 417 bytes long
+        for tag, offset in [("Xing", 36), ("Info", 36), ("VBRI", 36)]:
+            frame = "\xff\xfb\x90\x00" + "\x00" * (offset - 4) + tag
+            frame += "\x00" * (417 - len(frame))
+            self.assertEquals(mp3frames("ID3\x03\x00\x00\x00\x00\x00\x04TAGS" + frame + "\xff\xfb\x90\x00AUDIO"), "\xff\xfb\x90\x00AUDIO")
+    
+    def testMp3FramesStripsMonoXingFrame(self):
+        # MPEG 2 layer III at 64kbit/s and 22.05kHz, mono, so frames are 208 bytes long with the tag after 9 bytes of side information
+        frame = "\xff\xf3\x80\xc0" + "\x00" * 9 + "Xing"
+        frame += "\x00" * (208 - len(frame))
+        self.assertEquals(mp3frames(frame + "\xff\xf3\x80\xc0AUDIO"), "\xff\xf3\x80\xc0AUDIO")
+    
+    def testMp3FramesKeepsAudioFrame(self):
+        frame = "\xff\xfb\x90\x00" + "\x00" * 413
+        self.assertEquals(mp3frames(frame + frame), frame + frame)
+    
+    def testConcatenate(self):
+        def do(path):
+            concatenator = AudioConcatenator(os.path.join(path, "cache"))
+            clips = self.makeclips(path, [("a.mp3", "ID3\x03\x00\x00\x00\x00\x00\x01xA"), ("b.mp3", "B"), ("gap.mp3", "_")])
+            
+            outputpath = concatenator.concatenate([[clips[0], clips[1]], [clips[1]]], clips[2])
+            self.assertEquals(utils.filecontents(outputpath), "AB_B")
+            self.assertEquals((concatenator.made, concatenator.reused), (1, 0))
+        
+        utils.withtempdir(do)
+    
+    def testReuseByContent(self):
+        def do(path):
+            concatenator = AudioConcatenator(os.path.join(path, "cache"))
+            clips = self.makeclips(path, [("a.mp3", "A"), ("b.mp3", "B"), ("othera.mp3", "A"), ("gap.mp3", "_")])
+            
+            outputpath = concatenator.concatenate([[clips[0], clips[1]]], clips[3])
+            self.assertEquals(concatenator.concatenate([[clips[2], clips[1]]], clips[3]), outputpath)
+            self.assertNotEquals(concatenator.concatenate([[clips[1], clips[0]]], clips[3]), outputpath)
+            self.assertNotEquals(concatenator.concatenate([[clips[0]], [clips[1]]], clips[3]), outputpath)
+            self.assertEquals((concatenator.made, concatenator.reused), (3, 1))
+        
+        utils.withtempdir(do)
+    
+    # Test helpers
+    def makeclips(self, path, clips):
+        paths = []
+        for filename, contents in clips:
+            clippath = os.path.join(path, filename)
+            file = open(clippath, "wb")
+            file.write(contents)
+            file.close()
+            paths.append(clippath)
+        
+        return paths
+
 class LegacyMediaTest(unittest.TestCase):
     def testDiscoverNothing(self):
         self.assertEquals(discoverlegacymedia(None, []), None)
@@ -182,6 +598,20 @@ class LegacyMediaTest(unittest.TestCase):
     
     def testDiscardInvalidImportedFiles(self):
         self.assertEquals(discoverlegacymedia(["HASH1.mp3"], [(os.path.join("foo", "hello.mp3"), "HASH1.mp3"), (os.path.join("foo", "world.ogg"), "HASH2.ogg")]), [])
+    
+    def testMediaIndex(self):
+        index = MediaIndex([("hello.mp3", "HASH1.mp3")])
+        self.assertEquals(discoverlegacymedia(["HASH1.mp3", "HASH2.ogg"], index), ["HASH2.ogg"])
+
+class MediaIndexTest(unittest.TestCase):
+    def testContains(self):
+        index = MediaIndex([("hello.mp3", "HASH1.mp3")])
+        self.assertTrue("HASH1.mp3" in index)
+        self.assertFalse("HASH2.mp3" in index)
+        self.assertEquals(len(index), 1)
+    
+    def testIter(self):
+        self.assertEquals(sorted(MediaIndex([("hello.mp3", "HASH1.mp3"), ("world.ogg", "HASH2.ogg")])), [("hello.mp3", os.path.normcase("HASH1.mp3")), ("world.ogg", os.path.normcase("HASH2.ogg"))])
 
 if __name__ == '__main__':
     unittest.main()
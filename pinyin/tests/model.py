@@ -2,6 +2,8 @@
 
 import unittest
 
+from pinyin.db import database
+import pinyin.db.gensyllables
 from pinyin.model import *
 
 
@@ -129,6 +131,10 @@ class PinyinTest(unittest.TestCase):
         self.assertEquals(Pinyin.parse(u"nü3"), Pinyin.parse(u"nv3"))
         self.assertEquals(Pinyin.parse(u"lü3"), Pinyin.parse(u"lu:3"))
     
+    def testValidPinyinMatchesDatabase(self):
+        # If this fails, the syllable module is stale: rerun pinyin/db/gensyllables.py
+        self.assertEquals(Pinyin.validpinyin, frozenset(pinyin.db.gensyllables.readsyllables(database())))
+    
     # Bug #138 - kind of a relic of when we used a regex to recognise pinyin
     def testParsesXiong(self):
         self.assertEquals(Pinyin.parse(u"xiong1"), Pinyin("xiong", 1))
@@ -305,6 +311,16 @@ class TokenizeTest(unittest.TestCase):
         self.assertEquals([Pinyin.parse(u"hen3"), Text(" "), Pinyin.parse(u"hao3"), Text(", "), Text("my"), Text(" "), Text(u"xiǎo"), Text(" "), Text("one"), Text("!")],
                            tokenize(u"hen3 hao3, my xiǎo one!", forcenumeric=True))
     
+    def testTokenizeSegmented(self):
+        self.assertEquals([Pinyin(u"ni", 5), Pinyin(u"hao", 5)], tokenize(u"nihao", segment=True))
+        self.assertEquals([Pinyin(u"xie", 5), Pinyin(u"xie", 3), Pinyin(u"ni", 5), Text(u"!")], tokenize(u"xiexie3ni!", segment=True))
+        self.assertEquals([Pinyin(u"ni", 3), Pinyin(u"hao", 3)], tokenize(u"nǐhǎo", segment=True))
+        self.assertEquals([Text(u"nihao")], tokenize(u"nihao"))
+    
+    def testTokenizeSegmentedKeepsSingleWords(self):
+        self.assertEquals([Text(u"a"), Text(u" "), Text(u"color")], tokenize(u"a color", segment=True))
+        self.assertEquals([Pinyin.parse(u"hao3")], tokenize(u"hao3", segment=True))
+    
     def testTokenizeHTML(self):
         self.assertEquals([Text(u'<b>'), Text("some"), Text(" "), Text("silly"), Text(" "), Text("text"), Text("</b>")],
                           tokenize(u'<b>some silly text</b>'))
@@ -316,6 +332,39 @@ class TokenizeTest(unittest.TestCase):
         #self.assertEquals([Text(u'<b />')], tokenize(u'<b />'))
         self.assertEquals([Text(u'<span style="mehhhh!">'), Text("</span>")], tokenize(u'<span style="mehhhh!"></span>'))
         
+class PinyinSegmenterTest(unittest.TestCase):
+    def testSegmentPlain(self):
+        self.assertEquals([Pinyin(u"ni", 5), Pinyin(u"hao", 5)], self.segment(u"nihao"))
+    
+    def testSegmentNumeric(self):
+        self.assertEquals([Pinyin(u"Bei", 3), Pinyin(u"jing", 1)], self.segment(u"Bei3jing1"))
+        self.assertEquals(None, self.segment(u"Bei3jing", forcenumeric=True))
+    
+    def testSegmentToneMarks(self):
+        self.assertEquals([Pinyin(u"zhong", 1), Pinyin(u"wen", 2)], self.segment(u"zhōngwén"))
+        self.assertEquals([Pinyin(u"nü", 3), Pinyin(u"er", 2)], self.segment(u"nǚér"))
+    
+    def testSegmentUUmlaut(self):
+        self.assertEquals([Pinyin(u"nü", 3), Pinyin(u"ren", 2)], self.segment(u"nv3ren2"))
+    
+    def testSegmentPrefersLongestSyllable(self):
+        self.assertEquals([Pinyin(u"xian", 1)], self.segment(u"xian1"))
+    
+    def testSegmentBacktracks(self):
+        self.assertEquals([Pinyin(u"jian", 5), Pinyin(u"gu", 5)], self.segment(u"jiangu"))
+    
+    def testSegmentErhua(self):
+        self.assertEquals([Pinyin(u"yi", 4), Pinyin(u"dian", 3), Pinyin(u"r", 5)], self.segment(u"yi4dian3r"))
+    
+    def testSegmentRejectsNonPinyin(self):
+        self.assertEquals(None, self.segment(u"hello"))
+        self.assertEquals(None, self.segment(u"nǐhǎoǚ"))
+        self.assertEquals(None, self.segment(u"xǐ3"))
+    
+    # Test helpers
+    def segment(self, text, forcenumeric=False):
+        return pinyinsegmenter().segment(text, forcenumeric=forcenumeric)
+
 class PinyinTonifierTest(unittest.TestCase):
     def testEasy(self):
         self.assertEquals(PinyinTonifier().tonify(u"Han4zi4 bu4 mie4, Zhong1guo2 bi4 wang2!"),
@@ -344,6 +393,25 @@ class FlattenTest(unittest.TestCase):
     def testUsesWrittenTone(self):
         self.assertEquals(flatten([Word(Pinyin("hen", ToneInfo(written=2,spoken=3)))]), "hen2")
 
+    def testFlattenBareTokens(self):
+        self.assertEquals(flatten([Pinyin.parse(u"hen3"), Text(u"!")]), u"hen3!")
+
+    def testFlattenColored(self):
+        self.assertEquals(flatten([Word(Pinyin(u"ni", 3, { "color" : "#00aa00" }), Pinyin(u"hao", 3, { "color" : "#00aa00" })), Word(Text(u"!"))]),
+                          u'<span style="color:#00aa00">ni3</span><span style="color:#00aa00">hao3</span>!')
+
+    def testFlattenCoalesced(self):
+        self.assertEquals(flatten([Word(Pinyin(u"ni", 3, { "color" : "#00aa00" }), Pinyin(u"hao", 3, { "color" : "#00aa00" }), Pinyin(u"ma", 5, { "color" : "#545454" })), Word(Text(u"!"))], coalesce=True),
+                          u'<span style="color:#00aa00">ni3hao3</span><span style="color:#545454">ma</span>!')
+
+    def testFlattenCoalescedAcrossWhitespace(self):
+        self.assertEquals(flatten([Word(Pinyin(u"ni", 3, { "color" : "#00aa00" })), Word(Text(u" ")), Word(Pinyin(u"hao", 3, { "color" : "#00aa00" })), Word(Text(u" ")), Word(Pinyin(u"ma", 5, { "color" : "#545454" })), Word(Text(u" "))], coalesce=True),
+                          u'<span style="color:#00aa00">ni3 hao3</span> <span style="color:#545454">ma</span> ')
+
+    def testFlattenColorClasses(self):
+        self.assertEquals(flatten([Word(Pinyin(u"ni", 3, { "color" : "#00aa00" }), Pinyin(u"ma", 5, { "color" : "#abcdef" }))], colorclasses={ "#00aa00" : "tone3" }),
+                          u'<span class="tone3">ni3</span><span style="color:#abcdef">ma</span>')
+
 class NeedsSpaceBeforeAppendTest(unittest.TestCase):
     def testEmptyDoesntNeedSpace(self):
         self.assertFalse(needsspacebeforeappend([]))
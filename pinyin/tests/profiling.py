@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from pinyin.profiling import *
+
+
+class NoteTimingsTest(unittest.TestCase):
+    def testRecordByNoteAndStage(self):
+        timings = NoteTimings()
+        timings.startnote("note 1")
+        timings.add("meanings", 1.0)
+        timings.add("meanings", 2.0)
+        timings.startnote("note 2")
+        timings.add("meanings", 4.0)
+        timings.add("flush", 8.0)
+        self.assertEquals(timings.notes, { "note 1" : { "meanings" : 3.0 }, "note 2" : { "meanings" : 4.0, "flush" : 8.0 } })
+        self.assertEquals(timings.totals, { "meanings" : (7.0, 3), "flush" : (8.0, 1) })
+    
+    def testTimedReturnsResult(self):
+        self.assertEquals(NoteTimings().timed("meanings", lambda: "result"), "result")
+    
+    def testNestedStagesNotCountedTwice(self):
+        timings = NoteTimings()
+        timings.startnote("note")
+        timings.timed("meanings", lambda: timings.timed("translation", lambda: time.sleep(0.05)))
+        self.assertTrue(timings.notes["note"]["translation"] >= 0.04)
+        self.assertTrue(timings.notes["note"]["meanings"] < 0.04)
+    
+    def testSlowest(self):
+        timings = NoteTimings()
+        for note, seconds in [("fast", 1.0), ("slow", 3.0), ("middling", 2.0)]:
+            timings.startnote(note)
+            timings.add("flush", seconds)
+        self.assertEquals([note for note, total, breakdown in timings.slowest(2)], ["slow", "middling"])
+    
+    def testReport(self):
+        timings = NoteTimings()
+        timings.startnote(u"note 1 (书)")
+        timings.add("flush", 0.5)
+        timings.add("segmentation", 0.25)
+        report = timings.report()
+        self.assertTrue(report.startswith(u"Time spent in each stage, over 1 notes:"))
+        self.assertTrue(report.index(u"segmentation") < report.index(u"flush"))
+        self.assertTrue(u"750.0ms  note 1 (书): segmentation 250.0ms, flush 500.0ms" in report)
+    
+    def testWrite(self):
+        timings = NoteTimings()
+        timings.startnote(u"note 1 (书)")
+        timings.add("flush", 0.5)
+        
+        path = tempfile.mktemp()
+        try:
+            timings.write(path)
+            self.assertEquals(codecs.open(path, "r", "utf-8").read(), timings.report())
+        finally:
+            os.remove(path)
+
+class RecordingTest(unittest.TestCase):
+    def testNothingRecordedByDefault(self):
+        self.assertEquals(timed("flush", lambda: "result"), "result")
+    
+    def testRecording(self):
+        timings = NoteTimings()
+        def work():
+            startnote("note")
+            return timed("flush", lambda: "result")
+        
+        self.assertEquals(recording(timings, work), "result")
+        self.assertEquals(timings.notes.keys(), ["note"])
+        
+        # Once we are done, nothing more is recorded
+        timed("flush", lambda: None)
+        self.assertEquals(timings.totals["flush"][1], 1)
+    
+    def testOtherThreadsNotRecorded(self):
+        timings = NoteTimings()
+        def work():
+            other = threading.Thread(target=lambda: timed("translation", lambda: None))
+            other.start()
+            other.join()
+            return timed("flush", lambda: None)
+        
+        recording(timings, work)
+        self.assertEquals(timings.totals.keys(), ["flush"])
+    
+    def testElsewhere(self):
+        timings = NoteTimings()
+        def run(action):
+            # Stands in for something that waits for another thread, doing other work while it does
+            timed("flush", lambda: None)
+            outcome = []
+            other = threading.Thread(target=lambda: outcome.append(action()))
+            other.start()
+            other.join()
+            return outcome[0]
+        
+        self.assertEquals(recording(timings, lambda: elsewhere(run, lambda: timed("meanings", lambda: "result"))), "result")
+        self.assertEquals(timings.totals.keys(), ["meanings"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from pinyin.resultcache import *
+
+
+class ResultCacheTest(unittest.TestCase):
+    def testMiss(self):
+        self.assertEquals(ResultCache().get((u"书", "reading")), None)
+    
+    def testHit(self):
+        cache = ResultCache()
+        cache.put((u"书", "reading"), u"shū")
+        self.assertEquals(cache.get((u"书", "reading")), u"shū")
+    
+    def testNone(self):
+        cache = ResultCache()
+        cache.put((u"书", "mw"), None)
+        self.assertEquals(cache.get((u"书", "mw"), u"default"), None)
+        self.assertEquals(cache.get((u"马", "mw"), u"default"), u"default")
+    
+    def testKeysDistinguished(self):
+        cache = ResultCache()
+        cache.put((u"书", "reading"), u"shū")
+        cache.put((u"书", "meaning"), u"book")
+        self.assertEquals((cache.get((u"书", "reading")), cache.get((u"书", "meaning"))), (u"shū", u"book"))
+    
+    def testReplace(self):
+        cache = ResultCache()
+        cache.put((u"书", "reading"), u"shu1")
+        cache.put((u"书", "reading"), u"shū")
+        self.assertEquals(cache.get((u"书", "reading")), u"shū")
+        self.assertEquals(len(cache), 1)
+    
+    def testHitRate(self):
+        cache = ResultCache()
+        cache.put((u"书",), u"shū")
+        cache.get((u"书",))
+        cache.get((u"书",))
+        cache.get((u"马",))
+        cache.get((u"书",))
+        self.assertEquals((cache.hits, cache.misses), (3, 1))
+        self.assertEquals(cache.report(), "Result cache: 3 hits and 1 misses (75.0% hit rate), 1 entries, 0 evicted")
+    
+    def testEvictLeastRecentlyUsed(self):
+        cache = ResultCache(maxentries=10)
+        for n in range(10):
+            cache.put((n,), unicode(n))
+        
+        # Using the first entry makes the second the least recently used
+        cache.get((0,))
+        cache.put((10,), u"10")
+        
+        self.assertEquals(len(cache), 9)
+        self.assertEquals([cache.get((n,)) for n in [0, 1, 2, 10]], [u"0", None, None, u"10"])
+        self.assertEquals(cache.evictions, 2)
+    
+    def testPersist(self):
+        path = tempfile.mktemp()
+        try:
+            cache = ResultCache(path)
+            cache.put((u"书", "reading"), u"shū")
+            cache.get((u"书", "reading"))
+            
+            cache = ResultCache(path)
+            self.assertEquals(cache.get((u"书", "reading")), u"shū")
+            self.assertEquals(len(cache), 1)
+        finally:
+            os.remove(path)
+    
+    def testShared(self):
+        path = tempfile.mktemp()
+        try:
+            first, second = ResultCache(path), ResultCache(path)
+            first.put((u"书", "reading"), u"shū")
+            first.get((u"书", "reading"))
+            
+            # NB: this would have to wait for the first to finish writing if it left a transaction open
+            second.put((u"马", "reading"), u"mǎ")
+            self.assertEquals((first.get((u"马", "reading")), second.get((u"书", "reading"))), (u"mǎ", u"shū"))
+            self.assertEquals(second.misses, 0)
+        finally:
+            os.remove(path)
+    
+    def testStartAfreshIfDamaged(self):
+        path = tempfile.mktemp()
+        try:
+            open(path, "wb").write("rubbish" * 1000)
+            cache = ResultCache(path)
+            self.assertEquals(cache.get((u"书", "reading")), None)
+            cache.put((u"书", "reading"), u"shū")
+            self.assertEquals(cache.get((u"书", "reading")), u"shū")
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import array
 import unittest
 
 from pinyin.db import database
@@ -70,6 +71,69 @@ class CharacterColorizerTest(unittest.TestCase):
     def colorize(self, what):
         return flatten(colorize(colorlist, englishdict.tonedchars(what)))
 
+class ToneColorClassesTest(unittest.TestCase):
+    def testClasses(self):
+        colorclasses = tonecolorclasses(colorlist)
+        self.assertEquals(colorclasses[u"#ff0000"], "tone1")
+        self.assertEquals(colorclasses[u"#545454"], "tone5")
+        self.assertEquals(colorclasses[sandhifycolor(u"#00aa00")], "tone3s")
+    
+    def testCompactColorize(self):
+        self.assertEquals(flatten(colorize(colorlist, englishdict.tonedchars(u"小小!")), coalesce=True, colorclasses=tonecolorclasses(colorlist)),
+            u'<span class="tone3">小小</span>!')
+
+class TonePaletteTest(unittest.TestCase):
+    def testColors(self):
+        palette = tonepalette(colorlist)
+        self.assertEquals(palette.color(3, 3), u"#00aa00")
+        self.assertEquals(palette.color(3, 2), u"#66cc66")
+        self.assertEquals(palette.color(5, 5), u"#545454")
+    
+    def testShared(self):
+        self.assertTrue(tonepalette(colorlist) is tonepalette(list(colorlist)))
+        self.assertFalse(tonepalette(colorlist) is tonepalette(list(reversed(colorlist))))
+    
+    def testOpenTags(self):
+        palette = tonepalette(colorlist)
+        self.assertEquals(palette.styleopentags[u"#66cc66"], u'<span style="color:#66cc66">')
+        self.assertEquals(palette.classopentags[u"#66cc66"], u'<span class="tone3s">')
+    
+    def testNoSandhifyingPerToken(self):
+        tonepalette(colorlist)
+        before = colorwork.copy()
+        render(englishdict.reading(u"我很好") * 10, colorlist=colorlist, sandhi=True)
+        colorize(colorlist, tonesandhi(englishdict.tonedchars(u"我很好")))
+        self.assertEquals(colorwork["palettes"], before["palettes"])
+        self.assertEquals(colorwork["sandhifications"], before["sandhifications"])
+        self.assertTrue(colorwork["colored"] > before["colored"])
+
+class RenderTest(unittest.TestCase):
+    def testPlain(self):
+        self.assertEquals(render(englishdict.reading(u"你好")), u"ni3 hao3")
+    
+    def testColorize(self):
+        self.assertEquals(render(englishdict.tonedchars(u"小小!"), colorlist=colorlist),
+            u'<span style="color:#00aa00">小</span><span style="color:#00aa00">小</span>!')
+    
+    def testSandhi(self):
+        self.assertEquals(render(englishdict.tonedchars(u"小小"), colorlist=colorlist, sandhi=True),
+            u'<span style="color:#66cc66">小</span><span style="color:#00aa00">小</span>')
+    
+    def testSandhiConsumesUserColoredTones(self):
+        words = [Word(Pinyin("hen", 3, { "color" : "red" })), Word(Pinyin("hao", 3)), Word(Pinyin("ma", 3))]
+        self.assertEquals(render(words, colorlist=colorlist, sandhi=True),
+            u'<span style="color:red">hen3</span><span style="color:#00aa00">hao3</span><span style="color:#00aa00">ma3</span>')
+    
+    def testSandhiBareTokens(self):
+        self.assertEquals(render([Pinyin("hen", 3), Text(" "), Pinyin("hao", 3)], colorlist=colorlist, sandhi=True, tonify=True),
+            u'<span style="color:#66cc66">hěn</span> <span style="color:#00aa00">hǎo</span>')
+    
+    def testMatchesMultiStepPipeline(self):
+        for expression in [u"酒水饮料", u"我很好", u"Small 小 - Horse", u"哪兒"]:
+            for words in [englishdict.reading(expression), englishdict.tonedchars(expression)]:
+                self.assertEquals(render(words, colorlist=colorlist, sandhi=True, tonify=True, coalesce=True),
+                                  flatten(colorize(colorlist, tonesandhi(words)), tonify=True, coalesce=True))
+
 class PinyinAudioReadingsTest(unittest.TestCase):
     default_raw_available_media = ["na3.mp3", "ma4.mp3", "xiao3.mp3", "ma3.mp3", "ci2.mp3", "dian3.mp3",
                                    "wu3.mp3", "nin2.mp3", "ni3.ogg", "hao3.ogg", "gen1.ogg", "gen1.mp3"]
@@ -155,6 +219,16 @@ class PinyinAudioReadingsTest(unittest.TestCase):
         self.assertFalse(mediamissing)
         self.assertEquals(output, ["ma3.mp3"])
 
+    def testNoPacks(self):
+        self.assertEquals(PinyinAudioReadings([], [".mp3"]).audioreading(englishdict.reading(u"你")), (None, [], True))
+
+    def testReuseForSeveralReadings(self):
+        packs = [MediaPack("Foo", {"ni3.mp3" : "ni3.mp3"}), MediaPack("Bar", {"hao3.mp3" : "hao3.mp3", "ma3.mp3" : "ma3.mp3"})]
+        audioreadings = PinyinAudioReadings(packs, [".mp3"])
+        self.assertEquals(audioreadings.audioreading(englishdict.reading(u"你")), (packs[0], ["ni3.mp3"], False))
+        self.assertEquals(audioreadings.audioreading(englishdict.reading(u"好马")), (packs[1], ["hao3.mp3", "ma3.mp3"], False))
+        self.assertEquals(audioreadings.audioreading(englishdict.reading(u"你好马")), (packs[1], ["hao3.mp3", "ma3.mp3"], True))
+
     # Test helpers
     def assertHasReading(self, what, shouldbe, **kwargs):
         bestpackshouldbe, mediapack, output, mediamissing = self.audioreading(what, **kwargs)
@@ -220,6 +294,35 @@ class ToneSandhiTest(unittest.TestCase):
         # compound 饮料 - modified to take the new information into account:
         self.assertSandhi(*(englishdict.reading(u"酒水饮料") + ["jiu2 shui2 yin3 liao4"]))
     
+    def testEmptyWords(self):
+        self.assertSandhi(Word(Pinyin.parse("ni3")), Word(), Word(), Word(Pinyin.parse("hao3")), "ni2hao3")
+    
+    def testLongRun(self):
+        self.assertSandhi(Word(Pinyin.parse("wo3")), Word(Pinyin.parse("ye3")), Word(Pinyin.parse("hen3")), Word(Pinyin.parse("hao3")), "wo2ye3hen2hao3")
+    
+    def testTextBlocksSandhi(self):
+        self.assertSandhi(Word(Pinyin.parse("hen3")), Word(Text("!")), Word(Pinyin.parse("hao3")), "hen3!hao3")
+    
+    def testTonedCharacters(self):
+        sandhied = tonesandhi([Word(TonedCharacter(u"很", 3), TonedCharacter(u"好", 3))])
+        self.assertEquals(sandhied, [Word(TonedCharacter(u"很", ToneInfo(written=3, spoken=2)), TonedCharacter(u"好", 3))])
+    
+    def testKeepsHtmlAttrs(self):
+        sandhied = tonesandhi([Word(Pinyin("hen", 3, { "color" : "red" }), Pinyin("hao", 3, { "color" : "blue" }))])
+        self.assertEquals(sandhied, [Word(Pinyin("hen", ToneInfo(written=3, spoken=2), { "color" : "red" }), Pinyin("hao", 3, { "color" : "blue" }))])
+    
+    def testReusesUnchangedTokens(self):
+        words = [Word(Pinyin.parse("hen3"), Pinyin.parse("hao3"))]
+        self.assertTrue(tonesandhi(words)[0][1] is words[0][1])
+    
+    def testBatch(self):
+        sentences = [[Word(Pinyin.parse("hen3"))], [Word(Pinyin.parse("hao3"))], [Word(Pinyin.parse("ni3")), Word(Pinyin.parse("hao3"))], []]
+        self.assertEquals(tonesandhibatch(sentences), [tonesandhi(sentence) for sentence in sentences])
+    
+    def testSandhiContour(self):
+        contour = gathertonecontour([Word(Pinyin.parse("bao3"), Pinyin.parse("guan3")), Word(Pinyin.parse("hao3")), Word(Text(" ")), Word(Text("?"))], array.array('b'))
+        self.assertEquals(list(sandhicontour(contour)), [2, 2, contourwordboundary, 3, contourwordboundary, contourwordboundary, contourblocker, contourwordboundary])
+    
     # TODO: improve tone sandhi such that the following tests pass:
     #
     # def testYiFollowedByFour(self):
@@ -294,6 +397,18 @@ class MaskHanziTest(unittest.TestCase):
         self.assertEquals(maskhanzi(u"没有", "XXX", [Word(TonedCharacter(u"没", 2)), Word(TonedCharacter(u"没", 2)), Word(TonedCharacter(u"有", 2)), Word(TonedCharacter(u"有", 2)), Word(Text(u"没有 le he said 有 to me! 没有!"))]),
                           [Word(Text("XXX")), Word(Text("XXX")), Word(Text("XXX")), Word(Text("XXX")), Word(Text("XXX le he said XXX to me! XXX!"))])
 
+    def testLongestFirst(self):
+        self.assertEquals(maskhanzi(u"我喜欢你", "~", [Word(Text(u"我喜欢 / 喜欢你 / 你我"))]), [Word(Text(u"~ / ~ / ~~"))])
+    
+    def testLongerRunsWinOverEarlierOnes(self):
+        # 你你 is masked before 喜你, even though 喜你 comes first in the text
+        self.assertEquals(maskhanzi(u"你你喜你", "~", [Word(Text(u"喜你你你"))]), [Word(Text(u"~~~"))])
+    
+    def testMaskerReusedForSeveralMeanings(self):
+        masker = HanziMasker(u"爱", "~")
+        self.assertEquals([masker.mask(meaning) for meaning in [[Word(Text(u"爱"))], [Word(Text(u"love"))]]],
+                          [[Word(Text(u"~"))], [Word(Text(u"love"))]])
+    
     def testDontMaskWesternForms(self):
         self.assertEquals(maskhanzi("1000AD", "XXX", [Word(Text(u"In 1000AD..."))]), [Word(Text(u"In 1000AD..."))])
 
@@ -5,6 +5,7 @@ import unittest
 
 from pinyin.config import *
 from pinyin.db import database
+from pinyin.resultcache import ResultCache
 from pinyin.updater import *
 from pinyin.utils import Thunk
 from pinyin.mocks import *
@@ -35,6 +36,11 @@ class FieldUpdaterFromAudioTest(unittest.TestCase):
             self.updatefact(u"hen3,hǎo", { "audio" : "junky" }, forcepinyininaudiotosoundtags = True),
             { "audio" : henhaoaudio })
     
+    def testSegmentsRunOnPinyin(self):
+        self.assertEquals(
+            self.updatefact(u"hen3hao3", { "audio" : "junky" }, forcepinyininaudiotosoundtags = True),
+            { "audio" : u"[sound:" + os.path.join("Test", "hen3.mp3") + "][sound:" + os.path.join("Test", "hao3.mp3") + "]" })
+    
     def testDoesntModifySoundTags(self):
         self.assertEquals(
             self.updatefact(u"[sound:aeuth34t0914bnu.mp3][sound:ae390n32uh2ub.mp3]", { "audio" : "" }, forcepinyininaudiotosoundtags = True),
@@ -62,6 +68,64 @@ class FieldUpdaterFromAudioTest(unittest.TestCase):
 
         return notifier.infos, factclone
 
+class GenerateAudioTest(unittest.TestCase):
+    def testSeparateSounds(self):
+        def do(mediadir, pack):
+            self.assertEquals(self.generateaudio(mediadir, pack, u"你好"), u"[sound:%s][sound:%s]" % (os.path.join(pack.packpath, "ni3.mp3"), os.path.join(pack.packpath, "hao3.mp3")))
+        
+        self.withpack(do)
+    
+    def testConcatenate(self):
+        def do(mediadir, pack):
+            output = self.generateaudio(mediadir, pack, u"你好", concatenateaudio = True)
+            concatenated = re.match(ur"\[sound:(.*)\]$", output).group(1)
+            self.assertEquals(open(concatenated, "rb").read(), "NI3HAO3")
+            
+            # The same reading should come out of the same file
+            self.assertEquals(self.generateaudio(mediadir, pack, u"你好", concatenateaudio = True), output)
+        
+        self.withpack(do)
+    
+    def testConcatenateWithGaps(self):
+        def do(mediadir, pack):
+            output = self.generateaudio(mediadir, pack, u"你好, 好", concatenateaudio = True)
+            concatenated = re.match(ur"\[sound:(.*)\]$", output).group(1)
+            self.assertEquals(open(concatenated, "rb").read(), "NI3HAO3" + media.mp3frames(open(silencepath, "rb").read()) + "HAO3")
+        
+        self.withpack(do)
+    
+    def testDontConcatenateSingleSound(self):
+        def do(mediadir, pack):
+            self.assertEquals(self.generateaudio(mediadir, pack, u"你", concatenateaudio = True), u"[sound:%s]" % os.path.join(pack.packpath, "ni3.mp3"))
+        
+        self.withpack(do)
+    
+    def testDontConcatenateOtherFormats(self):
+        def do(mediadir, pack):
+            self.assertEquals(self.generateaudio(mediadir, pack, u"你马", concatenateaudio = True),
+                              u"[sound:%s][sound:%s]" % (os.path.join(pack.packpath, "ni3.mp3"), os.path.join(pack.packpath, "ma3.ogg")))
+        
+        self.withpack(do)
+    
+    # Test helpers
+    def withpack(self, do):
+        def inner(mediadir):
+            packpath = os.path.join(mediadir, "Pack")
+            os.mkdir(packpath)
+            for filename, contents in [("ni3.mp3", "NI3"), ("hao3.mp3", "HAO3"), ("ma3.ogg", "MA3")]:
+                file = open(os.path.join(packpath, filename), "wb")
+                file.write(contents)
+                file.close()
+            
+            do(mediadir, media.MediaPack.frompath(packpath))
+        
+        utils.withtempdir(inner)
+    
+    def generateaudio(self, mediadir, pack, reading, **kwargs):
+        mediamanager = MockMediaManager([pack], themediadir=mediadir)
+        config = Config(utils.updated({ "audioextensions" : [".mp3", ".ogg"] }, kwargs))
+        return generateaudio(MockNotifier(), mediamanager, config, englishdict.reading(reading))
+
 class FieldUpdaterFromMeaningTest(unittest.TestCase):
     def testDoesntDoAnythingWhenDisabled(self):
         self.assertEquals(self.updatefact(u"(1) yes (2) no", { "meaning" : "", "expression" : "junk" }, forcemeaningnumberstobeformatted = False),
@@ -116,6 +180,20 @@ class FieldUpdaterFromReadingTest(unittest.TestCase):
                 colorizedpinyingeneration = True, tonecolors = [u"#111111", u"#222222", u"#333333", u"#444444", u"#555555"]),
                 { "reading" : u'<span style="color:#333333">hěn</span> <span style="color:#333333">hǎo</span>' })
     
+    def testReformatsCompactly(self):
+        self.assertEquals(
+            self.updatefact(u"hen3 hǎo ma", { "reading" : "junky" },
+                forcereadingtobeformatted = True, tonedisplay = "numeric", colorizedpinyingeneration = True,
+                compactcoloredhtml = True, usetonecolorclasses = True),
+                { "reading" : u'<span class="tone3">hen3 hao3</span> <span class="tone5">ma</span>' })
+    
+    def testReformatsRunOnPinyin(self):
+        self.assertEquals(
+            self.updatefact(u"nihao", { "reading" : "junky" },
+                forcereadingtobeformatted = True, tonedisplay = "numeric",
+                colorizedpinyingeneration = True, tonecolors = [u"#111111", u"#222222", u"#333333", u"#444444", u"#555555"]),
+                { "reading" : u'<span style="color:#555555">ni</span><span style="color:#555555">hao</span>' })
+    
     def testReformattingRespectsExistingColorization(self):
         self.assertEquals(
             self.updatefact(u"<span style='color: red'>hen3</span> hǎo", { "reading" : "junky" },
@@ -329,6 +407,26 @@ class FieldUpdaterFromExpressionTest(unittest.TestCase):
                   "X", "gang1", "pi2", "X"]
         self.assertEquals(mwaudio, "".join([u"[sound:" + os.path.join("MWAudio", sound + ".mp3") + "]" for sound in sounds]))
 
+    def testMeaningAndMeasureWordsFromOneLookup(self):
+        updater = FieldUpdaterFromExpression(MockNotifier(), MockMediaManager([]), Config({ "dictlanguage" : "en" }))
+        lookups = LookupCountingDictionary(updater.dictionary)
+        updater.dictionaries = lambda language: lookups
+        
+        fact = { "meaning" : "", "mw" : "" }
+        updater.updatefact(fact, u"书")
+        self.assertEquals(fact, self.updatefact(u"书", { "meaning" : "", "mw" : "" }))
+        self.assertEquals(sorted(lookups.calls), ["findmeaning", "meaningsof"])
+    
+    def testMeasureWordsLookedUpAlone(self):
+        updater = FieldUpdaterFromExpression(MockNotifier(), MockMediaManager([]), Config({ "dictlanguage" : "en" }))
+        lookups = LookupCountingDictionary(updater.dictionary)
+        updater.dictionaries = lambda language: lookups
+        
+        fact = { "meaning" : "filled", "mw" : "" }
+        updater.updatefact(fact, u"书")
+        self.assertEquals(fact["mw"], self.updatefact(u"书", { "mw" : "" })["mw"])
+        self.assertEquals(sorted(lookups.calls), ["findmeaning", "measurewordsof"])
+
     def testFallBackOnGoogleForPhrase(self):
         self.assertEquals(
             self.updatefact(u"你好，你是我的朋友吗", { "reading" : "", "meaning" : "", "mw" : "", "audio" : "", "color" : "" },
@@ -406,6 +504,93 @@ class FieldUpdaterFromExpressionTest(unittest.TestCase):
         
         return notifier.infos, factclone
 
+class LookupCountingDictionary(object):
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+        self.calls = []
+    
+    def __getattr__(self, name):
+        if name in ["findmeaning", "meaningsof", "measurewordsof"]:
+            self.calls.append(name)
+        
+        return getattr(self.dictionary, name)
+
+class FieldUpdaterFromExpressionCacheTest(unittest.TestCase):
+    def testSameAsUncached(self):
+        cache = ResultCache()
+        for _ in range(2):
+            self.assertEquals(self.updatefact(cache, u"书", { "reading" : "", "meaning" : "", "mw" : "", "color" : "" }),
+                              self.updatefact(None, u"书", { "reading" : "", "meaning" : "", "mw" : "", "color" : "" }))
+    
+    def testRemembered(self):
+        cache = ResultCache()
+        self.updatefact(cache, u"书", { "reading" : "", "color" : "" })
+        self.assertEquals((cache.hits, cache.misses, len(cache)), (0, 2, 2))
+        
+        self.updatefact(cache, u"书", { "reading" : "", "color" : "" })
+        self.assertEquals(cache.hits, 2)
+    
+    def testDontLookUpIfRemembered(self):
+        cache = ResultCache()
+        self.updatefact(cache, u"书", { "reading" : "" })
+        
+        def fail(expression):
+            raise AssertionError("Should not have looked anything up")
+        
+        self.assertEquals(self.updatefact(cache, u"书", { "reading" : "" }, getdictreading=fail)["reading"], u'<span style="color:#ff0000">shū</span>')
+    
+    def testOtherSettingsNotRemembered(self):
+        cache = ResultCache()
+        self.updatefact(cache, u"书", { "reading" : "" }, tonedisplay = "numeric")
+        self.assertEquals(self.updatefact(cache, u"书", { "reading" : "" }, tonedisplay = "tonified")["reading"], u'<span style="color:#ff0000">shū</span>')
+        self.assertEquals(cache.hits, 0)
+    
+    def testMeaningDependsOnMWField(self):
+        cache = ResultCache()
+        self.updatefact(cache, u"啤酒", { "meaning" : "", "mw" : "" })
+        self.assertEquals(self.updatefact(cache, u"啤酒", { "meaning" : "" }), self.updatefact(None, u"啤酒", { "meaning" : "" }))
+    
+    def testRememberNoValue(self):
+        cache = ResultCache()
+        self.updatefact(cache, u"书", { "trad" : "", "simp" : "", "mw" : "" }, fallbackongoogletranslate = False, tradgeneration = True, simpgeneration = True)
+        self.assertEquals(len(cache), 1)
+    
+    def testColorRememberedForConvertedExpression(self):
+        cache = ResultCache()
+        for conversion in [lambda expression, simptrad: expression, lambda expression, simptrad: u"個個"]:
+            updater = FieldUpdaterFromExpression(MockNotifier(), MockMediaManager([]), Config({ "dictlanguage" : "en", "forceexpressiontobesimptrad" : True, "prefersimptrad" : "trad",
+                                                                                                  "colorizedcharactergeneration" : True, "tonecolors" : [u"#ff0000", u"#ffaa00", u"#00aa00", u"#0000ff", u"#545454"] }), cache)
+            updater.generateincharactersystem = conversion
+            fact = { "expression" : u"", "color" : u"" }
+            updater.updatefact(fact, u"个個")
+        
+        # Google Translate couldn't be reached the first time, but that is no reason to stick with what we made then
+        self.assertEquals(fact["color"], u'<span style="color:#0000ff">個</span><span style="color:#0000ff">個</span>')
+    
+    def testSimpTradNotRemembered(self):
+        cache = ResultCache()
+        self.updatefact(cache, u"书", { "trad" : "", "simp" : "" }, tradgeneration = True, simpgeneration = True)
+        self.assertEquals(len(cache), 0)
+    
+    def testAudioNotRemembered(self):
+        cache = ResultCache()
+        self.updatefact(cache, u"书", { "reading" : "", "audio" : "" })
+        self.assertEquals(len(cache), 1)
+    
+    # Test helpers
+    def updatefact(self, cache, expression, fact, getdictreading=None, **kwargs):
+        mediapacks = [media.MediaPack("Test", { "shu1.mp3" : "shu1.mp3" })]
+        settings = utils.updated({ "dictlanguage" : "en", "colorizedpinyingeneration" : True, "colorizedcharactergeneration" : True, "tonedisplay" : "tonified",
+                                   "audioextensions" : [".mp3"], "tonecolors" : [u"#ff0000", u"#ffaa00", u"#00aa00", u"#0000ff", u"#545454"] }, kwargs)
+        
+        updater = FieldUpdaterFromExpression(MockNotifier(), MockMediaManager(mediapacks), Config(settings), cache)
+        if getdictreading is not None:
+            updater.getdictreading = getdictreading
+        
+        factclone = copy.deepcopy(fact)
+        updater.updatefact(factclone, expression)
+        return factclone
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import array
 import copy
-import cStringIO
 import random
 import re
 
+import characters
 from logger import log
 from model import *
 from utils import *
@@ -21,88 +22,135 @@ see: <http://en.wikipedia.org/wiki/Standard_Mandarin#Tone_sandhi>
 NB: we don't implement this very well yet. Give it time..
 """
 def tonesandhi(words):
-    # 1) Gather the tone contour into a string
-    tonecontourio = cStringIO.StringIO()
-    gathervisitor = GatherToneContourVisitor(tonecontourio)
-    for word in words:
-        word.accept(gathervisitor)
-        tonecontourio.write("~")
-    tonecontour = tonecontourio.getvalue()
-    tonecontourio.close()
+    return tonesandhibatch([words])[0]
+
+"""
+Apply tone sandhi to each of a list of sentences. The sentences don't affect each other,
+but we gather all of their tones into one contour so the rules only have to run once.
+"""
+def tonesandhibatch(sentences):
+    # 1) Gather the tone contour into an array. A blocker after each sentence stops sandhi leaking between them
+    contour = array.array('b')
+    for words in sentences:
+        gathertonecontour(words, contour)
+        contour.append(contourblocker)
     
+    # 2) Work out the spoken tones
+    spoken = sandhicontour(contour)
     
-    # 2) Rewrite it (ewww!)
+    # 3) Apply the new contour to the words, reusing any token whose spoken tone is unchanged
+    results, i = [], 0
+    for words in sentences:
+        finalwords = []
+        for word in words:
+            finalword = Word()
+            for token in word:
+                if isinstance(token, Text):
+                    if len(token.strip()) != 0:
+                        i += 1
+                else:
+                    if spoken[i] != token.toneinfo.spoken:
+                        token = withspokentone(token, spoken[i])
+                    i += 1
+                
+                finalword.append(token)
+            
+            finalwords.append(finalword)
+            i += 1
+        
+        results.append(finalwords)
+        i += 1
     
-    log.info("Rewriting tone sandhi for contour %s", tonecontour)
+    return results
+
+# Codes used in the tone contour array alongside the tones 1 to 5 themselves
+contourwordboundary = 0
+contourblocker = -1
+
+"""
+Appends the tone contour of the words to the array: the written tone of each toned token,
+a blocker for each bit of non-blank text, and a boundary at the end of each word.
+"""
+def gathertonecontour(words, contour):
+    for word in words:
+        for token in word:
+            if isinstance(token, Text):
+                if len(token.strip()) != 0:
+                    contour.append(contourblocker)
+            else:
+                contour.append(token.toneinfo.written)
+        
+        contour.append(contourwordboundary)
     
-    # NB: must match strings of ~ in the following in order to ignore words
-    # which consist entirely of blank space. Tian'a, this is unbelievably horrible!
+    return contour
+
+def withspokentone(token, spoken):
+    toneinfo = ToneInfo(written=token.toneinfo.written, spoken=spoken)
+    if isinstance(token, Pinyin):
+        return Pinyin(token.word, toneinfo, token.htmlattrs)
+    else:
+        return TonedCharacter(unicode(token), toneinfo, token.htmlattrs)
+
+"""
+Given a tone contour as built by gathertonecontour, returns an array of the same length with
+the spoken tone at each position. This makes two linear passes over the array.
+"""
+def sandhicontour(contour):
+    spoken = array.array('b', contour)
+    n = len(spoken)
     
     # Top priority:
     #  33~3 -> 22~3
     #  3~33 -> 3~23
-    # (and the more general sandhi effect with strings of length > 3)
-    def dealWithThrees(match):
-        # a) Split the match into a list of strings of 3 per word
-        wordcontours = (match.group(1) or "").split("~")[:-1] + [match.group(2)]
+    # (and the more general sandhi effect with longer runs of third tones, possibly
+    # spanning several words). Empty words are just extra boundaries, so we skip over them.
+    i = 0
+    while i < n:
+        if spoken[i] != 3:
+            i += 1
+            continue
+        
+        # a) Find the extent of the run, which must end with a third tone
+        end, last = i, i
+        while end < n and (spoken[end] == 3 or spoken[end] == contourwordboundary):
+            if spoken[end] == 3:
+                last = end
+            end += 1
+        
+        # b) Rewrite each word's part of the run
+        wordstart = i
+        for j in xrange(i, last + 1):
+            if spoken[j] == contourwordboundary:
+                #   i) For everything but the last word, turn the tone into 2 if it is polysyllabic
+                if j - wordstart > 1:
+                    for k in xrange(wordstart, j):
+                        spoken[k] = 2
+                wordstart = j + 1
         
-        # b) Build the result
-        #   i) For everything but the last word, turn the tone into 2 if it is monosyllabic
-        maketwosifpoly = lambda what: len(what) == 1 and what or '2' * len(what)
         #   ii) For the last word, always end with a sequence of 2s followed by a 3
-        makeprefixtwos = lambda what: '2' * (len(what) - 1) + '3'
-        replacement = "~".join([maketwosifpoly(wordcontour) for wordcontour in wordcontours[:-1]] + [makeprefixtwos(wordcontours[-1])])
+        for k in xrange(wordstart, last):
+            spoken[k] = 2
         
-        log.debug("Rewrote complex tone sandhi %s into %s", match.group(0), replacement)
-        return replacement
-    tonecontour = re.sub(r"((?:3+\~+)*)(3+)", dealWithThrees, tonecontour)
+        i = end
     
     # Low priority (let others take effect first):
     #  33  -> 23 (though this is already caught by the code above, actually)
     #  3~3 -> 2~3
-    tonecontour = re.sub(r"3(\~*)3", r"2\g<1>3", tonecontour)
-    
-    log.info("Final contour computed as %s", tonecontour)
-    
-    # 3) Apply the new contour to the words
-    finalwords = []
-    tonecontourqueue = list(tonecontour[::-1])
-    applyvisitor = ApplyToneContourVisitor(tonecontourqueue)
-    for word in words:
-        finalwords.append(word.map(applyvisitor))
-        p = tonecontourqueue.pop()
-        assert p == "~"
-    return finalwords
-
-class GatherToneContourVisitor(TokenVisitor):
-    def __init__(self, tonecontourio):
-        self.tonecontourio = tonecontourio
-
-    def visitText(self, text):
-        if len(text.strip()) != 0:
-            self.tonecontourio.write("_")
-
-    def visitPinyin(self, pinyin):
-        self.tonecontourio.write(str(pinyin.toneinfo.written))
+    i = 0
+    while i < n:
+        if spoken[i] == 3:
+            j = i + 1
+            while j < n and spoken[j] == contourwordboundary:
+                j += 1
+            
+            if j < n and spoken[j] == 3:
+                spoken[i] = 2
+                i = j + 1
+                continue
         
-    def visitTonedCharacter(self, tonedcharacter):
-        self.tonecontourio.write(str(tonedcharacter.toneinfo.written))
-
-class ApplyToneContourVisitor(TokenVisitor):
-    def __init__(self, tonecontourqueue):
-        self.tonecontourqueue = tonecontourqueue
+        i += 1
     
-    def visitText(self, text):
-        if len(text.strip()) != 0:
-            p = self.tonecontourqueue.pop()
-            assert p in "_"
-        return text
-
-    def visitPinyin(self, pinyin):
-        return Pinyin(pinyin.word, ToneInfo(written=pinyin.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
-    
-    def visitTonedCharacter(self, tonedcharacter):
-        return TonedCharacter(unicode(tonedcharacter), ToneInfo(written=tonedcharacter.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
+    return spoken
 
 """
 Remove all r5 characters from the supplied words.
@@ -133,12 +181,12 @@ Colorize readings according to the reading in the Pinyin.
 * 2009 original version by Nick Cook <nick@n-line.co.uk> (http://www.n-line.co.uk)
 """
 def colorize(colorlist, words):
-    return [word.map(ColorizerVisitor(colorlist)) for word in words]
+    visitor = ColorizerVisitor(colorlist)
+    return [word.map(visitor) for word in words]
 
 class ColorizerVisitor(TokenVisitor):
     def __init__(self, colorlist):
-        self.colorlist = colorlist
-        log.info("Using color list %s", self.colorlist)
+        self.palette = tonepalette(colorlist)
         
     def visitText(self, text):
         return text
@@ -150,29 +198,82 @@ class ColorizerVisitor(TokenVisitor):
         return self.colorize(tonedcharacter, lambda htmlattrs: TonedCharacter(unicode(tonedcharacter), tonedcharacter.toneinfo, htmlattrs))
     
     def colorize(self, token, rebuild):
-        # Colors should always be based on the written tone, but they will be
-        # made lighter if a sandhi applies
-        color = self.colorlist[token.toneinfo.written - 1]
-        if token.toneinfo.spoken != token.toneinfo.written:
-            color = sandhifycolor(color)
-        
         # Make sure we don't overwrite any colors that the user set up.
         # Perhaps this is suboptimal, but it is the only sane thing to do -
         # in particular since it means we don't screw up sandhi coloring
         # when coloring a "Reading" field which was set up by the PyTK.
         if "color" not in token.htmlattrs:
             htmlattrs = token.htmlattrs.copy()
-            htmlattrs["color"] = color
+            htmlattrs["color"] = self.palette.color(token.toneinfo.written, token.toneinfo.spoken)
             return rebuild(htmlattrs)
         else:
             return token
 
+"""
+Renders the words straight to HTML, doing the job of tonesandhi, colorize and flatten in one
+go without building any intermediate lists of words. If a color list is supplied then tokens
+are colored just as colorize would, and if sandhi is set then the spoken tones are worked out
+just as tonesandhi would first. The remaining options are passed on to flatten.
+"""
+def render(words, colorlist=None, sandhi=False, tonify=False, coalesce=False, colorclasses=None):
+    return FusedRenderer(colorlist, sandhi, tonify, coalesce, colorclasses).render(words)
+
+class FusedRenderer(FlattenRenderer):
+    def __init__(self, colorlist=None, sandhi=False, tonify=False, coalesce=False, colorclasses=None):
+        FlattenRenderer.__init__(self, tonify, coalesce, colorclasses)
+        self.palette = colorlist is not None and tonepalette(colorlist) or None
+        self.sandhi = sandhi
+        self.spokentones = None
+        
+        # Use the opening tags the palette made earlier, if they are for the classes we were given
+        if self.palette is None:
+            self.opentags = {}
+        elif colorclasses is None:
+            self.opentags = self.palette.styleopentags
+        elif colorclasses is self.palette.colorclasses:
+            self.opentags = self.palette.classopentags
+        else:
+            self.opentags = {}
+    
+    def render(self, words):
+        if self.sandhi:
+            # Some callers hand us a bare list of tokens rather than a list of Words
+            words = [isinstance(word, list) and word or [word] for word in words]
+            
+            # Sandhi needs to look ahead, so we have to work out the spoken tones before we start
+            # rendering. We only want the tones themselves, in the order we will meet the tokens.
+            contour = sandhicontour(gathertonecontour(words, array.array('b')))
+            self.spokentones = iter([tone for tone in contour if tone > 0])
+        
+        return FlattenRenderer.render(self, words)
+    
+    def tokencolor(self, token):
+        if isinstance(token, Text):
+            return token.htmlattrs.get("color")
+        
+        # NB: must consume the spoken tone even if the user colored this token themselves
+        if self.spokentones is not None:
+            spoken = self.spokentones.next()
+        else:
+            spoken = token.toneinfo.spoken
+        
+        color = token.htmlattrs.get("color")
+        if color is None and self.palette is not None:
+            color = self.palette.color(token.toneinfo.written, spoken)
+        
+        return color
+    
+    def opentag(self, color):
+        return self.opentags.get(color) or FlattenRenderer.opentag(self, color)
+
 def sandhifycolor(color):
     # Lighten up the color by halving saturation and increasing value
     # by 20%. This was chosen to match Nicks choice of how to change green
     # (tone 3) when sandhi applies: he wanted to go:
     #  from 00AA00 = (120, 100, 67)
     #  to   66CC66 = (120, 50,  80)
+    colorwork["sandhifications"] += 1
+    
     r, g, b = parseHtmlColor(color)
     h, s, v = rgbToHSV(r, g, b)
     r, g, b = hsvToRGB(h, s * 0.5, min(v * 1.2, 1.0))
@@ -181,6 +282,60 @@ def sandhifycolor(color):
     log.info("Sandhified %s to %s", color, finalcolor)
     return finalcolor
 
+"""
+Everything we need to color tokens with a list of tone colors: the color for each tone and
+its sandhified variant, short CSS class names for them, and the opening span tag for each.
+Working these out is relatively expensive, so get palettes from tonepalette, which builds
+one the first time it sees a color list and shares it from then on.
+"""
+class TonePalette(object):
+    def __init__(self, colorlist):
+        log.info("Building the tone palette for the color list %s", colorlist)
+        colorwork["palettes"] += 1
+        
+        self.colors = list(colorlist)
+        self.sandhifiedcolors = [sandhifycolor(color) for color in colorlist]
+        
+        self.colorclasses = {}
+        for n, (color, sandhifiedcolor) in enumerate(zip(self.colors, self.sandhifiedcolors)):
+            self.colorclasses[sandhifiedcolor] = "tone%ds" % (n + 1)
+            self.colorclasses[color] = "tone%d" % (n + 1)
+        
+        styles, classes = FlattenRenderer(), FlattenRenderer(colorclasses=self.colorclasses)
+        self.styleopentags = dict([(color, styles.opentag(color)) for color in self.colorclasses])
+        self.classopentags = dict([(color, classes.opentag(color)) for color in self.colorclasses])
+    
+    def color(self, written, spoken):
+        # Colors should always be based on the written tone, but they will be
+        # made lighter if a sandhi applies
+        colorwork["colored"] += 1
+        if spoken != written:
+            return self.sandhifiedcolors[written - 1]
+        else:
+            return self.colors[written - 1]
+
+def tonepalette(colorlist):
+    return tonepalettes[tuple(colorlist)]
+
+# The color list only changes when the user changes their preferences
+tonepalettes = FactoryDict(TonePalette)
+
+"""
+Running totals of the work done coloring tokens, so we can check how much of it the palettes save:
+  palettes:        palettes built
+  sandhifications: colors converted to their sandhified variant
+  colored:         tokens colored
+"""
+colorwork = { "palettes" : 0, "sandhifications" : 0, "colored" : 0 }
+
+"""
+Short CSS class names for each tone color and its sandhified variant, suitable
+for passing to flatten as the colorclasses. Colors the user set up by hand
+don't appear here and so keep their inline style.
+"""
+def tonecolorclasses(colorlist):
+    return tonepalette(colorlist).colorclasses
+
 """
 Output audio reading corresponding to a textual reading.
 * 2009 rewrites by Max Bolingbroke <batterseapower@hotmail.com>
@@ -190,101 +345,122 @@ class PinyinAudioReadings(object):
     def __init__(self, mediapacks, audioextensions):
         self.mediapacks = mediapacks
         self.audioextensions = audioextensions
+        
+        # Bit i of the mask for a syllable is set if the i-th pack has a sound for it
+        self.coverages = [mediapack.coverage(audioextensions) for mediapack in mediapacks]
+        self.coveringpacks = FactoryDict(self.packscovering)
+    
+    def packscovering(self, syllable):
+        mask = 0
+        for n, coverage in enumerate(self.coverages):
+            if coverage[syllable] is not None:
+                mask |= 1 << n
+        
+        return mask
     
     def audioreading(self, tokens):
         log.info("Requested audio reading for %d tokens", len(tokens))
         
-        # Try possible packs to format the tokens. Basically, we
-        # don't want to use a mix of sounds from different packs
-        bestmediapacksoutputs, bestmediamissingcount = [], len(tokens) + 1
-        for mediapack in self.mediapacks:
-            log.info("Checking for reading in pack %s", mediapack.name)
-            output, mediamissingcount = audioreadingforpack(mediapack, self.audioextensions, trimerhua(tokens))
-            
-            # We will end up choosing one of the packs that minimizes the number of errors:
-            if mediamissingcount == bestmediamissingcount:
-                # Just as good as a previous pack, so this is an alternative
-                bestmediapacksoutputs.append((mediapack, output))
-            elif mediamissingcount < bestmediamissingcount:
-                # Strictly better than the previous ones, so this is the new best option
-                bestmediapacksoutputs = [(mediapack, output)]
-                bestmediamissingcount = mediamissingcount
-        
         # Did we get any result at all?
-        if len(bestmediapacksoutputs) != 0:
-            bestmediapack, bestoutput = random.choice(bestmediapacksoutputs)
-            return bestmediapack, bestoutput, (bestmediamissingcount != 0)
-        else:
+        if len(self.mediapacks) == 0:
             return None, [], True
-
-# Simple wrapper around the PinyinAudioReadingsVisitor
-def audioreadingforpack(mediapack, audioextensions, words):
-    visitor = PinyinAudioReadingsVisitor(mediapack, audioextensions)
-    [word.accept(visitor) for word in trimerhua(words)]
-    return (visitor.output, visitor.mediamissingcount)
-
-class PinyinAudioReadingsVisitor(TokenVisitor):
-    def __init__(self, mediapack, audioextensions):
-        self.mediapack = mediapack
-        self.audioextensions = audioextensions
         
-        self.output = []
-        self.mediamissingcount = 0
-    
-    def visitText(self, text):
-        pass
-
-    def visitPinyin(self, pinyin):
-        # Find possible base sounds we could accept
-        possiblebases = [pinyin.numericformat(hideneutraltone=False, tone="spoken")]
-        substitutions = waysToSubstituteAwayUUmlaut(pinyin.word)
-        if pinyin.toneinfo.spoken == 5:
-            # Sometimes we can replace tone 5 with 4 in order to deal with lack of '[xx]5.ogg's
-            possiblebases.extend([pinyin.word, pinyin.word + '4'])
-        elif substitutions is not None:
-            # Typically u: is written as v in filenames
-            possiblebases.extend([substitution + str(pinyin.toneinfo.spoken) for substitution in substitutions])
-    
-        # Find path to first suitable media in the possibilty list
-        for possiblebase in possiblebases:
-            media = self.mediapack.mediafor(possiblebase, self.audioextensions)
-            if media:
-                break
-    
-        if media:
-            # If we've managed to find some media, we can put it into the output:
-            self.output.append(media)
-        else:
-            # Otherwise, increment the count of missing media we use to determine optimality
-            log.warning("Couldn't find media for %s (%s) in %s", pinyin, pinyin.numericformat(tone="spoken"), self.mediapack)
-            self.mediamissingcount += 1
-
-    def visitTonedCharacter(self, tonedcharacter):
-        pass
+        # Gather the syllables we need sounds for in one pass, leaving out the erhua
+        syllables = [(token.word.lower(), token.toneinfo.spoken) for word in tokens for token in word if isinstance(token, Pinyin) and not(token.iser)]
+        
+        # Count how many times each pack would come up short. We don't want to use a mix of
+        # sounds from different packs, so only a pack that minimizes this will be chosen. Few
+        # syllables differ in which packs cover them, so tally the distinct masks first
+        maskcounts = {}
+        for syllable in syllables:
+            mask = self.coveringpacks[syllable]
+            maskcounts[mask] = maskcounts.get(mask, 0) + 1
+        
+        mediamissingcounts = [sum([count for mask, count in maskcounts.items() if not(mask & (1 << n))]) for n in range(len(self.mediapacks))]
+        
+        # Break ties between the best packs randomly
+        bestmediamissingcount = min(mediamissingcounts)
+        bestmediapacks = [n for n, mediamissingcount in enumerate(mediamissingcounts) if mediamissingcount == bestmediamissingcount]
+        best = random.choice(bestmediapacks)
+        bestmediapack, bestcoverage = self.mediapacks[best], self.coverages[best]
+        log.info("Chose pack %s for the reading, missing %d sounds", bestmediapack.name, bestmediamissingcount)
+        
+        output = []
+        for syllable in syllables:
+            media = bestcoverage[syllable]
+            if media is not None:
+                output.append(media)
+            else:
+                log.warning("Couldn't find media for %s%d in %s", syllable[0], syllable[1], bestmediapack)
+        
+        return bestmediapack, output, (bestmediamissingcount != 0)
 
 """
 Replace occurences of the expression in the words with the masking character.
 """
 def maskhanzi(expression, maskingcharacter, words):
-    return [word.map(MaskHanziVisitor(expression, maskingcharacter)) for word in words]
+    return HanziMasker(expression, maskingcharacter).mask(words)
 
-class MaskHanziVisitor(TokenVisitor):
+"""
+Masks the hanzi of an expression in any number of definitions. Every run of hanzi taken from
+the expression is masked, longest first, and each masked run becomes a single masking character.
+
+We work out the runs once per expression rather than once per bit of text. Masking is then a
+pass of str.replace per run, which does the scanning in C: we tried walking a trie of the runs
+over the text instead, but in Python that came out many times slower for realistic definitions.
+"""
+class HanziMasker(object):
     def __init__(self, expression, maskingcharacter):
         self.expression = expression
         self.maskingcharacter = maskingcharacter
+        self.visitor = MaskHanziVisitor(self)
+        
+        # Each run only needs replacing once, at the point where it first turns up in the order
+        self.runs, seen = [], set()
+        for substring in substrings(expression):
+            if substring not in seen and characters.isallhanzi(substring):
+                self.runs.append(substring)
+                seen.add(substring)
+        
+        # Most text in definitions has none of the expression in it at all, and we can spot that in one go
+        self.runcharacters = frozenset(u"".join(self.runs))
     
-    def visitText(self, text):
-        for substring in substrings(self.expression):
-            if all([isHanzi(c) for c in substring]):
-                text = text.replace(substring, self.maskingcharacter)
+    def mask(self, words):
+        # Only rebuild the words that actually have something to mask
+        return [self.needsmasking(word) and word.map(self.visitor) or word for word in words]
+    
+    def needsmasking(self, word):
+        for token in word:
+            if isinstance(token, Text):
+                if not(self.runcharacters.isdisjoint(token)):
+                    return True
+            elif isinstance(token, TonedCharacter):
+                if unicode(token) in self.expression:
+                    return True
+        
+        return False
+    
+    def masktext(self, text):
+        if self.runcharacters.isdisjoint(text):
+            return text
+        
+        for run in self.runs:
+            text = text.replace(run, self.maskingcharacter)
+        
+        return text
 
-        return Text(text)
+class MaskHanziVisitor(TokenVisitor):
+    def __init__(self, masker):
+        self.masker = masker
+    
+    def visitText(self, text):
+        return Text(self.masker.masktext(text))
 
     def visitPinyin(self, pinyin):
         return pinyin
 
     def visitTonedCharacter(self, tonedcharacter):
-        if unicode(tonedcharacter) in self.expression:
-            return Text(self.maskingcharacter)
+        if unicode(tonedcharacter) in self.masker.expression:
+            return Text(self.masker.maskingcharacter)
         else:
             return tonedcharacter
@@ -3,6 +3,7 @@
 
 import os
 
+import characters
 import db
 import dictionary
 import dictionaryonline
@@ -10,6 +11,7 @@ import media
 import meanings
 import numberutils
 import model
+import profiling
 import transformations
 import utils
 import random
@@ -19,11 +21,36 @@ from config import getconfig, updatecontrolflags
 from logger import log
 
 
-def preparetokens(config, tokens):
-    if config.colorizedpinyingeneration:
-        tokens = transformations.colorize(config.tonecolors, tokens)
+def preparetokens(config, tokens, sandhi=False):
+    colorlist = config.colorizedpinyingeneration and config.tonecolors or None
+    return flattentokens(config, tokens, tonify=config.shouldtonify, colorlist=colorlist, sandhi=sandhi)
 
-    return model.flatten(tokens, tonify=config.shouldtonify)
+def flattentokens(config, tokens, tonify=False, colorlist=None, sandhi=False):
+    colorclasses = config.usetonecolorclasses and transformations.tonecolorclasses(config.tonecolors) or None
+    return profiling.timed("rendering", lambda: transformations.render(tokens, colorlist=colorlist, sandhi=sandhi, tonify=tonify, coalesce=config.compactcoloredhtml, colorclasses=colorclasses))
+
+"""
+Concatenated readings for each cache directory. NB: the downloads directory is the one place in the
+media directory that we won't mistake for a media pack.
+"""
+audioconcatenators = utils.FactoryDict(media.AudioConcatenator)
+
+silencepath = utils.toolkitdir("pinyin", "system-media", "silence.mp3")
+
+"""
+Split a reading into the phrases between its punctuation, which is where we want gaps in the audio.
+"""
+def splitphrases(dictreading):
+    phrases = [[]]
+    for word in dictreading:
+        ispunctuation = len([() for token in word if not(isinstance(token, model.Text))]) == 0 and \
+                        u"".join(word).strip() != u"" and characters.ispunctuation(u"".join(word).strip())
+        if ispunctuation:
+            phrases.append([])
+        else:
+            phrases[-1].append(word)
+    
+    return phrases
 
 def generateaudio(notifier, mediamanager, config, dictreading):
     mediapacks = mediamanager.discovermediapacks()
@@ -36,21 +63,36 @@ def generateaudio(notifier, mediamanager, config, dictreading):
         return None
     
     # Get the best media pack to generate the audio, along with the string of files from that pack we need to take
-    mediapack, output, _mediamissing = transformations.PinyinAudioReadings(mediapacks, config.audioextensions).audioreading(dictreading)
+    mediapack, output, _mediamissing = profiling.timed("audio", lambda: transformations.PinyinAudioReadings(mediapacks, config.audioextensions).audioreading(dictreading))
+    
+    # Perhaps play the whole reading from a single file, so Anki doesn't have to start on a new file for every syllable
+    if config.concatenateaudio and len(output) > 1 and len([() for outputfile in output if os.path.splitext(outputfile)[1].lower() != ".mp3"]) == 0:
+        phrases = [transformations.PinyinAudioReadings([mediapack], config.audioextensions).audioreading(phrase)[1] for phrase in splitphrases(dictreading)]
+        concatenator = audioconcatenators[os.path.join(mediamanager.mediadir(), "downloads", "readings")]
+        outputpath = profiling.timed("audio", lambda: concatenator.concatenate([[os.path.join(mediapack.packpath, outputfile) for outputfile in phrase] for phrase in phrases if len(phrase) != 0], silencepath))
+        return "[sound:%s]" % profiling.timed("media import", lambda: mediamanager.importtocurrentdeck(outputpath))
     
     # Construct the string of audio tags from the optimal choice of sounds
     output_tags = u""
     for outputfile in output:
         # Install required media in the deck as we go, getting the canonical string to insert into the sound field upon installation
-        output_tags += "[sound:%s]" % mediamanager.importtocurrentdeck(os.path.join(mediapack.packpath, outputfile))
+        output_tags += "[sound:%s]" % profiling.timed("media import", lambda: mediamanager.importtocurrentdeck(os.path.join(mediapack.packpath, outputfile)))
     
     return output_tags
 
+"""
+The updaters generate fields using a frozen snapshot of their settings, which is only made
+again once the settings change.
+"""
+compiledconfig = property(lambda self: self.sourceconfig.compiled())
+
 class FieldUpdaterFromAudio(object):
+    config = compiledconfig
+    
     def __init__(self, notifier, mediamanager, config=getconfig()):
         self.notifier = notifier
         self.mediamanager = mediamanager
-        self.config = config
+        self.sourceconfig = config
     
     def reformataudio(self, audio):
         output = u""
@@ -60,7 +102,7 @@ class FieldUpdaterFromAudio(object):
                 output += match.group(0)
             else:
                 # Process as if this non-sound tag were a reading, in order to turn it into some tags
-                output += generateaudio(self.notifier, self.mediamanager, self.config, [model.Word(*model.tokenize(match))])
+                output += generateaudio(self.notifier, self.mediamanager, self.config, [model.Word(*model.tokenize(match, segment=True))])
         
         return output
     
@@ -73,8 +115,10 @@ class FieldUpdaterFromAudio(object):
         fact['audio'] = self.reformataudio(audio)
 
 class FieldUpdaterFromMeaning(object):
+    config = compiledconfig
+    
     def __init__(self, config=getconfig()):
-        self.config = config
+        self.sourceconfig = config
 
     def reformatmeaning(self, meaning):
         output = u""
@@ -97,8 +141,10 @@ class FieldUpdaterFromMeaning(object):
         fact['meaning'] = self.reformatmeaning(meaning)
 
 class FieldUpdaterFromReading(object):
+    config = compiledconfig
+    
     def __init__(self, config=getconfig()):
-        self.config = config
+        self.sourceconfig = config
     
     def updatefact(self, fact, reading):
         # Don't bother if the appropriate configuration option is off
@@ -116,14 +162,32 @@ class FieldUpdaterFromReading(object):
     
         # Identify probable pinyin in the user's freeform input, reformat them according to the
         # current rules, and pop the result back into the field
-        fact['reading'] = preparetokens(self.config, [model.Word(*model.tokenize(reading))])
+        fact['reading'] = preparetokens(self.config, [model.Word(*model.tokenize(reading, segment=True))])
+
+# What the result cache gives us when it doesn't know a value, since None is a value it can know
+notcached = object()
 
 class FieldUpdaterFromExpression(object):
-    def __init__(self, notifier, mediamanager, config=getconfig()):
+    config = compiledconfig
+    
+    # The fields whose contents depend only on the expression, the dictionaries and the settings, so
+    # that they can be remembered in the result cache. NB: audio is left out because it must be imported
+    # into the deck being updated, the expression because we only ever fill it in from the others, and
+    # trad and simp because they are whatever Google Translate said, which may just be that it was unreachable
+    cachedkeys = ["reading", "meaning", "mw", "color"]
+    
+    # The fields that we may write to even if they are already filled in (see shouldupdate)
+    rewrittenkeys = ["expression", "weblinks", "color"]
+    
+    def __init__(self, notifier, mediamanager, config=getconfig(), cache=None):
         self.notifier = notifier
         self.mediamanager = mediamanager
         self.dictionaries = dictionary.PinyinDictionary.loadall()
-        self.config = config
+        self.sourceconfig = config
+        self.cache = cache
+        
+        # The dictionaries only load their data once, so that is the version we will get for the whole session
+        self.dataversion = utils.Thunk(dictionary.dataversion)
     
     dictionary = property(lambda self: self.dictionaries(self.config.dictlanguage))
     
@@ -145,11 +209,12 @@ class FieldUpdaterFromExpression(object):
             return None
         
         # Consider sandhi in meanings - you never know, there might be some!
-        dictmeanings = [transformations.tonesandhi(dictmeaning) for dictmeaning in dictmeanings]
+        dictmeanings = profiling.timed("rendering", lambda: [transformations.tonesandhi(dictmeaning) for dictmeaning in dictmeanings])
         
         if self.config.hanzimasking:
             # Hanzi masking is on: scan through the meanings and remove the expression itself
-            dictmeanings = [transformations.maskhanzi(expression, self.config.formathanzimaskingcharacter(), dictmeaning) for dictmeaning in dictmeanings]
+            masker = transformations.HanziMasker(expression, self.config.formathanzimaskingcharacter())
+            dictmeanings = [masker.mask(dictmeaning) for dictmeaning in dictmeanings]
 
         # Prepare all the meanings by flattening them and removing empty entries
         meanings = [meaning for meaning in [preparetokens(self.config, dictmeaning) for dictmeaning in dictmeanings] if meaning.strip != '']
@@ -196,7 +261,7 @@ class FieldUpdaterFromExpression(object):
         return generateaudio(self.notifier, self.mediamanager, self.config, transformations.tonesandhi(dictreading))
     
     def generatecoloredcharacters(self, expression):
-        return model.flatten(transformations.colorize(self.config.tonecolors, transformations.tonesandhi(self.dictionary.tonedchars(expression))))
+        return flattentokens(self.config, profiling.timed("segmentation", lambda: self.dictionary.tonedchars(expression)), colorlist=self.config.tonecolors, sandhi=True)
 
     # Future support will need to be dictionary-based and will require a lot more work
     # Will need to be a bit complex:
@@ -219,7 +284,7 @@ class FieldUpdaterFromExpression(object):
             glangcode="zh-CN"
         else:
             glangcode="zh-TW"
-        meanings = dictionaryonline.gTrans(expression, glangcode, False)
+        meanings = profiling.timed("translation", lambda: dictionaryonline.gTrans(expression, glangcode, False))
         
         if meanings == None or len(meanings) == 0:
             # No conversion, so give up and return the input expression
@@ -252,6 +317,64 @@ class FieldUpdaterFromExpression(object):
   
         raise AssertionError("The CEDICT reading lookup should always succeed, but it failed on %s" % expression)
     
+    def lookupmeanings(self, expression, hasmwfield, dictionarymeanings):
+        dictmeaningssources = [
+                # Use CEDICT to get meanings
+                (None,
+                 dictionarymeanings),
+                # Interpret Hanzi as numbers. NB: only consult after CEDICT so that we
+                # handle curious numbers such as 'liang' using the dictionary
+                (None,
+                 lambda: (numberutils.meaningfromnumberlike(expression, self.dictionary), None))
+            ] + (self.config.shouldusegoogletranslate and [
+                # If the dictionary can't answer our question, ask Google Translate.
+                # If there is a long word followed by another word then this will be treated as a phrase.
+                # Phrases are also queried using googletranslate rather than the local dictionary.
+                # This helps deal with small dictionaries (for example French)
+                ('<br /><span style="color:gray"><small>[Google Translate]</small></span><span> </span>',
+                 lambda: (profiling.timed("translation", lambda: dictionaryonline.gTrans(expression, self.config.dictlanguage)), None))
+            ] or [])
+        
+        # Find the first source that returns a sensible meaning
+        for dictmeaningssource, lookup in dictmeaningssources:
+            dictmeanings, dictmeasurewords = lookup()
+            if dictmeanings != None or dictmeasurewords != None:
+                break
+        
+        # If the user wants the measure words to be folded into the definition or there
+        # is no MW field for us to split them out into, fold them in there
+        if not(self.config.detectmeasurewords) or not(hasmwfield):
+            # NB: do NOT overwrite the old dictmeasurewords, because we still want to use the
+            # measure words for e.g. measure word audio generation
+            dictmeanings = dictionary.combinemeaningsmws(dictmeanings, dictmeasurewords)
+        
+        # NB: expression only used for Hanzi masking here
+        meaning = self.generatemeanings(expression, dictmeanings)
+        if meaning and dictmeaningssource:
+            # Append attribution to the meaning if we have any
+            meaning = meaning + dictmeaningssource
+        
+        return meaning, dictmeasurewords
+    
+    """
+    Generate the value for the given field, or get it from the result cache if we have made it before.
+    The cache key says what the fields were generated from: a thunk, so we only work it out if we need it.
+    """
+    def cachedvalue(self, cachekey, key, generate):
+        if self.cache is None or key not in self.cachedkeys:
+            return generate()
+        
+        value = self.cache.get(cachekey() + (key,), notcached)
+        if value is notcached:
+            value = generate()
+            
+            # NB: if a field might have come from Google, having no value may just mean that it was unreachable
+            mightusegoogle = key in ["meaning", "mw"] and self.config.fallbackongoogletranslate
+            if value is not None or not(mightusegoogle):
+                self.cache.put(cachekey() + (key,), value)
+        
+        return value
+    
     def updatefact(self, fact, expression):
         # AutoBlanking Feature - If there is no expression, zeros relevant fields
         # DEBUG - add feature to store the text when a lookup is performed. When new text is entered then allow auto-blank any field that has not been edited
@@ -279,68 +402,52 @@ class FieldUpdaterFromExpression(object):
             # delay, but I'm not sure where the delay originates from, which worries me:
             return
         
-        # Apply tone sandhi: this information is needed both by the sound generation
-        # and the colorisation, so we can't do it in generatereading
-        dictreading = self.getdictreading(expression)
-        dictreadingsandhi = transformations.tonesandhi(dictreading)
-  
-        # Preload the meaning, but only if we absolutely must
-        if self.config.needmeanings:
-            dictmeaningssources = [
-                    # Use CEDICT to get meanings
-                    (None,
-                     lambda: self.dictionary.meanings(expression, self.config.prefersimptrad)),
-                    # Interpret Hanzi as numbers. NB: only consult after CEDICT so that we
-                    # handle curious numbers such as 'liang' using the dictionary
-                    (None,
-                     lambda: (numberutils.meaningfromnumberlike(expression, self.dictionary), None))
-                ] + (self.config.shouldusegoogletranslate and [
-                    # If the dictionary can't answer our question, ask Google Translate.
-                    # If there is a long word followed by another word then this will be treated as a phrase.
-                    # Phrases are also queried using googletranslate rather than the local dictionary.
-                    # This helps deal with small dictionaries (for example French)
-                    ('<br /><span style="color:gray"><small>[Google Translate]</small></span><span> </span>',
-                     lambda: (dictionaryonline.gTrans(expression, self.config.dictlanguage), None))
-                ] or [])
-            
-            # Find the first source that returns a sensible meaning
-            for dictmeaningssource, lookup in dictmeaningssources:
-                dictmeanings, dictmeasurewords = lookup()
-                if dictmeanings != None or dictmeasurewords != None:
-                    break
+        # Look things up only when a field needs them, since the result cache may already know all the fields.
+        # Tone sandhi is needed both by the sound generation and the colorisation, so we can't do it in generatereading
+        # NB: these all work from the expression we were given, even if we change it to simplified or traditional below
+        hasmwfield = "mw" in fact
+        dictreading = utils.Thunk(lambda expression=expression: profiling.timed("segmentation", lambda: self.getdictreading(expression)))
+        dictreadingsandhi = utils.Thunk(lambda: profiling.timed("rendering", lambda: transformations.tonesandhi(dictreading())))
+        # NB: the meanings and the measure words both come from the same dictionary entry, so we only look it up once
+        dictmeaning = utils.Thunk(lambda expression=expression: profiling.timed("segmentation", lambda: self.dictionary.findmeaning(expression)))
+        dictionarymeanings = utils.Thunk(lambda: profiling.timed("meanings", lambda: self.dictionary.meaningsof(dictmeaning(), self.config.prefersimptrad)))
+        meanings = utils.Thunk(lambda expression=expression: profiling.timed("meanings", lambda: self.lookupmeanings(expression, hasmwfield, dictionarymeanings)))
+        # Only the dictionary knows about measure words. Parsing its meaning gives us them as well, so we only
+        # look them up on their own (which can avoid the parsing) if we aren't going to be filling in the meaning
+        # NB: decide before we start filling in fields, because the meaning may be filled in before we need the measure words
+        fillingmeaning = self.shouldupdate(fact, "meaning", False)
+        def lookupmeasurewords():
+            if fillingmeaning:
+                return dictionarymeanings()[1]
             
-            # If the user wants the measure words to be folded into the definition or there
-            # is no MW field for us to split them out into, fold them in there
-            if not(self.config.detectmeasurewords) or "mw" not in fact:
-                # NB: do NOT overwrite the old dictmeasurewords, because we still want to use the
-                # measure words for e.g. measure word audio generation
-                dictmeanings = dictionary.combinemeaningsmws(dictmeanings, dictmeasurewords)
-            
-            # NB: expression only used for Hanzi masking here
-            meaning = self.generatemeanings(expression, dictmeanings)
-            if meaning and dictmeaningssource:
-                # Append attribution to the meaning if we have any
-                meaning = meaning + dictmeaningssource
+            return profiling.timed("meanings", lambda: self.dictionary.measurewordsof(dictmeaning(), self.config.prefersimptrad))
+        
+        measurewords = utils.Thunk(lookupmeasurewords)
 
         # Generate translations of the expression into simplified/traditional on-demand
         expressionviews = utils.FactoryDict(lambda simptrad: self.generateincharactersystem(expression, simptrad))
         
         # Update the expression is option is turned on and the preference simp/trad is different to expression (i.e. needs correcting)
+        originalexpression = expression
         expressionupdated = False
         if self.config.forceexpressiontobesimptrad and (expression != expressionviews[self.config.prefersimptrad]):
             expression = expressionviews[self.config.prefersimptrad]
             expressionupdated = True
+        
+        # NB: the colored characters are made from the expression we may have just converted (which
+        # depends on whether Google Translate could be reached), so we remember values for that too
+        cachekey = utils.Thunk(lambda: (originalexpression, expression, hasmwfield, self.dataversion(), self.config.fingerprint()))
 
         # Do the updates on the fields the user has requested:
         # NB: when adding an updater to this list, make sure that you have
         # added it to the updatecontrolflags dictionary in Config as well!
         updaters = {
                 'expression' : lambda: expression,
-                'reading'    : lambda: self.generatereading(dictreadingsandhi),
-                'meaning'    : lambda: meaning,
-                'mw'         : lambda: self.generatemeasureword(self.config.detectmeasurewords and dictmeasurewords or None),
-                'audio'      : lambda: self.generateaudio(dictreadingsandhi),
-                'mwaudio'    : lambda: self.generatemwaudio(dictreading, dictmeasurewords),
+                'reading'    : lambda: self.generatereading(dictreadingsandhi()),
+                'meaning'    : lambda: meanings()[0],
+                'mw'         : lambda: self.generatemeasureword(self.config.detectmeasurewords and measurewords() or None),
+                'audio'      : lambda: self.generateaudio(dictreadingsandhi()),
+                'mwaudio'    : lambda: self.generatemwaudio(dictreading(), measurewords()),
                 'color'      : lambda: self.generatecoloredcharacters(expression),
                 'trad'       : lambda: (expressionviews["trad"] != expressionviews["simp"]) and expressionviews["trad"] or None,
                 'simp'       : lambda: (expressionviews["trad"] != expressionviews["simp"]) and expressionviews["simp"] or None,
@@ -349,28 +456,34 @@ class FieldUpdaterFromExpression(object):
 
         # Loop through each field, deciding whether to update it or not
         for key, updater in updaters.items():
-            # A hint for reading this method: read the stuff inside the if not(...):
-            # as an assertion that has to be valid before we can proceed with the update.
-            
-            # If this option has been disabled or the field isn't present then jump to the next update.
-            # Expression is always updated because some parts of the code call updatefact with an expression
-            # that is not yet set on the fact, and we need to make sure that it arrives. This is OK, because
-            # we only actually modify a directly user-entered expression when forceexpressiontobesimptrad is on.
-            #
-            # NB: please do NOT do this if key isn't in updatecontrolflags, because that
-            # indicates an error with the Toolkit that I'd like to get an exception for!
-            if not(key in fact and (key == "expression" or updatecontrolflags[key] is None or self.config.settings[updatecontrolflags[key]])):
-                continue
-            
-            # If the field is not empty already then skip (so we don't overwrite it), unless:
-            # a) this is the expression field, which should always be over-written with simp/trad
-            # b) this is the weblinks field, which must always be up to date
-            # c) this is the color field and we have just forced the expression to change,
-            #    in which case we'd like to overwrite the colored characters regardless
-            if not(fact[key].strip() == u"" or key in ["expression", "weblinks"] or (key == "color" and expressionupdated)):
+            if not(self.shouldupdate(fact, key, expressionupdated)):
                 continue
             
             # Fill the field with the new value, but only if we have one and it is necessary to do so
-            value = updater()
+            value = self.cachedvalue(cachekey, key, updater)
             if value != None and value != fact[key]:
                 fact[key] = value
+    
+    """
+    Whether updatefact fills in the field, as far as we can tell without generating its value.
+    """
+    def shouldupdate(self, fact, key, expressionupdated):
+        # A hint for reading this method: read the stuff inside the if not(...):
+        # as an assertion that has to be valid before we can proceed with the update.
+        
+        # If this option has been disabled or the field isn't present then jump to the next update.
+        # Expression is always updated because some parts of the code call updatefact with an expression
+        # that is not yet set on the fact, and we need to make sure that it arrives. This is OK, because
+        # we only actually modify a directly user-entered expression when forceexpressiontobesimptrad is on.
+        #
+        # NB: please do NOT do this if key isn't in updatecontrolflags, because that
+        # indicates an error with the Toolkit that I'd like to get an exception for!
+        if not(key in fact and (key == "expression" or updatecontrolflags[key] is None or self.config.settings[updatecontrolflags[key]])):
+            return False
+        
+        # If the field is not empty already then skip (so we don't overwrite it), unless:
+        # a) this is the expression field, which should always be over-written with simp/trad
+        # b) this is the weblinks field, which must always be up to date
+        # c) this is the color field and we have just forced the expression to change,
+        #    in which case we'd like to overwrite the colored characters regardless
+        return fact[key].strip() == u"" or key in ["expression", "weblinks"] or (key == "color" and expressionupdated)
@@ -6,7 +6,6 @@ import re
 import sys
 import string
 import getpass
-import unicodedata
 
 """
 Is the current user a developer?
@@ -44,22 +43,6 @@ def suppressexceptions(action):
             from logger import log
             log.exception("Had to suppress an exception")
 
-"""
-Utility function that reports whether a string consists only of punctuation character
-"""
-def ispunctuation(text):
-    # NB: can't use "all" because it's not in Python 2.4 and below, which Anki uses
-    for char in text:
-        # For General_Category list see http://unicode.org/Public/UNIDATA/UCD.html
-        # Po . , ' "
-        # Pd -
-        # Ps ( [
-        # Pe ) ]
-        if 'P' not in unicodedata.category(unicode(char)):
-            return False
-    
-    return True
-
 """
 Reports whether a string consists of only punctuation characters that should have a space added after them.
 """
@@ -107,7 +90,12 @@ Creates the supplied directory if it doesn't exist.
 """
 def ensuredirexists(dirpath):
     if not(os.path.exists(dirpath)):
-        os.makedirs(dirpath)
+        try:
+            os.makedirs(dirpath)
+        except OSError:
+            # Someone else may have beaten us to it
+            if not(os.path.isdir(dirpath)):
+                raise
 
 """
 Create a directory in the specified path with the specified name, falling back on
@@ -152,19 +140,43 @@ def touch(where):
     open(where, 'w').close()
 
 """
-Find the hex-format MD5 digest of the input.
+Make a fresh MD5 hash object, which can be fed the input bit by bit.
 """
-def md5(what):
+def md5hasher():
     # Try hashlib first, as it's the newer library (Python 2.5 or later)
     try:
         import hashlib
-        return hashlib.md5(what).hexdigest()
+        return hashlib.md5()
     except ImportError:
         pass
     
     # Fall back on md5, the deprecated equivalent that Anki comes with
     import md5
-    return md5.new(what).hexdigest()
+    return md5.new()
+
+"""
+Find the hex-format MD5 digest of the input.
+"""
+def md5(what):
+    hasher = md5hasher()
+    hasher.update(what)
+    return hasher.hexdigest()
+
+"""
+Find the hex-format MD5 digest of the contents of a file, without reading it all in at once.
+"""
+def md5file(path, chunksize=65536):
+    hasher = md5hasher()
+    file = open(path, "rb")
+    try:
+        chunk = file.read(chunksize)
+        while chunk:
+            hasher.update(chunk)
+            chunk = file.read(chunksize)
+    finally:
+        file.close()
+    
+    return hasher.hexdigest()
 
 """
 Lazy evaluation: defer evaluation of the function, then cache the result.
@@ -494,19 +506,6 @@ def isosx():
 def islinux():
     return sys.platform.lower().startswith("linux")
 
-def isHanzi(char):
-    # Originally based on anki.stats.isKanji
-    if type(char) == str:
-        return False
-    
-    import unicodedata
-
-    try:
-        return unicodedata.name(char).find('CJK UNIFIED IDEOGRAPH') >= 0
-    except ValueError:
-        # A control character
-        return False
-
 class FactoryDict(dict):
     def __init__(self, factory, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)